@@ -1,33 +1,173 @@
 import os
+import time
+import atexit
 import logging
 
-from flask import Flask, request, jsonify
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import Flask, Response, g, request, jsonify, stream_with_context
 from flask_cors import CORS
 from supabase import create_client
 
 from config import Config
-from services.storage import upload_file_to_storage
-from services.database import insert_prediction, fetch_history, delete_prediction
-from utils.validation import allowed_file
+from services.storage import (
+    upload_bytes_to_storage,
+    upload_many_to_storage,
+    upload_thumbnail,
+)
+from services.history_cache import create_history_cache
+from services.database import (
+    build_prediction_record,
+    insert_predictions,
+    fetch_history,
+    fetch_prediction,
+    fetch_predictions_by_file_url,
+    delete_prediction,
+    delete_predictions,
+    remove_unreferenced_files,
+)
+from utils.metrics import (
+    REGISTRY,
+    REQUESTS,
+    REQUEST_SECONDS,
+    STAGE_SECONDS,
+    PREDICTIONS,
+)
 from ml.ml_config import MLConfig
-from ml.inference.predictor import Predictor
-
-# Disable GPU
-os.environ["CUDA_VISIBLE_DEVICES"] = "-1"
+import components
+from components import models, embeddings
+from serving import (
+    predict_options,
+    predict_image,
+    batch_options,
+    read_batch_files,
+    check_image,
+    predict_chunk,
+    chunk_results,
+    chunk_saved,
+    chunk_lines,
+    history_options,
+    queue_thumbnails,
+    with_thumbnail_urls,
+    similar_options,
+    search_similar,
+    similar_items,
+    bulk_delete_options,
+    bulk_delete_results,
+    create_thumbnail_worker,
+    create_write_behind,
+    create_file_remover,
+    service_stats,
+    register_service_metrics,
+)
 
 # Setup Flask
 app = Flask(__name__)
+app.config["MAX_CONTENT_LENGTH"] = Config.MAX_REQUEST_BYTES
 CORS(app, resources={r"/*": {"origins": Config.ALLOWED_ORIGINS}})
 
-# Setup logging
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # Supabase client
 sb = create_client(Config.SUPABASE_URL, Config.SUPABASE_KEY)
 
-# Initialize the model
-predictor = Predictor(MLConfig.MODEL_PATH)
+# Threads for storage round trips that run alongside other work
+io_executor = ThreadPoolExecutor(Config.IO_WORKERS, thread_name_prefix="io")
+
+# Recently fetched history pages, updated on inserts and dropped on deletes
+history_cache = create_history_cache(
+    Config.HISTORY_CACHE_BACKEND,
+    url=Config.HISTORY_CACHE_URL,
+    max_users=Config.HISTORY_CACHE_MAX_USERS,
+    ttl_seconds=Config.HISTORY_CACHE_TTL_S,
+)
+
+
+def store_thumbnail(object_path, data):
+    """Upload a thumbnail generated by the thumbnail worker."""
+    upload_thumbnail(sb, Config.BUCKET_NAME, object_path, data)
+
+
+# Thumbnails of uploaded images, generated in the background
+thumbnails = create_thumbnail_worker(store_thumbnail)
+if thumbnails:
+    atexit.register(thumbnails.close)
+
+
+def write_predictions(records):
+    """Insert a write-behind flush, timed like the inserts made directly."""
+    with STAGE_SECONDS.time(stage="insert_prediction"):
+        return insert_predictions(sb, Config.TABLE_NAME, records, history_cache)
+
+
+# Prediction rows written in bulk in the background, flushed on shutdown
+write_behind = create_write_behind(write_predictions)
+if write_behind:
+    atexit.register(write_behind.close)
+
+
+def remove_files(file_urls):
+    """Remove the files of deleted predictions that are still unreferenced."""
+    remove_unreferenced_files(sb, Config.TABLE_NAME, Config.BUCKET_NAME, file_urls)
+
+
+# Files of deleted predictions, removed once no queued row can still
+# reference them
+file_remover = create_file_remover(remove_files)
+if file_remover:
+    atexit.register(file_remover.close)
+
+register_service_metrics(history_cache, write_behind)
+
+
+def download_upload(object_path):
+    """Fetch a stored upload to index it for /api/similar."""
+    return sb.storage.from_(Config.BUCKET_NAME).download(object_path)
+
+
+def init_worker():
+    """
+    Re-create the per-process state of a worker forked from a server that
+    loaded the app first (gunicorn's preload_app, see gunicorn.conf.py).
+    Models and indexes stay shared with the master, copy-on-write, while
+    connections, thread pools and background threads do not survive fork.
+    """
+    global sb, io_executor
+
+    sb = create_client(Config.SUPABASE_URL, Config.SUPABASE_KEY)
+    io_executor = ThreadPoolExecutor(Config.IO_WORKERS, thread_name_prefix="io")
+    if thumbnails:
+        thumbnails.after_fork()
+    if write_behind:
+        write_behind.after_fork()
+    if file_remover:
+        file_remover.after_fork()
+    components.after_fork()
+
+
+def stats():
+    return {
+        **components.stats(),
+        **service_stats(history_cache, write_behind, thumbnails, file_remover),
+    }
+
+
+@app.before_request
+def start_timer():
+    g.start_time = time.perf_counter()
+
+
+@app.after_request
+def record_request(response):
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    if "start_time" in g:
+        REQUEST_SECONDS.observe(
+            time.perf_counter() - g.start_time,
+            endpoint=endpoint,
+            method=request.method,
+        )
+    REQUESTS.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+    return response
 
 
 @app.route("/")
@@ -48,77 +188,335 @@ def predict():
       - 'image': File to upload (required)
       - 'user_id': User identifier (required)
       - 'model_id': Model identifier (optional, defaults to 'cnn')
+      - 'top_k': Number of most likely constellations to return (optional)
+      - 'tiled': 'true' to predict a wide-field photo from overlapping tiles
+        (optional, cannot be combined with 'top_k')
+      - 'tile_aggregation': 'max' or 'vote' for tiled predictions (optional)
 
     Steps:
     1. Validate and process the uploaded file.
-    2. Upload the file to Supabase Storage.
+    2. Upload the file to Supabase Storage and, at the same time,
     3. Perform a prediction using the model.
     4. Save prediction details to the database.
     5. Return the prediction result.
     """
     file = request.files.get("image")
     user_id = request.form.get("user_id")
-    model_id = request.form.get("model_id", "cnn")
 
     # Validate input
     if not file or not user_id:
         logger.error("Missing file or user_id in the request.")
         return jsonify({"error": "Missing file or user_id"}), 400
 
-    # Validate file type
-    if not allowed_file(file.filename):
-        logger.error("Invalid file type provided.")
-        return (
-            jsonify({"error": "Invalid file type. Only JPG, JPEG, PNG allowed."}),
-            400,
-        )
+    options, error = predict_options(request.form, models)
+    if error:
+        return jsonify({"error": error}), 400
+    model_id = options[0]
 
-    # Upload file to storage
-    public_url, error = upload_file_to_storage(sb, Config.BUCKET_NAME, file, user_id)
+    # Check the file type, then the real format and dimensions from the
+    # header only
+    error = check_image(file.filename, file)
     if error:
-        logger.error(f"File upload to storage failed: {error}")
-        return jsonify({"error": error}), 500
+        logger.error(f"Image rejected before upload: {error}")
+        return jsonify({"error": error}), 400
+
+    # Read the upload once, the same buffer feeds the storage upload and the
+    # decoder. BytesIO shares the bytes object instead of copying it.
+    data = file.read()
+
+    # Upload file to storage while the prediction runs
+    upload = io_executor.submit(
+        upload_bytes_to_storage,
+        sb,
+        Config.BUCKET_NAME,
+        data,
+        file.filename,
+        file.mimetype,
+        user_id,
+        Config.CONTENT_ADDRESSED_STORAGE,
+    )
 
     # Make prediction
     try:
-        predicted_class, confidence = predictor.predict(file)
+        predictor = models.get(model_id)
+        prediction = predict_image(predictor, data, *options[1:], embeddings)
+    except TimeoutError as e:
+        logger.error(f"No interpreter available for prediction: {e}")
+        return jsonify({"error": "Server is busy, try again later"}), 503
     except Exception as e:
         logger.error(f"Error making prediction: {e}")
         return jsonify({"error": "Error making prediction"}), 500
+    predicted_class, confidence, details, embedding = prediction
+
+    # The storage service times the upload itself, this is only the part of
+    # it that outlasted the prediction
+    with STAGE_SECONDS.time(stage="upload_wait"):
+        public_url, error = upload.result()
+    if error:
+        logger.error(f"File upload to storage failed: {error}")
+        return jsonify({"error": error}), 500
+    queue_thumbnails(data, public_url, thumbnails)
+
+    PREDICTIONS.inc(model_id=model_id, label=predicted_class)
 
-    # Save prediction to database
-    success, error = insert_prediction(
-        sb, Config.TABLE_NAME, user_id, file.filename, public_url, predicted_class
+    # Save prediction to database, queued when possible and written directly
+    # when the queue is disabled or full
+    record = build_prediction_record(
+        user_id, file.filename, public_url, predicted_class, model_id
     )
+    success, error = True, None
+    if not write_behind or not write_behind.put(record):
+        with STAGE_SECONDS.time(stage="insert_prediction"):
+            success, error = insert_predictions(
+                sb, Config.TABLE_NAME, [record], history_cache
+            )
     if not success:
         logger.error(f"Failed to save prediction to database: {error}")
         return jsonify({"error": error}), 500
+    if embedding is not None:
+        embeddings.add(predictor.fingerprint, user_id, public_url, embedding)
 
+    # The saved history entry, for clients to show it right away: a queued
+    # row only gets its id once written, shortly after the response
     return jsonify(
-        {"label": predicted_class, "confidence": confidence, "file_url": public_url}
+        {
+            "label": predicted_class,
+            "confidence": confidence,
+            "file_url": public_url,
+            "model_id": model_id,
+            "id": record.get("id"),
+            "filename": record["filename"],
+            "created_at": record["created_at"],
+            **details,
+        }
     )
 
 
+@app.route("/api/predict/batch", methods=["POST"])
+def predict_batch():
+    """
+    Predict many images in one request and stream the results.
+
+    Request:
+    - Form-data with:
+      - 'images': Files to upload (one or more), and/or
+      - 'archive': Zip archive of images
+      - 'user_id': User identifier (required)
+      - 'model_id': Model identifier (optional, defaults to 'cnn')
+      - 'top_k': Number of most likely constellations to return (optional)
+
+    Response:
+    - NDJSON stream with one line per image, in upload order, holding either
+      the prediction (as returned by /api/predict) or an 'error'. Images are
+      predicted, uploaded and saved in chunks of BATCH_MAX_SIZE.
+    """
+    options, error = batch_options(request.form, models)
+    if error:
+        return jsonify({"error": error}), 400
+    user_id, model_id, top_k = options
+
+    files, error = read_batch_files(
+        request.files.getlist("images"), request.files.get("archive")
+    )
+    if error:
+        return jsonify({"error": error}), 400
+
+    try:
+        predictor = models.get(model_id)
+    except ValueError as e:
+        logger.error(f"Error loading model: {e}")
+        return jsonify({"error": "Error making prediction"}), 500
+
+    return Response(
+        stream_with_context(
+            _predict_batch_lines(predictor, files, user_id, model_id, top_k)
+        ),
+        mimetype="application/x-ndjson",
+    )
+
+
+def _predict_batch_lines(predictor, files, user_id, model_id, top_k):
+    for start in range(0, len(files), MLConfig.BATCH_MAX_SIZE):
+        chunk = files[start : start + MLConfig.BATCH_MAX_SIZE]
+        valid = [i for i, (_, data, _, _) in enumerate(chunk) if data is not None]
+
+        # Predict the chunk while its uploads are in flight.
+        uploads = upload_many_to_storage(
+            sb,
+            Config.BUCKET_NAME,
+            [chunk[i][:3] for i in valid],
+            user_id,
+            io_executor,
+            Config.CONTENT_ADDRESSED_STORAGE,
+        )
+        predictions, vectors = predict_chunk(
+            predictor, [chunk[i][1] for i in valid], top_k, embeddings
+        )
+        with STAGE_SECONDS.time(stage="upload_wait"):
+            uploaded = [upload.result() for upload in uploads]
+
+        lines, records, indexed = chunk_results(
+            chunk,
+            valid,
+            predictions,
+            vectors,
+            uploaded,
+            user_id,
+            model_id,
+            top_k,
+            thumbnails,
+        )
+        with STAGE_SECONDS.time(stage="insert_prediction"):
+            success, error = insert_predictions(
+                sb, Config.TABLE_NAME, records, history_cache
+            )
+        chunk_saved(lines, predictor, user_id, indexed, success, error, embeddings)
+        yield from chunk_lines(start, chunk, lines)
+
+
+@app.route("/api/stats", methods=["GET"])
+def get_stats():
+    """
+    Report the inference counters of this worker: resident models with the
+    batch sizes formed by their micro-batchers, hits and misses of the
+    prediction cache, near-duplicate index and history cache, the rows of
+    the write-behind queue, the thumbnail backlog and the searches of the
+    embedding index.
+
+    With several server workers each request is answered by one of them,
+    named by 'worker' (its process id); /metrics sums all of them.
+    """
+    return jsonify({"worker": os.getpid(), **stats()}), 200
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """
+    Expose request, stage, model load and prediction metrics of this worker
+    in the Prometheus text format.
+    """
+    return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
+
 @app.route("/api/history", methods=["GET"])
 def get_history():
     """
-    Retrieve a user's prediction history.
+    Retrieve a page of a user's prediction history, newest first.
 
     Query Parameters:
     - user_id (required): Fetch history for this user.
+    - limit (optional): Records per page, up to HISTORY_MAX_PAGE_SIZE.
+    - cursor (optional): 'next_cursor' of the previous page.
+    - fields (optional): Comma-separated columns to return, e.g.
+      'file_url,label'. 'id' and 'created_at' are always returned.
+
+    Response:
+    - 'items': Prediction records, including file URLs and labels. Records
+      with a 'file_url' also get a 'thumbnail_url' and a 'preview_url'
+      when thumbnails are enabled; the thumbnails of older uploads may be
+      missing, clients fall back to 'file_url'.
+    - 'next_cursor': Cursor of the next page, null on the last page.
+    """
+    options, error = history_options(request.args)
+    if error:
+        return jsonify({"error": error}), 400
+
+    with STAGE_SECONDS.time(stage="fetch_history"):
+        page, error = fetch_history(sb, Config.TABLE_NAME, *options, history_cache)
+    if error:
+        return jsonify({"error": error}), 500
+
+    history, next_cursor = page
+    return (
+        jsonify(
+            {
+                "items": with_thumbnail_urls(history, thumbnails),
+                "next_cursor": next_cursor,
+            }
+        ),
+        200,
+    )
+
+
+@app.route("/api/similar", methods=["GET"])
+def get_similar():
+    """
+    Find a user's earlier uploads that look most like one of their uploads.
+
+    Query Parameters:
+    - user_id (required): Owner of the uploads.
+    - id (required): Prediction whose upload is looked up.
+    - limit (optional): Uploads to return, up to SIMILAR_MAX_RESULTS.
 
     Response:
-    - List of prediction records, including file URLs and labels.
+    - 'items': History records of the most similar uploads, most similar
+      first, each with its cosine 'similarity' to the query. Only uploads
+      predicted by the same model, one that outputs embeddings, are
+      compared.
     """
-    user_id = request.args.get("user_id")
-    if not user_id:
-        return jsonify({"error": "Missing user_id"}), 400
+    options, error = similar_options(request.args)
+    if error:
+        return jsonify({"error": error}), 400
+    user_id, pred_id, limit = options
+
+    if not embeddings:
+        return jsonify({"error": "Similar-image search is disabled"}), 501
 
-    history, error = fetch_history(sb, Config.TABLE_NAME, user_id)
+    record, error = fetch_prediction(sb, Config.TABLE_NAME, pred_id, user_id)
+    if error:
+        return jsonify({"error": error}), 500
+    if not record:
+        return jsonify({"error": "Prediction not found"}), 404
+
+    matches = search_similar(record, limit, embeddings, models, download_upload)
+    if matches is None:
+        return jsonify({"error": "No embedding stored for this upload"}), 404
+
+    # Uploads deleted since they were indexed are skipped. Rows still in the
+    # write-behind queue are not in the table yet either, so they are not
+    # dropped from the index.
+    records, error = fetch_predictions_by_file_url(
+        sb, Config.TABLE_NAME, user_id, [file_url for file_url, _ in matches]
+    )
     if error:
         return jsonify({"error": error}), 500
 
-    return jsonify(history), 200
+    return jsonify({"items": similar_items(matches, records, thumbnails)}), 200
+
+
+@app.route("/api/history", methods=["DELETE"])
+def delete_history_items():
+    """
+    Delete several of a user's prediction records and their files at once.
+
+    Request:
+    - JSON body with 'user_id': Owner of the records, and 'ids': List of
+      prediction ids, at most MAX_BULK_DELETE.
+
+    Response:
+    - 'results': One entry per id, in request order, with either
+      'success': true or an 'error'. Ids of records that are not the
+      user's are reported as not found.
+    """
+    options, error = bulk_delete_options(request.get_json(silent=True))
+    if error:
+        return jsonify({"error": error}), 400
+    user_id, pred_ids = options
+
+    with STAGE_SECONDS.time(stage="delete_predictions"):
+        outcomes, error = delete_predictions(
+            sb,
+            Config.TABLE_NAME,
+            Config.BUCKET_NAME,
+            user_id,
+            pred_ids,
+            history_cache,
+            file_remover,
+        )
+    if error:
+        return jsonify({"error": error}), 500
+
+    return jsonify({"results": bulk_delete_results(pred_ids, outcomes)}), 200
 
 
 @app.route("/api/history/<int:pred_id>", methods=["DELETE"])
@@ -129,12 +527,20 @@ def delete_history_item(pred_id):
     Steps:
     1. Fetch the prediction record from the database.
     2. Parse the file path from the record.
-    3. Remove the file from Supabase Storage.
-    4. Delete the record from the database.
+    3. Delete the record from the database and drop the user's cached
+       history.
+    4. Remove the file from Supabase Storage unless other predictions still
+       reference it.
     """
-    response, error = delete_prediction(
-        sb, Config.TABLE_NAME, Config.BUCKET_NAME, pred_id
-    )
+    with STAGE_SECONDS.time(stage="delete_prediction"):
+        response, error = delete_prediction(
+            sb,
+            Config.TABLE_NAME,
+            Config.BUCKET_NAME,
+            pred_id,
+            history_cache,
+            file_remover,
+        )
 
     if error:
         if error == "Prediction not found":
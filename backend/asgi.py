@@ -0,0 +1,519 @@
+"""
+ASGI serving mode: the routes of app.py on Quart, for I/O-bound traffic.
+
+Run from the backend directory:
+
+    hypercorn asgi:app --bind 0.0.0.0:5000
+
+Storage uploads and database queries are awaited on a Supabase AsyncClient,
+so a single process keeps hundreds of requests in flight while they wait on
+the network, instead of one per worker thread. Decoding and inference are
+CPU-bound and run on a bounded thread pool: ASYNC_CPU_WORKERS threads, with
+at most ASYNC_MAX_PENDING_CPU predictions waiting for them. Models and
+indexes come from components.py, request parsing and responses from the
+helpers of serving.py, so both modes behave alike without loading app.py
+and its sync clients. The background services of app.py are created here
+too, reaching Supabase through the event loop, and history cache calls run
+in threads, as the cache may wait on Redis.
+"""
+
+import os
+import time
+import asyncio
+import logging
+import functools
+
+from concurrent.futures import ThreadPoolExecutor
+
+from quart import Quart, Response, g, request, jsonify
+from quart_cors import cors
+from supabase import acreate_client
+
+from config import Config
+from services import async_database, async_storage
+from services.database import build_prediction_record
+from services.history_cache import create_history_cache
+from utils.metrics import (
+    REGISTRY,
+    REQUESTS,
+    REQUEST_SECONDS,
+    STAGE_SECONDS,
+    PREDICTIONS,
+)
+from ml.ml_config import MLConfig
+import components
+from components import models, embeddings
+from serving import (
+    predict_options,
+    predict_image,
+    batch_options,
+    read_batch_files,
+    check_image,
+    predict_chunk,
+    chunk_results,
+    chunk_saved,
+    chunk_lines,
+    history_options,
+    queue_thumbnails,
+    with_thumbnail_urls,
+    similar_options,
+    search_similar,
+    similar_items,
+    bulk_delete_options,
+    bulk_delete_results,
+    create_thumbnail_worker,
+    create_write_behind,
+    create_file_remover,
+    service_stats,
+    register_service_metrics,
+)
+
+logger = logging.getLogger(__name__)
+
+app = Quart(__name__)
+app.config["MAX_CONTENT_LENGTH"] = Config.MAX_REQUEST_BYTES
+app = cors(app, allow_origin=Config.ALLOWED_ORIGINS)
+
+# Async Supabase client and the server's event loop, set at startup
+sb = None
+loop = None
+
+# Enough threads for every pooled interpreter to fill its micro-batches, as
+# threads waiting on a batch are idle
+cpu_executor = ThreadPoolExecutor(
+    Config.ASYNC_CPU_WORKERS
+    or MLConfig.INTERPRETER_POOL_SIZE
+    * (MLConfig.BATCH_MAX_SIZE if MLConfig.BATCHING_ENABLED else 1),
+    thread_name_prefix="cpu",
+)
+cpu_slots = asyncio.Semaphore(Config.ASYNC_MAX_PENDING_CPU)
+
+
+async def run_cpu(fn, *args):
+    """
+    Run CPU-bound work on the executor without blocking the event loop.
+    Raises TimeoutError when the backlog stays full for the interpreter
+    pool timeout.
+    """
+    try:
+        await asyncio.wait_for(cpu_slots.acquire(), MLConfig.INTERPRETER_POOL_TIMEOUT_S)
+    except asyncio.TimeoutError:
+        raise TimeoutError("Prediction backlog is full")
+    try:
+        return await asyncio.get_running_loop().run_in_executor(
+            cpu_executor, functools.partial(fn, *args)
+        )
+    finally:
+        cpu_slots.release()
+
+
+def run_on_loop(coroutine):
+    """
+    Await a coroutine on the server's event loop from a background thread
+    (write-behind, thumbnails, file removal, CPU pool), blocking that thread
+    until it completes.
+    """
+    return asyncio.run_coroutine_threadsafe(coroutine, loop).result()
+
+
+# Recently fetched history pages, updated on inserts and dropped on deletes
+history_cache = create_history_cache(
+    Config.HISTORY_CACHE_BACKEND,
+    url=Config.HISTORY_CACHE_URL,
+    max_users=Config.HISTORY_CACHE_MAX_USERS,
+    ttl_seconds=Config.HISTORY_CACHE_TTL_S,
+)
+
+
+def store_thumbnail(object_path, data):
+    """Upload a thumbnail generated by the thumbnail worker."""
+    run_on_loop(
+        async_storage.upload_thumbnail(sb, Config.BUCKET_NAME, object_path, data)
+    )
+
+
+def write_predictions(records):
+    """Insert a write-behind flush, timed like the inserts made directly."""
+    with STAGE_SECONDS.time(stage="insert_prediction"):
+        return run_on_loop(
+            async_database.insert_predictions(
+                sb, Config.TABLE_NAME, records, history_cache
+            )
+        )
+
+
+def remove_files(file_urls):
+    """Remove the files of deleted predictions that are still unreferenced."""
+    run_on_loop(
+        async_database.remove_unreferenced_files(
+            sb, Config.TABLE_NAME, Config.BUCKET_NAME, file_urls
+        )
+    )
+
+
+def download_upload(object_path):
+    """Fetch a stored upload to index it for /api/similar."""
+    return run_on_loop(sb.storage.from_(Config.BUCKET_NAME).download(object_path))
+
+
+# Background services as in app.py, which reach Supabase through the
+# event loop and are closed before it stops
+thumbnails = create_thumbnail_worker(store_thumbnail)
+write_behind = create_write_behind(write_predictions)
+file_remover = create_file_remover(remove_files)
+register_service_metrics(history_cache, write_behind)
+
+
+def stats():
+    return {
+        **components.stats(),
+        **service_stats(history_cache, write_behind, thumbnails, file_remover),
+    }
+
+
+@app.before_serving
+async def create_supabase_client():
+    global sb, loop
+    sb = await acreate_client(Config.SUPABASE_URL, Config.SUPABASE_KEY)
+    loop = asyncio.get_running_loop()
+
+
+@app.after_serving
+async def shutdown_services():
+    # Queued rows and thumbnails still need the event loop to be stored
+    for service in (write_behind, thumbnails, file_remover):
+        if service:
+            await asyncio.to_thread(service.close)
+    cpu_executor.shutdown(wait=False)
+
+
+@app.before_request
+async def start_timer():
+    g.start_time = time.perf_counter()
+
+
+@app.after_request
+async def record_request(response):
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    if "start_time" in g:
+        REQUEST_SECONDS.observe(
+            time.perf_counter() - g.start_time,
+            endpoint=endpoint,
+            method=request.method,
+        )
+    REQUESTS.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+    return response
+
+
+@app.route("/")
+async def home():
+    """
+    A basic route to confirm the application is running.
+    """
+    return "Hello, friend! Welcome to the Constellation Recognizer 6001X Deluxe API!"
+
+
+@app.route("/api/predict", methods=["POST"])
+async def predict():
+    """
+    Handle file uploads, perform prediction, and store results, as
+    /api/predict of app.py.
+    """
+    form = await request.form
+    files = await request.files
+    file = files.get("image")
+    user_id = form.get("user_id")
+
+    if not file or not user_id:
+        logger.error("Missing file or user_id in the request.")
+        return jsonify({"error": "Missing file or user_id"}), 400
+
+    options, error = predict_options(form, models)
+    if error:
+        return jsonify({"error": error}), 400
+    model_id = options[0]
+
+    error = check_image(file.filename, file)
+    if error:
+        logger.error(f"Image rejected before upload: {error}")
+        return jsonify({"error": error}), 400
+
+    data = file.read()
+
+    # Upload file to storage while the prediction runs
+    upload = asyncio.ensure_future(
+        async_storage.upload_bytes_to_storage(
+            sb,
+            Config.BUCKET_NAME,
+            data,
+            file.filename,
+            file.mimetype,
+            user_id,
+            Config.CONTENT_ADDRESSED_STORAGE,
+        )
+    )
+
+    def run_prediction():
+        predictor = models.get(model_id)
+        return predictor, predict_image(predictor, data, *options[1:], embeddings)
+
+    try:
+        predictor, prediction = await run_cpu(run_prediction)
+    except TimeoutError as e:
+        logger.error(f"No interpreter available for prediction: {e}")
+        upload.cancel()
+        return jsonify({"error": "Server is busy, try again later"}), 503
+    except Exception as e:
+        logger.error(f"Error making prediction: {e}")
+        upload.cancel()
+        return jsonify({"error": "Error making prediction"}), 500
+    predicted_class, confidence, details, embedding = prediction
+
+    with STAGE_SECONDS.time(stage="upload_wait"):
+        public_url, error = await upload
+    if error:
+        logger.error(f"File upload to storage failed: {error}")
+        return jsonify({"error": error}), 500
+    queue_thumbnails(data, public_url, thumbnails)
+
+    PREDICTIONS.inc(model_id=model_id, label=predicted_class)
+
+    record = build_prediction_record(
+        user_id, file.filename, public_url, predicted_class, model_id
+    )
+    success, error = True, None
+    if not write_behind or not write_behind.put(record):
+        with STAGE_SECONDS.time(stage="insert_prediction"):
+            success, error = await async_database.insert_predictions(
+                sb, Config.TABLE_NAME, [record], history_cache
+            )
+    if not success:
+        logger.error(f"Failed to save prediction to database: {error}")
+        return jsonify({"error": error}), 500
+    if embedding is not None:
+        embeddings.add(predictor.fingerprint, user_id, public_url, embedding)
+
+    # The saved history entry, for clients to show it right away: a queued
+    # row only gets its id once written, shortly after the response
+    return jsonify(
+        {
+            "label": predicted_class,
+            "confidence": confidence,
+            "file_url": public_url,
+            "model_id": model_id,
+            "id": record.get("id"),
+            "filename": record["filename"],
+            "created_at": record["created_at"],
+            **details,
+        }
+    )
+
+
+@app.route("/api/predict/batch", methods=["POST"])
+async def predict_batch():
+    """
+    Predict many images in one request and stream the results as NDJSON,
+    as /api/predict/batch of app.py.
+    """
+    form = await request.form
+    files = await request.files
+    options, error = batch_options(form, models)
+    if error:
+        return jsonify({"error": error}), 400
+    user_id, model_id, top_k = options
+
+    # Reading and checking the images decodes headers and unzips archives
+    try:
+        batch, error = await run_cpu(
+            read_batch_files, files.getlist("images"), files.get("archive")
+        )
+    except TimeoutError as e:
+        logger.error(f"No thread available to read the batch: {e}")
+        return jsonify({"error": "Server is busy, try again later"}), 503
+    if error:
+        return jsonify({"error": error}), 400
+
+    try:
+        predictor = await run_cpu(models.get, model_id)
+    except Exception as e:
+        logger.error(f"Error loading model: {e}")
+        return jsonify({"error": "Error making prediction"}), 500
+
+    return Response(
+        _predict_batch_lines(predictor, batch, user_id, model_id, top_k),
+        mimetype="application/x-ndjson",
+    )
+
+
+async def _predict_batch_lines(predictor, files, user_id, model_id, top_k):
+    for start in range(0, len(files), MLConfig.BATCH_MAX_SIZE):
+        chunk = files[start : start + MLConfig.BATCH_MAX_SIZE]
+        valid = [i for i, (_, data, _, _) in enumerate(chunk) if data is not None]
+
+        # Predict the chunk while its uploads are in flight.
+        uploads = asyncio.ensure_future(
+            async_storage.upload_many_to_storage(
+                sb,
+                Config.BUCKET_NAME,
+                [chunk[i][:3] for i in valid],
+                user_id,
+                Config.CONTENT_ADDRESSED_STORAGE,
+            )
+        )
+        try:
+            predictions, vectors = await run_cpu(
+                predict_chunk,
+                predictor,
+                [chunk[i][1] for i in valid],
+                top_k,
+                embeddings,
+            )
+        except TimeoutError as e:
+            logger.error(f"No interpreter available for batch prediction: {e}")
+            predictions, vectors = [None] * len(valid), [None] * len(valid)
+        with STAGE_SECONDS.time(stage="upload_wait"):
+            uploaded = await uploads
+
+        lines, records, indexed = chunk_results(
+            chunk,
+            valid,
+            predictions,
+            vectors,
+            uploaded,
+            user_id,
+            model_id,
+            top_k,
+            thumbnails,
+        )
+        with STAGE_SECONDS.time(stage="insert_prediction"):
+            success, error = await async_database.insert_predictions(
+                sb, Config.TABLE_NAME, records, history_cache
+            )
+        chunk_saved(lines, predictor, user_id, indexed, success, error, embeddings)
+        for line in chunk_lines(start, chunk, lines):
+            yield line
+
+
+@app.route("/api/stats", methods=["GET"])
+async def get_stats():
+    """Report the inference counters of this process, as in app.py."""
+    return jsonify({"worker": os.getpid(), **stats()}), 200
+
+
+@app.route("/metrics", methods=["GET"])
+async def metrics():
+    """
+    Expose request, stage, model load and prediction metrics of this
+    process in the Prometheus text format.
+    """
+    return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/api/history", methods=["GET"])
+async def get_history():
+    """Retrieve a page of a user's prediction history, as in app.py."""
+    options, error = history_options(request.args)
+    if error:
+        return jsonify({"error": error}), 400
+
+    with STAGE_SECONDS.time(stage="fetch_history"):
+        page, error = await async_database.fetch_history(
+            sb, Config.TABLE_NAME, *options, history_cache
+        )
+    if error:
+        return jsonify({"error": error}), 500
+
+    history, next_cursor = page
+    items = await asyncio.to_thread(with_thumbnail_urls, history, thumbnails)
+    return jsonify({"items": items, "next_cursor": next_cursor}), 200
+
+
+@app.route("/api/similar", methods=["GET"])
+async def get_similar():
+    """
+    Find a user's earlier uploads that look most like one of their uploads,
+    as in app.py.
+    """
+    options, error = similar_options(request.args)
+    if error:
+        return jsonify({"error": error}), 400
+    user_id, pred_id, limit = options
+
+    if not embeddings:
+        return jsonify({"error": "Similar-image search is disabled"}), 501
+
+    record, error = await async_database.fetch_prediction(
+        sb, Config.TABLE_NAME, pred_id, user_id
+    )
+    if error:
+        return jsonify({"error": error}), 500
+    if not record:
+        return jsonify({"error": "Prediction not found"}), 404
+
+    try:
+        matches = await run_cpu(
+            search_similar, record, limit, embeddings, models, download_upload
+        )
+    except TimeoutError as e:
+        logger.error(f"No thread available for the similar search: {e}")
+        return jsonify({"error": "Server is busy, try again later"}), 503
+    if matches is None:
+        return jsonify({"error": "No embedding stored for this upload"}), 404
+
+    records, error = await async_database.fetch_predictions_by_file_url(
+        sb, Config.TABLE_NAME, user_id, [file_url for file_url, _ in matches]
+    )
+    if error:
+        return jsonify({"error": error}), 500
+
+    items = await asyncio.to_thread(similar_items, matches, records, thumbnails)
+    return jsonify({"items": items}), 200
+
+
+@app.route("/api/history", methods=["DELETE"])
+async def delete_history_items():
+    """Delete several prediction records and their files, as in app.py."""
+    options, error = bulk_delete_options(await request.get_json(silent=True))
+    if error:
+        return jsonify({"error": error}), 400
+    user_id, pred_ids = options
+
+    with STAGE_SECONDS.time(stage="delete_predictions"):
+        outcomes, error = await async_database.delete_predictions(
+            sb,
+            Config.TABLE_NAME,
+            Config.BUCKET_NAME,
+            user_id,
+            pred_ids,
+            history_cache,
+            file_remover,
+        )
+    if error:
+        return jsonify({"error": error}), 500
+
+    return jsonify({"results": bulk_delete_results(pred_ids, outcomes)}), 200
+
+
+@app.route("/api/history/<int:pred_id>", methods=["DELETE"])
+async def delete_history_item(pred_id):
+    """Delete a prediction record and associated file, as in app.py."""
+    with STAGE_SECONDS.time(stage="delete_prediction"):
+        response, error = await async_database.delete_prediction(
+            sb,
+            Config.TABLE_NAME,
+            Config.BUCKET_NAME,
+            pred_id,
+            history_cache,
+            file_remover,
+        )
+
+    if error:
+        if error == "Prediction not found":
+            return jsonify({"error": error}), 404
+        return jsonify({"error": error}), 500
+
+    return jsonify(response), 200
+
+
+if __name__ == "__main__":
+    app.run(host="0.0.0.0", port=int(os.getenv("PORT", 5000)))
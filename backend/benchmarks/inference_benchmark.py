@@ -0,0 +1,191 @@
+"""
+Benchmark the inference pipeline stage by stage.
+
+Run from the backend directory:
+
+    python -m benchmarks.inference_benchmark \
+        --models ml/models/best_model.tflite ml/models/best_model_int8.tflite \
+        --batch-sizes 1 4 8 --threads 1 2 4 --output inference_benchmark.json
+
+Every combination of model, interpreter thread count and batch size is run
+for --iterations batches. Decode, resize (including normalization into the
+input buffer), invoke and post-processing are timed separately and
+reported as p50/p95/p99 per batch, together with the throughput. `.keras`
+models are run through Keras for comparison, with TensorFlow's default
+threading. Results are written as JSON so that runs can be diffed.
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+
+import numpy as np
+
+from PIL import Image
+from utils.validation import allowed_file
+from ml.ml_config import MLConfig
+from ml.inference.predictor import Predictor
+from ml.inference.postprocess import TopK
+from ml.inference.preprocess import decode_image
+
+STAGES = ["decode", "resize", "invoke", "postprocess", "total"]
+
+
+def synthetic_images(count, sizes=((640, 480), (4000, 3000))):
+    """Random-noise JPEGs, alternating between the given sizes."""
+    rng = np.random.default_rng(0)
+    images = []
+    for i in range(count):
+        width, height = sizes[i % len(sizes)]
+        pixels = rng.integers(0, 255, (height, width, 3), dtype=np.uint8)
+        buffer = io.BytesIO()
+        Image.fromarray(pixels).save(buffer, "JPEG", quality=90)
+        images.append(buffer.getvalue())
+    return images
+
+
+def sample_images(images_dir, limit):
+    images = []
+    for dirpath, _, filenames in os.walk(images_dir):
+        for filename in sorted(filenames):
+            if allowed_file(filename) and len(images) < limit:
+                with open(os.path.join(dirpath, filename), "rb") as f:
+                    images.append(f.read())
+    return images
+
+
+class TFLiteRunner:
+    def __init__(self, model_path, threads):
+        self.predictor = Predictor(model_path, num_threads=threads)
+        if not self.predictor.pool:
+            raise ValueError(f"Could not load {model_path}")
+
+    def invoke(self, batch):
+        return self.predictor.run(batch)
+
+
+class KerasRunner:
+    def __init__(self, model_path, threads):
+        import tensorflow as tf
+
+        self.model = tf.keras.models.load_model(model_path)
+
+    def invoke(self, batch):
+        return self.model(np.asarray(batch), training=False).numpy()
+
+
+def percentiles(samples_ms):
+    return {
+        "p50": float(np.percentile(samples_ms, 50)),
+        "p95": float(np.percentile(samples_ms, 95)),
+        "p99": float(np.percentile(samples_ms, 99)),
+    }
+
+
+def benchmark(runner, images, batch_size, iterations, warmup=3):
+    top_k = TopK(MLConfig.CONSTELLATIONS)
+    size = MLConfig.IMG_SIZE
+    timings = {stage: [] for stage in STAGES}
+
+    for iteration in range(warmup + iterations):
+        batch_data = [
+            images[(iteration * batch_size + i) % len(images)]
+            for i in range(batch_size)
+        ]
+        batch = np.empty((batch_size, size, size, 3), np.float32)
+
+        start = time.perf_counter()
+        decoded = [decode_image(io.BytesIO(data), size) for data in batch_data]
+        decoded_at = time.perf_counter()
+        for i, img in enumerate(decoded):
+            img = img.resize((size, size), reducing_gap=3.0)
+            np.multiply(np.asarray(img), np.float32(1 / 255.0), out=batch[i])
+        resized_at = time.perf_counter()
+        probabilities = runner.invoke(batch)
+        invoked_at = time.perf_counter()
+        top_k(probabilities, 5)
+        done_at = time.perf_counter()
+
+        if iteration < warmup:
+            continue
+        timings["decode"].append((decoded_at - start) * 1000)
+        timings["resize"].append((resized_at - decoded_at) * 1000)
+        timings["invoke"].append((invoked_at - resized_at) * 1000)
+        timings["postprocess"].append((done_at - invoked_at) * 1000)
+        timings["total"].append((done_at - start) * 1000)
+
+    return {
+        "latency_ms": {stage: percentiles(timings[stage]) for stage in STAGES},
+        "images_per_sec": batch_size * 1000 / float(np.mean(timings["total"])),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--models", nargs="+", default=[MLConfig.MODEL_PATH])
+    parser.add_argument("--batch-sizes", nargs="+", type=int, default=[1, 4, 8])
+    parser.add_argument("--threads", nargs="+", type=int, default=[1, 2, 4])
+    parser.add_argument("--images", help="Directory of sample images")
+    parser.add_argument(
+        "--synthetic", type=int, default=8, help="Synthetic images added to samples"
+    )
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--output", default="inference_benchmark.json")
+    args = parser.parse_args()
+
+    images = synthetic_images(args.synthetic)
+    if args.images:
+        images += sample_images(args.images, limit=64)
+    if not images:
+        parser.error("No images to benchmark, use --images or --synthetic")
+
+    results = []
+    for model_path in args.models:
+        keras = model_path.endswith(".keras")
+        for threads in [None] if keras else args.threads:
+            runner = (KerasRunner if keras else TFLiteRunner)(model_path, threads)
+            for batch_size in args.batch_sizes:
+                result = benchmark(runner, images, batch_size, args.iterations)
+                result.update(
+                    model=os.path.basename(model_path),
+                    threads=threads,
+                    batch_size=batch_size,
+                )
+                results.append(result)
+
+                latency = result["latency_ms"]
+                print(
+                    f"{result['model']:<28} threads={threads or 'default':<8}"
+                    f"batch={batch_size:<4}"
+                    f"total p50={latency['total']['p50']:8.2f}ms "
+                    f"p99={latency['total']['p99']:8.2f}ms "
+                    f"invoke p50={latency['invoke']['p50']:8.2f}ms "
+                    f"{result['images_per_sec']:8.1f} img/s"
+                )
+
+    with open(args.output, "w") as f:
+        json.dump(
+            {
+                "meta": {
+                    "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                    "python": sys.version.split()[0],
+                    "platform": platform.platform(),
+                    "cpu_count": os.cpu_count(),
+                    "runtime": MLConfig.INFERENCE_RUNTIME,
+                    "iterations": args.iterations,
+                    "images": len(images),
+                },
+                "results": results,
+            },
+            f,
+            indent=2,
+        )
+    print(f"Results saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Local stand-in for the parts of Supabase that /api/predict talks to, for
+benchmarks that run the server in another process.
+
+It answers the storage uploads and existence checks and the table inserts
+over HTTP, so the app only needs its SUPABASE_URL pointed at it. Rows are
+kept by a LocalTableClient, objects by their path, and every request waits
+`latency_ms` to mimic the round trip to the real service.
+"""
+
+import json
+import time
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from services.local_table import LocalTableClient
+
+# Any key of the shape the Supabase client accepts, the stand-in ignores it
+KEY = "local.benchmark"
+
+
+class LocalSupabase:
+    def __init__(self, port, latency_ms=0.0):
+        self.latency = latency_ms / 1000.0
+        self.url = f"http://127.0.0.1:{port}"
+        self.tables = LocalTableClient(latency_ms=latency_ms)
+        self.objects = {}
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def stats(self):
+        with self._lock:
+            objects = len(self.objects)
+        rows = sum(len(rows) for rows in self.tables.rows.values())
+        return {"rows": rows, "objects": objects}
+
+    def _handler(self):
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                path = self.path.split("?")[0]
+                if path.startswith("/rest/v1/"):
+                    table = stand_in.tables.table(path[len("/rest/v1/") :])
+                    rows = table.insert(json.loads(body)).execute().data
+                    return self._send(201, rows)
+                if path.startswith("/storage/v1/object/"):
+                    time.sleep(stand_in.latency)
+                    key = path[len("/storage/v1/object/") :]
+                    with stand_in._lock:
+                        stand_in.objects[key] = len(body)
+                    return self._send(200, {"Key": key})
+                self._send(404, {"message": "Not supported by the stand-in"})
+
+            do_PUT = do_POST
+
+            def do_HEAD(self):
+                time.sleep(stand_in.latency)
+                key = self.path.split("?")[0][len("/storage/v1/object/") :]
+                with stand_in._lock:
+                    found = key in stand_in.objects
+                self.send_response(200 if found else 404)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def _send(self, status, payload):
+                body = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
@@ -0,0 +1,211 @@
+"""
+Compare the gunicorn server with the app preloaded in the master against
+every worker loading it on its own.
+
+Run from the backend directory, no Supabase project needed:
+
+    python -m benchmarks.prefork_benchmark [--workers 4] [--threads 4]
+
+Each mode starts gunicorn with gunicorn.conf.py, reports the memory of the
+master and its workers once all workers have loaded the model and again
+after a load of /api/predict requests, and the throughput of that load.
+PSS splits pages shared between processes among them, so its sum is the
+memory the server really uses; private memory is what every worker holds
+on its own.
+
+The server stores the uploads and rows in a local stand-in for Supabase
+(benchmarks/local_supabase.py) that waits --latency-ms per round trip.
+With --remote it uses the project of SUPABASE_URL and SUPABASE_KEY
+instead, and the rows and files of the run are deleted at the end.
+"""
+
+import io
+import os
+import sys
+import time
+import uuid
+import argparse
+import tempfile
+import subprocess
+
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+from PIL import Image
+from supabase import create_client
+
+from config import Config
+from services.database import delete_predictions
+from benchmarks.local_supabase import KEY, LocalSupabase
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def server_memory(pid):
+    """Sum the RSS, PSS and private memory of a server and its workers, in MB."""
+    pids = [pid]
+    with open(f"/proc/{pid}/task/{pid}/children") as f:
+        pids += [int(child) for child in f.read().split()]
+
+    totals = {"rss": 0, "pss": 0, "private": 0}
+    for p in pids:
+        with open(f"/proc/{p}/smaps_rollup") as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                if name == "Rss":
+                    totals["rss"] += int(value.split()[0])
+                elif name == "Pss":
+                    totals["pss"] += int(value.split()[0])
+                elif name in ("Private_Clean", "Private_Dirty"):
+                    totals["private"] += int(value.split()[0])
+    return {key: kb / 1024 for key, kb in totals.items()}
+
+
+def wait_until_loaded(log_path, workers, preload, timeout=300):
+    """Wait for every worker to boot and, unless preloaded, load the model."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with open(log_path) as f:
+            log = f.read()
+        booted = log.count("Booting worker")
+        loaded = log.count("Loaded model")
+        if booted >= workers and (preload or loaded >= workers):
+            return
+        time.sleep(0.2)
+    raise TimeoutError("gunicorn did not start in time")
+
+
+def make_images(count):
+    """Distinct JPEGs, so that none of the predictions is served from a cache."""
+    images = []
+    for i in range(count):
+        img = Image.linear_gradient("L").resize((1280, 960)).convert("RGB")
+        img.paste((i * 37 % 256, i * 91 % 256, i % 256), (0, 0, 64 + i % 64, 64))
+        buffer = io.BytesIO()
+        img.save(buffer, "JPEG")
+        images.append(buffer.getvalue())
+    return images
+
+
+def run_load(url, images, concurrency, user_id):
+    """POST every image to /api/predict, return (requests/s, failed requests)."""
+    with httpx.Client(
+        timeout=60, limits=httpx.Limits(max_connections=concurrency)
+    ) as client:
+
+        def predict(item):
+            i, data = item
+            response = client.post(
+                f"{url}/api/predict",
+                files={"image": (f"benchmark_{i}.jpg", data, "image/jpeg")},
+                data={"user_id": user_id},
+            )
+            return response.status_code == 200
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as executor:
+            results = list(executor.map(predict, enumerate(images)))
+        elapsed = time.perf_counter() - start
+    return len(results) / elapsed, results.count(False)
+
+
+def measure(preload, args, images, supabase_env):
+    port = args.port + preload
+    env = dict(
+        os.environ,
+        **supabase_env,
+        GUNICORN_PRELOAD=str(preload).lower(),
+        GUNICORN_WORKERS=str(args.workers),
+        GUNICORN_THREADS=str(args.threads),
+        GUNICORN_BIND=f"127.0.0.1:{port}",
+        TF_CPP_MIN_LOG_LEVEL="3",
+    )
+    log_path = os.path.join(tempfile.gettempdir(), f"prefork_benchmark_{port}.log")
+    with open(log_path, "w") as log:
+        start = time.perf_counter()
+        server = subprocess.Popen(
+            [sys.executable, "-m", "gunicorn", "app:app"],
+            env=env,
+            cwd=BACKEND_DIR,
+            stdout=log,
+            stderr=subprocess.STDOUT,
+        )
+        try:
+            wait_until_loaded(log_path, args.workers, preload)
+            booted = time.perf_counter() - start
+            idle = server_memory(server.pid)
+            throughput, failed = run_load(
+                f"http://127.0.0.1:{port}", images, args.concurrency, args.user_id
+            )
+            loaded = server_memory(server.pid)
+        finally:
+            server.terminate()
+            server.wait()
+    os.remove(log_path)
+    return booted, idle, loaded, throughput, failed
+
+
+def delete_remote_rows(user_id):
+    """Delete the rows of a --remote run and the files only they reference."""
+    sb = create_client(Config.SUPABASE_URL, Config.SUPABASE_KEY)
+    rows = sb.table(Config.TABLE_NAME).select("id").eq("user_id", user_id).execute()
+    ids = [row["id"] for row in rows.data or []]
+    failed = 0
+    for start in range(0, len(ids), Config.MAX_BULK_DELETE):
+        results = delete_predictions(
+            sb,
+            Config.TABLE_NAME,
+            Config.BUCKET_NAME,
+            user_id,
+            ids[start : start + Config.MAX_BULK_DELETE],
+        )
+        failed += sum(error is not None for error in results.values())
+    return len(ids), failed
+
+
+def report(args, images, supabase_env):
+    print(
+        f"{'mode':<12}{'boot s':>8}{'RSS MB':>10}{'PSS MB':>10}{'private MB':>12}"
+        f"{'after load PSS':>16}{'req/s':>8}{'failed':>8}"
+    )
+    for preload in (False, True):
+        booted, idle, loaded, throughput, failed = measure(
+            preload, args, images, supabase_env
+        )
+        print(
+            f"{'preload' if preload else 'per-worker':<12}{booted:>8.1f}"
+            f"{idle['rss']:>10.0f}{idle['pss']:>10.0f}{idle['private']:>12.0f}"
+            f"{loaded['pss']:>16.0f}{throughput:>8.1f}{failed:>8}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--latency-ms", type=float, default=50.0)
+    parser.add_argument("--remote", action="store_true")
+    args = parser.parse_args()
+    # Rows of this run only, which --remote deletes afterwards
+    args.user_id = f"benchmark-{uuid.uuid4().hex[:8]}"
+
+    images = make_images(args.requests)
+    if args.remote:
+        try:
+            report(args, images, {})
+        finally:
+            deleted, failed = delete_remote_rows(args.user_id)
+            print(f"Deleted {deleted - failed} of {deleted} rows and their files")
+        return
+
+    with LocalSupabase(args.port + 2, args.latency_ms) as stand_in:
+        report(args, images, {"SUPABASE_URL": stand_in.url, "SUPABASE_KEY": KEY})
+        stats = stand_in.stats()
+    print(f"Local stand-in stored {stats['rows']} rows and {stats['objects']} files")
+
+
+if __name__ == "__main__":
+    main()
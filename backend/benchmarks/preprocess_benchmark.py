@@ -0,0 +1,97 @@
+"""
+Compare the original preprocessing with the zero-copy path.
+
+Run from the backend directory:
+
+    python -m benchmarks.preprocess_benchmark [--image PATH] [--runs N]
+
+Without --image a synthetic JPEG of --width x --height pixels is used.
+Allocations are measured with tracemalloc (NumPy reports its buffers to it)
+in a separate pass from the timings, so tracing does not skew the times.
+"""
+
+import io
+import time
+import argparse
+import tracemalloc
+
+import numpy as np
+
+from PIL import Image
+from ml.ml_config import MLConfig
+from ml.inference.preprocess import preprocess_image, preprocess_image_into
+
+
+def legacy_preprocess_image(file):
+    """The preprocessing as it was before the zero-copy path."""
+    img = Image.open(file).convert("RGB")
+    img = img.resize((MLConfig.IMG_SIZE, MLConfig.IMG_SIZE))
+    img_array = np.array(img) / 255.0
+    img_array = img_array.astype(np.float32)
+    img_array = np.expand_dims(img_array, axis=0)
+    return img_array
+
+
+def synthetic_jpeg(width, height):
+    rng = np.random.default_rng(0)
+    pixels = rng.integers(0, 255, (height, width, 3), dtype=np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, "JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def measure(name, fn, data, runs):
+    fn(io.BytesIO(data))
+
+    start = time.perf_counter()
+    for _ in range(runs):
+        fn(io.BytesIO(data))
+    elapsed_ms = (time.perf_counter() - start) / runs * 1000
+
+    tracemalloc.start()
+    fn(io.BytesIO(data))
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {"name": name, "ms_per_image": elapsed_ms, "peak_kib": peak / 1024}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--image", help="Image file to preprocess")
+    parser.add_argument("--width", type=int, default=4000)
+    parser.add_argument("--height", type=int, default=3000)
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+
+    if args.image:
+        with open(args.image, "rb") as f:
+            data = f.read()
+    else:
+        data = synthetic_jpeg(args.width, args.height)
+
+    # Stands in for the interpreter's input tensor, which is allocated once.
+    input_tensor = np.empty((1, MLConfig.IMG_SIZE, MLConfig.IMG_SIZE, 3), np.float32)
+
+    results = [
+        measure("legacy", legacy_preprocess_image, data, args.runs),
+        measure("preprocess_image", preprocess_image, data, args.runs),
+        measure(
+            "preprocess_image_into",
+            lambda f: preprocess_image_into(f, input_tensor[0]),
+            data,
+            args.runs,
+        ),
+    ]
+
+    baseline = results[0]
+    print(f"{'path':<24}{'ms/image':>10}{'peak KiB':>12}{'saved ms':>10}")
+    for r in results:
+        print(
+            f"{r['name']:<24}{r['ms_per_image']:>10.2f}{r['peak_kib']:>12.1f}"
+            f"{baseline['ms_per_image'] - r['ms_per_image']:>10.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
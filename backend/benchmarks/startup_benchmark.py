@@ -0,0 +1,89 @@
+"""
+Measure worker cold start for each TFLite runtime.
+
+Run from the backend directory:
+
+    python -m benchmarks.startup_benchmark [--runtimes litert tensorflow]
+
+Every measurement runs in a fresh Python process and reports the time to
+import the inference code and the TFLite runtime, the time until the
+first prediction returns (model load and warm-up included) and the
+resident memory afterwards.
+"""
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+# Executed in the child process, prints one JSON line.
+PROBE = """
+import io, json, time
+start = time.perf_counter()
+from ml.ml_config import MLConfig
+from ml.inference.predictor import Predictor
+from ml.inference.runtime import get_interpreter_class
+get_interpreter_class()
+imported = time.perf_counter()
+
+from PIL import Image
+buffer = io.BytesIO()
+Image.new("RGB", (640, 480), (10, 20, 30)).save(buffer, "JPEG")
+predictor = Predictor(MLConfig.MODEL_PATH)
+if MLConfig.WARMUP_ENABLED:
+    predictor.warmup()
+predictor.predict(buffer.getvalue())
+predicted = time.perf_counter()
+
+rss_kb = 0
+with open("/proc/self/status") as f:
+    for line in f:
+        if line.startswith("VmRSS:"):
+            rss_kb = int(line.split()[1])
+print(json.dumps({
+    "import_s": imported - start,
+    "first_prediction_s": predicted - start,
+    "rss_mb": rss_kb / 1024,
+}))
+"""
+
+
+def probe(runtime):
+    env = dict(os.environ, INFERENCE_RUNTIME=runtime, TF_CPP_MIN_LOG_LEVEL="3")
+    result = subprocess.run(
+        [sys.executable, "-c", PROBE],
+        env=env,
+        capture_output=True,
+        text=True,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    )
+    if result.returncode != 0:
+        return None
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--runtimes", nargs="+", default=["litert", "tflite_runtime", "tensorflow"]
+    )
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'runtime':<16}{'import s':>10}{'first pred s':>14}{'RSS MB':>10}")
+    for runtime in args.runtimes:
+        samples = [probe(runtime) for _ in range(args.runs)]
+        samples = [s for s in samples if s]
+        if not samples:
+            print(f"{runtime:<16}{'not installed':>34}")
+            continue
+        best = {key: min(s[key] for s in samples) for key in samples[0]}
+        print(
+            f"{runtime:<16}{best['import_s']:>10.2f}"
+            f"{best['first_prediction_s']:>14.2f}{best['rss_mb']:>10.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""
+Compare synchronous prediction inserts with the write-behind queue.
+
+Run from the backend directory, no database needed:
+
+    python -m benchmarks.write_behind_benchmark --records 2000 --clients 8 \
+        --latency-ms 20 --failure-rate 0.05
+
+Records are written by --clients concurrent threads against an in-memory
+table client that sleeps --latency-ms per round trip and fails with
+--failure-rate. For each mode the caller-side latency per record, the
+throughput until every record is stored and the number of round trips are
+reported, and the stored rows are checked against the records sent.
+"""
+
+import time
+import argparse
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from config import Config
+from services.database import (
+    build_prediction_record,
+    insert_prediction,
+    insert_predictions,
+)
+from services.local_table import LocalTableClient
+from services.write_behind import WriteBehindQueue
+
+
+def make_records(count):
+    return [
+        build_prediction_record(
+            f"user-{i % 10}", f"img{i}.jpg", f"http://local/img{i}.jpg", "Lyra", "cnn"
+        )
+        for i in range(count)
+    ]
+
+
+def write_sync(client, record):
+    """One round trip per record, as /api/predict does without the queue."""
+    success, _ = insert_prediction(
+        client,
+        Config.TABLE_NAME,
+        record["user_id"],
+        record["filename"],
+        record["file_url"],
+        record["label"],
+        record["model_id"],
+    )
+    return success
+
+
+def run(records, clients, write, done=None):
+    latencies = []
+
+    def timed(record):
+        start = time.perf_counter()
+        ok = write(record)
+        latencies.append((time.perf_counter() - start) * 1000)
+        return ok
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(clients) as executor:
+        accepted = sum(executor.map(timed, records))
+    if done:
+        done()
+    elapsed = time.perf_counter() - start
+
+    return {
+        "accepted": accepted,
+        "caller_ms_p50": float(np.percentile(latencies, 50)),
+        "caller_ms_p99": float(np.percentile(latencies, 99)),
+        "records_per_sec": len(records) / elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--records", type=int, default=2000)
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--latency-ms", type=float, default=20.0)
+    parser.add_argument("--per-row-ms", type=float, default=0.05)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--max-rows", type=int, default=Config.WRITE_BEHIND_MAX_ROWS)
+    parser.add_argument("--flush-ms", type=float, default=Config.WRITE_BEHIND_FLUSH_MS)
+    args = parser.parse_args()
+
+    records = make_records(args.records)
+
+    def client():
+        return LocalTableClient(
+            args.latency_ms, args.per_row_ms, args.failure_rate, seed=0
+        )
+
+    sync_client = client()
+    sync = run(records, args.clients, lambda record: write_sync(sync_client, record))
+    sync.update(
+        stored=len(sync_client.rows.get(Config.TABLE_NAME, [])),
+        round_trips=sync_client.requests,
+    )
+
+    behind_client = client()
+    queue = WriteBehindQueue(
+        lambda batch: insert_predictions(behind_client, Config.TABLE_NAME, batch),
+        max_rows=args.max_rows,
+        flush_interval_ms=args.flush_ms,
+        max_pending=args.records,
+        max_retries=Config.WRITE_BEHIND_MAX_RETRIES,
+        retry_backoff_ms=Config.WRITE_BEHIND_RETRY_BACKOFF_MS,
+    )
+    behind = run(records, args.clients, queue.put, done=queue.close)
+    behind.update(
+        stored=len(behind_client.rows.get(Config.TABLE_NAME, [])),
+        round_trips=behind_client.requests,
+        **{k: v for k, v in queue.stats().items() if k != "pending"},
+    )
+
+    for name, result in (("sync", sync), ("write-behind", behind)):
+        print(
+            f"{name:<13} caller p50={result['caller_ms_p50']:8.3f}ms "
+            f"p99={result['caller_ms_p99']:8.3f}ms "
+            f"{result['records_per_sec']:9.1f} records/s "
+            f"round trips={result['round_trips']:<6} "
+            f"stored={result['stored']}/{len(records)}"
+        )
+    print(
+        f"write-behind: {behind['flushes']} flushes, {behind['dropped']} dropped, "
+        f"{behind['rejected']} rejected"
+    )
+
+
+if __name__ == "__main__":
+    main()
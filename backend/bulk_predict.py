@@ -0,0 +1,208 @@
+"""
+Score a directory tree of images offline, without Flask or Supabase.
+
+Usage (from the backend directory):
+
+    python bulk_predict.py IMAGES_DIR OUTPUT [--model cnn] [--workers 4]
+
+OUTPUT is written as CSV or JSONL depending on its extension. Rerunning the
+same command after an interruption skips the images that already have a
+result in OUTPUT and appends the rest.
+"""
+
+import io
+import os
+import csv
+import sys
+import json
+import time
+import argparse
+import multiprocessing
+
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from utils.validation import allowed_file
+from ml.ml_config import MLConfig
+
+FIELDS = ["path", "label", "confidence", "error"]
+
+# Each worker process owns one predictor, created by _init_worker.
+_predictor = None
+
+
+def _init_worker(model_path):
+    global _predictor
+    from ml.inference.predictor import Predictor
+
+    _predictor = Predictor(model_path)
+    if not _predictor.pool:
+        raise RuntimeError(f"Could not load model {model_path}")
+
+
+def _predict_chunk(root, paths):
+    results = _predictor.predict_batch([os.path.join(root, p) for p in paths])
+    return [
+        (
+            {"path": path, "label": top[0]["label"], "confidence": top[0]["confidence"]}
+            if top
+            else {"path": path, "error": "Could not decode image"}
+        )
+        for path, top in zip(paths, results)
+    ]
+
+
+def find_images(root):
+    """List the images under `root` as sorted paths relative to it."""
+    images = []
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            if allowed_file(filename):
+                images.append(os.path.relpath(os.path.join(dirpath, filename), root))
+    return sorted(images)
+
+
+def read_done(output_path, output_format):
+    """
+    Return the paths that already have a result in the output file. A last
+    line cut short by an interruption is left out, so its image is scored
+    again.
+    """
+    if not os.path.exists(output_path):
+        return set()
+
+    with open(output_path, newline="") as f:
+        text = f.read()
+    complete = io.StringIO(text[: text.rfind("\n") + 1], newline="")
+
+    if output_format == "csv":
+        return {
+            row["path"]
+            for row in csv.DictReader(complete)
+            if row["label"] or row["error"]
+        }
+
+    done = set()
+    for line in complete:
+        try:
+            done.add(json.loads(line)["path"])
+        except (ValueError, KeyError):
+            continue
+    return done
+
+
+def drop_partial_line(output_path):
+    """Cut off a last line that an interruption left without its newline."""
+    with open(output_path, "rb+") as f:
+        data = f.read()
+        if data and not data.endswith(b"\n"):
+            f.truncate(data.rfind(b"\n") + 1)
+
+
+class ResultWriter:
+    def __init__(self, output_path, output_format):
+        # Results are appended on a line of their own, see `read_done`
+        if os.path.exists(output_path):
+            drop_partial_line(output_path)
+        exists = os.path.exists(output_path) and os.path.getsize(output_path) > 0
+        self.file = open(output_path, "a", newline="")
+        self.format = output_format
+        if output_format == "csv":
+            self.csv = csv.DictWriter(self.file, FIELDS)
+            if not exists:
+                self.csv.writeheader()
+
+    def write(self, results):
+        for result in results:
+            if self.format == "csv":
+                self.csv.writerow(result)
+            else:
+                self.file.write(json.dumps(result) + "\n")
+        # Flush every chunk so an interruption loses at most the chunks
+        # still in flight.
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("images_dir", help="Directory searched recursively")
+    parser.add_argument("output", help="Results file, .csv or .jsonl")
+    parser.add_argument(
+        "--model",
+        default=MLConfig.DEFAULT_MODEL_ID,
+        help="Model id from MLConfig.MODELS or a path to a .tflite file",
+    )
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=MLConfig.BATCH_MAX_SIZE,
+        help="Images per task, run through the model as one batch",
+    )
+    args = parser.parse_args()
+
+    model_path = MLConfig.MODELS.get(args.model, args.model)
+    output_format = "csv" if args.output.endswith(".csv") else "jsonl"
+
+    images = find_images(args.images_dir)
+    done = read_done(args.output, output_format)
+    todo = [path for path in images if path not in done]
+    print(f"{len(images)} images found, {len(images) - len(todo)} already scored")
+    if not todo:
+        return
+
+    chunks = [
+        todo[i : i + args.chunk_size] for i in range(0, len(todo), args.chunk_size)
+    ]
+    writer = ResultWriter(args.output, output_format)
+
+    # TensorFlow is not fork-safe, so workers start from a fresh interpreter.
+    context = multiprocessing.get_context("spawn")
+    start = time.perf_counter()
+    scored = 0
+    try:
+        with ProcessPoolExecutor(
+            args.workers,
+            mp_context=context,
+            initializer=_init_worker,
+            initargs=(model_path,),
+        ) as executor:
+            # Keep a bounded number of chunks in flight so results stream
+            # out in steady increments instead of piling up in memory.
+            pending = set()
+            next_chunk = 0
+            while pending or next_chunk < len(chunks):
+                while next_chunk < len(chunks) and len(pending) < 2 * args.workers:
+                    pending.add(
+                        executor.submit(
+                            _predict_chunk, args.images_dir, chunks[next_chunk]
+                        )
+                    )
+                    next_chunk += 1
+
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    results = future.result()
+                    writer.write(results)
+                    scored += len(results)
+
+                elapsed = time.perf_counter() - start
+                print(
+                    f"\r{scored}/{len(todo)} images, {scored / elapsed:.1f} images/sec",
+                    end="",
+                    file=sys.stderr,
+                )
+    finally:
+        writer.close()
+
+    elapsed = time.perf_counter() - start
+    print(
+        f"\nScored {scored} images in {elapsed:.1f}s "
+        f"({scored / elapsed:.1f} images/sec) -> {args.output}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+"""
+Inference components of a server process, shared by the Flask app (app.py)
+and the ASGI app (asgi.py): the models with their prediction cache and the
+near-duplicate and embedding indexes. They are created, and the default
+model loaded, on import; storage clients, queues and thread pools belong
+to each app.
+"""
+
+import os
+import glob
+import time
+import atexit
+import logging
+import threading
+
+from PIL import Image
+
+from config import Config
+from utils.metrics import CallbackMetric
+from ml.ml_config import MLConfig
+from ml.inference.predictor import Predictor
+from ml.inference.cache import PredictionCache
+from ml.inference.embeddings import EmbeddingIndex
+from ml.inference.near_duplicates import NearDuplicateIndex
+from ml.registry import ModelRegistry
+
+# Disable GPU
+os.environ["CUDA_VISIBLE_DEVICES"] = "-1"
+
+# Setup logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Let PIL itself refuse to decode images past the configured pixel limit
+Image.MAX_IMAGE_PIXELS = Config.MAX_IMAGE_PIXELS
+
+# Prediction cache shared by all models (keys include the model identity)
+prediction_cache = None
+if MLConfig.PREDICTION_CACHE_ENABLED:
+    prediction_cache = PredictionCache(
+        max_entries=MLConfig.PREDICTION_CACHE_SIZE,
+        ttl_seconds=MLConfig.PREDICTION_CACHE_TTL_S,
+        disk_path=MLConfig.PREDICTION_CACHE_PATH,
+        disk_max_entries=MLConfig.PREDICTION_CACHE_DISK_SIZE,
+    )
+
+
+def worker_index_path(path, slot):
+    """File a server worker saves an index to, see `use_worker_index_files`."""
+    root, ext = os.path.splitext(path)
+    return f"{root}.worker{slot}{ext}"
+
+
+def worker_index_files(path):
+    """The files the server workers saved an index to."""
+    root, ext = os.path.splitext(path)
+    return sorted(
+        p
+        for p in glob.glob(worker_index_path(path, "*"))
+        if not p.endswith(".tmp" + ext)
+    )
+
+
+def load_worker_index_files(index):
+    """Add the entries that the workers of an earlier server saved."""
+    if index.path:
+        for path in worker_index_files(index.path):
+            index.load(path)
+
+
+# Perceptual hashes of earlier uploads, shared by all models (entries are
+# tagged with the model identity) and saved on shutdown
+near_duplicates = None
+if MLConfig.NEAR_DUPLICATE_ENABLED:
+    near_duplicates = NearDuplicateIndex(
+        max_entries=MLConfig.NEAR_DUPLICATE_INDEX_SIZE,
+        max_distance=MLConfig.NEAR_DUPLICATE_MAX_DISTANCE,
+        path=MLConfig.NEAR_DUPLICATE_INDEX_PATH,
+    )
+    load_worker_index_files(near_duplicates)
+    atexit.register(near_duplicates.save)
+
+# Embeddings of uploads for /api/similar, for models that output them
+embeddings = None
+if MLConfig.EMBEDDINGS_ENABLED:
+    embeddings = EmbeddingIndex(
+        max_entries=MLConfig.EMBEDDING_INDEX_SIZE,
+        ivf_threshold=MLConfig.EMBEDDING_IVF_THRESHOLD,
+        nprobe=MLConfig.EMBEDDING_IVF_NPROBE,
+        path=MLConfig.EMBEDDING_INDEX_PATH,
+    )
+    load_worker_index_files(embeddings)
+    atexit.register(embeddings.save)
+
+
+def create_predictor(model_path):
+    """Load a model with the configured pool, batching and cache."""
+    predictor = Predictor(
+        model_path,
+        pool_size=MLConfig.INTERPRETER_POOL_SIZE,
+        pool_timeout=MLConfig.INTERPRETER_POOL_TIMEOUT_S,
+        num_threads=MLConfig.INTERPRETER_THREADS,
+    )
+    if not predictor.pool:
+        return predictor
+    if MLConfig.WARMUP_ENABLED:
+        predictor.warmup()
+    if MLConfig.BATCHING_ENABLED:
+        predictor.enable_batching(MLConfig.BATCH_MAX_SIZE, MLConfig.BATCH_MAX_WAIT_MS)
+    if prediction_cache:
+        predictor.enable_cache(prediction_cache)
+    if near_duplicates:
+        predictor.enable_near_duplicates(near_duplicates)
+    return predictor
+
+
+# Initialize the models, loading the default one right away
+models = ModelRegistry(
+    MLConfig.MODELS, create_predictor, MLConfig.MODEL_MEMORY_LIMIT_MB * 1024 * 1024
+)
+if MLConfig.DEFAULT_MODEL_ID not in models:
+    logger.error(
+        f"Default model '{MLConfig.DEFAULT_MODEL_ID}' is not deployed: "
+        f"{MLConfig.MODELS.get(MLConfig.DEFAULT_MODEL_ID)}"
+    )
+else:
+    try:
+        models.get(MLConfig.DEFAULT_MODEL_ID)
+    except ValueError as e:
+        logger.error(f"Failed to load the default model: {e}")
+
+
+def after_fork():
+    """
+    Re-create the thread-bound state of the components in a worker forked
+    from a server that loaded the app first, see `init_worker` in app.py.
+    """
+    if prediction_cache:
+        prediction_cache.after_fork()
+    models.after_fork()
+
+
+def use_worker_index_files(slot):
+    """
+    Save the indexes of a server worker on exit to files of its own, named
+    after its `slot` among the workers, instead of the file that every
+    worker would overwrite. All of them are loaded on the next start, and
+    every INDEX_SYNC_S by the running workers, see `sync_worker_indexes`.
+    """
+    shared = []
+    for index in (near_duplicates, embeddings):
+        if index and index.path:
+            shared.append((index, index.path))
+            index.path = worker_index_path(index.path, slot)
+
+    if shared and MLConfig.INDEX_SYNC_S > 0:
+        threading.Thread(
+            target=sync_worker_indexes,
+            args=(shared, MLConfig.INDEX_SYNC_S),
+            name="index-sync",
+            daemon=True,
+        ).start()
+
+
+def sync_worker_indexes(shared, interval):
+    """
+    Save the (index, path) indexes of this worker every `interval` seconds
+    and add what the other workers saved since, so that every worker finds
+    the uploads of all of them, at most two intervals late.
+    """
+    loaded = {}
+    while True:
+        time.sleep(interval)
+        for index, path in shared:
+            try:
+                index.save()
+                for worker_path in worker_index_files(path):
+                    modified = os.path.getmtime(worker_path)
+                    if (
+                        worker_path != index.path
+                        and loaded.get(worker_path) != modified
+                    ):
+                        index.load(worker_path)
+                        loaded[worker_path] = modified
+            except Exception as e:
+                logger.error(f"Could not sync the index {path}: {e}")
+
+
+def skip_exit_saves():
+    """
+    Keep the master of a preloaded server from saving the indexes on exit.
+    It never serves requests, so its copies only hold what was loaded at
+    startup and would overwrite what the workers saved.
+    """
+    for index in (near_duplicates, embeddings):
+        if index:
+            atexit.unregister(index.save)
+
+
+def stats():
+    """
+    The counters of the inference components: resident models with the
+    batch sizes formed by their micro-batchers, hits and misses of the
+    prediction cache and near-duplicate index, and the searches of the
+    embedding index.
+    """
+    return {
+        "models": models.stats(),
+        "cache": prediction_cache.stats() if prediction_cache else None,
+        "near_duplicates": near_duplicates.stats() if near_duplicates else None,
+        "embeddings": embeddings.stats() if embeddings else None,
+    }
+
+
+# Counters kept by the inference components, read when /metrics is scraped
+CallbackMetric(
+    "prediction_cache_lookups_total",
+    "Prediction cache lookups, by result.",
+    ["result"],
+    lambda: (
+        {
+            ("hit",): prediction_cache.stats()["hits"],
+            ("miss",): prediction_cache.stats()["misses"],
+        }
+        if prediction_cache
+        else {}
+    ),
+    type="counter",
+)
+CallbackMetric(
+    "inference_batches_total",
+    "Micro-batches run by resident models, by batch size.",
+    ["model_id", "batch_size"],
+    lambda: {
+        (model_id, size): count
+        for model_id, model in models.stats()["resident"].items()
+        if model["batching"]
+        for size, count in model["batching"]["batch_sizes"].items()
+    },
+    type="counter",
+)
+CallbackMetric(
+    "near_duplicate_lookups_total",
+    "Near-duplicate index lookups, by result.",
+    ["result"],
+    lambda: (
+        {
+            ("hit",): near_duplicates.stats()["hits"],
+            ("miss",): near_duplicates.stats()["misses"],
+        }
+        if near_duplicates
+        else {}
+    ),
+    type="counter",
+)
+CallbackMetric(
+    "embedding_searches_total",
+    "Similar-image searches of the embedding index, by method.",
+    ["method"],
+    lambda: (
+        {
+            ("exhaustive",): embeddings.stats()["searches"]
+            - embeddings.stats()["ivf_searches"],
+            ("ivf",): embeddings.stats()["ivf_searches"],
+        }
+        if embeddings
+        else {}
+    ),
+    type="counter",
+)
@@ -10,7 +10,62 @@ class Config:
     SUPABASE_URL = os.getenv("SUPABASE_URL")
     SUPABASE_KEY = os.getenv("SUPABASE_KEY")
     BUCKET_NAME = "images"
+    # Name stored images after the hash of their content, so that repeated
+    # uploads of the same image share one object
+    CONTENT_ADDRESSED_STORAGE = (
+        os.getenv("CONTENT_ADDRESSED_STORAGE", "false").lower() == "true"
+    )
     TABLE_NAME = "predictions"
+    # Limits checked from the image header before anything is stored or
+    # decoded, and on the whole request body
+    MAX_UPLOAD_BYTES = int(float(os.getenv("MAX_UPLOAD_MB", "20")) * 1024 * 1024)
+    MAX_IMAGE_PIXELS = int(float(os.getenv("MAX_IMAGE_MEGAPIXELS", "50")) * 10**6)
+    MAX_REQUEST_BYTES = int(float(os.getenv("MAX_REQUEST_MB", "200")) * 1024 * 1024)
+    # Upper bound on images accepted by one /api/predict/batch request
+    MAX_BATCH_IMAGES = int(os.getenv("MAX_BATCH_IMAGES", "200"))
+    # Rows per /api/history page, by default and at most
+    HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "20"))
+    HISTORY_MAX_PAGE_SIZE = int(os.getenv("HISTORY_MAX_PAGE_SIZE", "100"))
+    # Cache of recent history pages per user: 'local' (per worker), 'redis'
+    # (shared by all workers, needs redis-py and HISTORY_CACHE_URL) or 'none'.
+    # gunicorn.conf.py defaults to 'none' when running several workers.
+    HISTORY_CACHE_BACKEND = os.getenv("HISTORY_CACHE_BACKEND", "local")
+    HISTORY_CACHE_URL = os.getenv("HISTORY_CACHE_URL", "redis://localhost:6379/0")
+    HISTORY_CACHE_MAX_USERS = int(os.getenv("HISTORY_CACHE_MAX_USERS", "1000"))
+    HISTORY_CACHE_TTL_S = float(os.getenv("HISTORY_CACHE_TTL_S", "300"))
+    # Uploads returned by /api/similar, by default and at most
+    SIMILAR_RESULTS = int(os.getenv("SIMILAR_RESULTS", "10"))
+    SIMILAR_MAX_RESULTS = int(os.getenv("SIMILAR_MAX_RESULTS", "50"))
+    # Upper bound on ids accepted by one bulk history delete
+    MAX_BULK_DELETE = int(os.getenv("MAX_BULK_DELETE", "500"))
+    # Thumbnails generated in the background and stored next to each image,
+    # by their longest side in pixels (a size of 0 skips that thumbnail)
+    THUMBNAIL_ENABLED = os.getenv("THUMBNAIL_ENABLED", "true").lower() == "true"
+    THUMBNAIL_SIZE = int(os.getenv("THUMBNAIL_SIZE", "160"))
+    PREVIEW_SIZE = int(os.getenv("PREVIEW_SIZE", "640"))
+    THUMBNAIL_WORKERS = int(os.getenv("THUMBNAIL_WORKERS", "2"))
+    THUMBNAIL_MAX_PENDING = int(os.getenv("THUMBNAIL_MAX_PENDING", "256"))
+    # Threads for overlapping storage round trips
+    IO_WORKERS = int(os.getenv("IO_WORKERS", "8"))
+    # ASGI mode (asgi.py): threads for decoding and inference, unset sizes
+    # them to keep every pooled interpreter's micro-batches full, and the
+    # predictions that may wait for them before requests get a 503
+    ASYNC_CPU_WORKERS = int(os.getenv("ASYNC_CPU_WORKERS", "0"))
+    ASYNC_MAX_PENDING_CPU = int(os.getenv("ASYNC_MAX_PENDING_CPU", "256"))
+    # Prediction rows are queued and inserted in bulk by a background thread,
+    # every WRITE_BEHIND_FLUSH_MS or every WRITE_BEHIND_MAX_ROWS rows
+    WRITE_BEHIND_ENABLED = os.getenv("WRITE_BEHIND_ENABLED", "true").lower() == "true"
+    WRITE_BEHIND_MAX_ROWS = int(os.getenv("WRITE_BEHIND_MAX_ROWS", "50"))
+    WRITE_BEHIND_FLUSH_MS = float(os.getenv("WRITE_BEHIND_FLUSH_MS", "200"))
+    WRITE_BEHIND_MAX_PENDING = int(os.getenv("WRITE_BEHIND_MAX_PENDING", "10000"))
+    WRITE_BEHIND_MAX_RETRIES = int(os.getenv("WRITE_BEHIND_MAX_RETRIES", "3"))
+    WRITE_BEHIND_RETRY_BACKOFF_MS = float(
+        os.getenv("WRITE_BEHIND_RETRY_BACKOFF_MS", "100")
+    )
+    # With content-addressed storage, the files of deleted predictions are
+    # removed this long after the delete, once new predictions of the same
+    # image queued by any worker are written (0 removes them right away)
+    FILE_REMOVAL_DELAY_S = float(os.getenv("FILE_REMOVAL_DELAY_S", "60"))
     ALLOWED_ORIGINS = [
         "http://localhost:5173",
         "https://resonant-chaja-d637bc.netlify.app",
@@ -0,0 +1,177 @@
+"""
+Production server settings for the Flask app. gunicorn reads this file
+when started from the backend directory:
+
+    gunicorn app:app
+
+The app is loaded once in the master before the workers are forked
+(preload_app), so the imported libraries, the interpreters and the indexes
+are shared copy-on-write instead of being loaded again by every worker.
+Each worker then re-creates its connections and background threads, see
+`init_worker` in app.py, and saves the indexes to files of its own.
+
+State that is not shared by the workers: each writes its metrics to a
+directory that /metrics sums, and its indexes to files that the others
+load every INDEX_SYNC_S, so similar-image search and near-duplicate reuse
+see the uploads of other workers up to that late. /api/stats reports the
+worker that answers it. The history cache is only kept with a shared
+(redis) backend.
+
+Workers and threads are sized from the CPUs available to the server and
+the measured cost of a prediction, unless set with GUNICORN_WORKERS and
+GUNICORN_THREADS. benchmarks/prefork_benchmark.py compares the memory and
+throughput with and without preloading.
+"""
+
+import io
+import gc
+import os
+import math
+import time
+import shutil
+import tempfile
+import itertools
+
+
+def available_cores():
+    """CPUs the server may run on, within the container's CPU quota if any."""
+    try:
+        cores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cores = os.cpu_count() or 1
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            cores = min(cores, max(1, math.ceil(int(quota) / int(period))))
+    except (OSError, ValueError):
+        pass
+    return cores
+
+
+_cores = available_cores()
+
+bind = os.getenv("GUNICORN_BIND", f"0.0.0.0:{os.getenv('PORT', '5000')}")
+preload_app = os.getenv("GUNICORN_PRELOAD", "true").lower() == "true"
+worker_class = "gthread"
+
+# One worker per core, as decoding and inference are CPU bound and the
+# threads of one worker share its GIL
+workers = int(os.getenv("GUNICORN_WORKERS", "0")) or _cores
+# Threads per worker, measured once the app is loaded when unset (with
+# preload_app only, 4 otherwise)
+_auto_threads = not int(os.getenv("GUNICORN_THREADS", "0"))
+threads = int(os.getenv("GUNICORN_THREADS", "0")) or 4
+# Milliseconds a request waits on Supabase, which the threads of a worker
+# overlap with the predictions of other requests, and the most threads
+_io_wait_ms = float(os.getenv("GUNICORN_IO_WAIT_MS", "100"))
+_max_threads = int(os.getenv("GUNICORN_MAX_THREADS", "32"))
+
+# The interpreters of all workers split the cores between them. Set before
+# the app reads MLConfig.
+os.environ.setdefault("INTERPRETER_THREADS", str(max(1, _cores // workers)))
+
+# A local history cache is only updated by the worker that handled the
+# insert or delete, the others would serve stale pages until the TTL ends
+if workers > 1:
+    _history_cache = os.environ.setdefault("HISTORY_CACHE_BACKEND", "none")
+    if _history_cache == "local":
+        raise RuntimeError(
+            "HISTORY_CACHE_BACKEND=local cannot be used with several workers, "
+            "use 'redis' or 'none'"
+        )
+
+# Files the workers share for the life of the server: their metrics, and
+# their indexes unless saved elsewhere
+_run_dir = os.path.join(tempfile.gettempdir(), f"gunicorn-{os.getpid()}")
+_metrics_dir = os.getenv("METRICS_DIR") or os.path.join(_run_dir, "metrics")
+_metrics_interval = float(os.getenv("METRICS_WRITE_INTERVAL_S", "5"))
+if workers > 1:
+    for _name, _file in (
+        ("NEAR_DUPLICATE_INDEX_PATH", "near_duplicates.npz"),
+        ("EMBEDDING_INDEX_PATH", "embeddings.npz"),
+    ):
+        if not os.getenv(_name):
+            os.environ[_name] = os.path.join(_run_dir, _file)
+
+
+def prediction_ms(predictor, runs=5):
+    """
+    Median time to decode and predict a photo-sized JPEG, unbatched and
+    uncached, in milliseconds.
+    """
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.linear_gradient("L").resize((1280, 960)).convert("RGB").save(buffer, "JPEG")
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        predictor.run_file(io.BytesIO(buffer.getvalue()))
+        timings.append(time.perf_counter() - start)
+    return sorted(timings)[len(timings) // 2] * 1000
+
+
+def when_ready(server):
+    if not server.cfg.preload_app:
+        return
+
+    from components import models
+    from utils.metrics import REGISTRY
+    from ml.ml_config import MLConfig
+
+    if _auto_threads:
+        # Enough threads that one keeps the core busy predicting while the
+        # others wait on Supabase
+        try:
+            cost_ms = prediction_ms(models.get(MLConfig.DEFAULT_MODEL_ID))
+            count = min(_max_threads, max(2, math.ceil(1 + _io_wait_ms / cost_ms)))
+            server.cfg.set("threads", count)
+            server.log.info(f"Predictions take {cost_ms:.1f} ms")
+        except Exception as e:
+            server.log.warning(f"Could not measure predictions: {e}")
+    server.log.info(
+        f"{server.num_workers} workers of {server.cfg.threads} threads "
+        f"on {_cores} cores"
+    )
+
+    # The model loads and measurements of the master count once, the
+    # workers start from zero. Written once, as the master serves nothing.
+    REGISTRY.share(_metrics_dir, interval=None)
+
+    # Leave everything loaded so far out of garbage collection, so that
+    # collections in the workers do not write to the pages they share with
+    # the master
+    gc.collect()
+    gc.freeze()
+
+
+def pre_fork(server, worker):
+    # The lowest slot no live worker holds, so that a replaced worker takes
+    # over the index files of the one it replaces
+    taken = {getattr(w, "slot", None) for w in server.WORKERS.values()}
+    worker.slot = next(slot for slot in itertools.count() if slot not in taken)
+
+
+def post_fork(server, worker):
+    from utils.metrics import REGISTRY
+
+    REGISTRY.reset()
+    REGISTRY.share(_metrics_dir, _metrics_interval)
+
+    # Without preload_app this loads the app in the worker, as it would be
+    # right after
+    from app import init_worker
+    from components import use_worker_index_files
+
+    if server.cfg.preload_app:
+        init_worker()
+    use_worker_index_files(worker.slot)
+
+
+def on_exit(server):
+    if server.cfg.preload_app:
+        from components import skip_exit_saves
+
+        skip_exit_saves()
+    shutil.rmtree(_run_dir, ignore_errors=True)
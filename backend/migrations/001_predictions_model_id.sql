@@ -0,0 +1,5 @@
+-- Model that made each prediction, written with every new row since
+-- /api/predict accepts a model_id. Earlier rows were all made by the
+-- default model. Run once in the Supabase SQL editor before deploying.
+alter table predictions
+    add column if not exists model_id text not null default 'cnn';
@@ -0,0 +1,122 @@
+import queue
+import logging
+import threading
+import time
+
+from collections import Counter
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class MicroBatcher:
+    """
+    Collect single-image requests that arrive within a short window and run
+    them through the model as one batch.
+
+    `run_fn` takes a list of N images of shape (H, W, 3) and returns one row
+    of outputs per image. Each caller blocks in `submit` until its own row is
+    ready. With several `workers`, batches are formed and run concurrently,
+    which only helps when `run_fn` can itself run in parallel (for example
+    on top of an interpreter pool).
+    """
+
+    def __init__(self, run_fn, max_batch_size=8, max_wait_ms=5.0, workers=1):
+        self.run_fn = run_fn
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._batch_sizes = Counter()
+        self._closed = False
+        self._start(max(1, int(workers)))
+
+    def submit(self, image):
+        """Queue one preprocessed image (H, W, 3) and wait for its output row."""
+        future = Future()
+        with self._lock:
+            # Once closed, nobody is left to serve the queue.
+            if self._closed:
+                return self.run_fn([image])[0]
+            self._queue.put((image, future))
+        return future.result()
+
+    def stats(self):
+        """Return how many batches of each size have been run so far."""
+        with self._lock:
+            return {
+                "batches": sum(self._batch_sizes.values()),
+                "images": sum(size * n for size, n in self._batch_sizes.items()),
+                "batch_sizes": dict(sorted(self._batch_sizes.items())),
+            }
+
+    def close(self):
+        """Stop the workers after the already queued requests are served."""
+        with self._lock:
+            self._closed = True
+            for _ in self._workers:
+                self._queue.put(_STOP)
+        for worker in self._workers:
+            worker.join()
+
+    def after_fork(self):
+        """
+        Restart the workers in a forked child process, which inherits the
+        batcher but none of its threads.
+        """
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._batch_sizes = Counter()
+        if not self._closed:
+            self._start(len(self._workers))
+
+    def _start(self, workers):
+        self._workers = [
+            threading.Thread(target=self._run, name=f"micro-batcher-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+
+            batch = [item]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            self._process(batch)
+
+    def _process(self, batch):
+        futures = [future for _, future in batch]
+        try:
+            outputs = self.run_fn([image for image, _ in batch])
+        except Exception as e:
+            logger.error(f"Batched inference failed: {e}")
+            for future in futures:
+                future.set_exception(e)
+            return
+
+        with self._lock:
+            self._batch_sizes[len(batch)] += 1
+
+        for future, output in zip(futures, outputs):
+            future.set_result(output)
@@ -0,0 +1,210 @@
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def model_fingerprint(model_path):
+    """
+    Identify the current contents of a model file by its path, size and
+    modification time, without reading the whole file.
+    """
+    stat = os.stat(model_path)
+    identity = f"{os.path.abspath(model_path)}:{stat.st_size}:{stat.st_mtime_ns}"
+    return hashlib.sha256(identity.encode()).hexdigest()[:16]
+
+
+class PredictionCache:
+    """
+    Cache of (label, confidence) results keyed by a hash of the uploaded
+    bytes and the fingerprint of the model that produced them.
+
+    Entries live in a bounded in-memory LRU and, when `disk_path` is set, in
+    a SQLite file that survives restarts and keeps the `disk_max_entries`
+    newest entries. When a model file changes on disk its old entries are
+    dropped from both tiers.
+
+    The file may be shared by the workers of a server. A failed query, such
+    as one that gave up on a lock, counts as a miss or leaves the entry in
+    memory only, rather than failing the prediction.
+    """
+
+    def __init__(
+        self, max_entries=1024, ttl_seconds=None, disk_path=None, disk_max_entries=None
+    ):
+        self.max_entries = max(1, int(max_entries))
+        self.ttl = ttl_seconds or None
+        self.disk_path = disk_path or None
+        self.disk_max_entries = max(1, int(disk_max_entries or 100000))
+
+        self._entries = OrderedDict()
+        self._fingerprints = {}
+        self._paths = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        self._db = None
+        if disk_path:
+            os.makedirs(os.path.dirname(os.path.abspath(disk_path)), exist_ok=True)
+            self._db = self._connect()
+            self._execute(
+                "CREATE TABLE IF NOT EXISTS predictions ("
+                "key TEXT PRIMARY KEY, model_path TEXT, model TEXT, "
+                "label TEXT, confidence REAL, expires_at REAL)"
+            )
+            self._execute(
+                "DELETE FROM predictions WHERE expires_at <= ?", (time.time(),)
+            )
+
+    def check_model(self, model_path):
+        """
+        Return the fingerprint of the model file, purging the entries of its
+        previous version if the file has changed since the last call.
+        """
+        fingerprint = model_fingerprint(model_path)
+        with self._lock:
+            previous = self._fingerprints.get(model_path)
+            if previous != fingerprint:
+                if previous:
+                    logger.info(f"Model {model_path} changed, invalidating its cache")
+                self._fingerprints[model_path] = fingerprint
+                self._paths[fingerprint] = model_path
+                self._purge_model(model_path, keep=fingerprint)
+        return fingerprint
+
+    @staticmethod
+    def make_key(data, fingerprint):
+        return f"{hashlib.sha256(data).hexdigest()}:{fingerprint}"
+
+    def get(self, key):
+        """Return the cached (label, confidence) for `key`, or None."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at is None or expires_at > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+
+            if self._db is not None:
+                try:
+                    row = self._db.execute(
+                        "SELECT label, confidence, expires_at FROM predictions "
+                        "WHERE key = ?",
+                        (key,),
+                    ).fetchone()
+                except sqlite3.Error as e:
+                    logger.warning(f"Prediction cache read failed: {e}")
+                    row = None
+                if row and (row[2] is None or row[2] > now):
+                    value = (row[0], row[1])
+                    self._remember(key, value, row[2])
+                    self.hits += 1
+                    return value
+
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        expires_at = time.time() + self.ttl if self.ttl else None
+        fingerprint = key.rsplit(":", 1)[1]
+        with self._lock:
+            self._remember(key, value, expires_at)
+            if self._db is None:
+                return
+            inserted = self._execute(
+                "INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    key,
+                    self._paths.get(fingerprint),
+                    fingerprint,
+                    value[0],
+                    value[1],
+                    expires_at,
+                ),
+            )
+            # Rows get increasing rowids, a replaced one a new one, so the
+            # rows past the newest `disk_max_entries` are the least recently
+            # stored, expired ones included
+            if inserted is not None and inserted.lastrowid > self.disk_max_entries:
+                self._execute(
+                    "DELETE FROM predictions WHERE rowid <= ?",
+                    (inserted.lastrowid - self.disk_max_entries,),
+                )
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            if self._db is not None:
+                self._execute("DELETE FROM predictions")
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+    def after_fork(self):
+        """
+        Open a connection of its own in a forked child process, as SQLite
+        connections must not be used across a fork.
+        """
+        self._lock = threading.Lock()
+        if self._db is not None:
+            self._db = self._connect()
+
+    def _remember(self, key, value, expires_at):
+        self._entries[key] = (value, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _purge_model(self, model_path, keep):
+        """Drop the entries of every version of `model_path` except `keep`."""
+        stale = {
+            fingerprint
+            for fingerprint, path in self._paths.items()
+            if path == model_path and fingerprint != keep
+        }
+        for key in [k for k in self._entries if k.rsplit(":", 1)[1] in stale]:
+            del self._entries[key]
+        for fingerprint in stale:
+            del self._paths[fingerprint]
+
+        if self._db is not None:
+            self._execute(
+                "DELETE FROM predictions WHERE model_path = ? AND model != ?",
+                (model_path, keep),
+            )
+
+    def _connect(self):
+        db = sqlite3.connect(self.disk_path, check_same_thread=False)
+        # Readers of other workers do not wait for a writer, nor block it
+        self._execute("PRAGMA journal_mode=WAL", db=db)
+        return db
+
+    def _execute(self, sql, parameters=(), db=None):
+        """
+        Run and commit a statement, returning its cursor, or None when it
+        failed.
+        """
+        db = db or self._db
+        try:
+            cursor = db.execute(sql, parameters)
+            db.commit()
+            return cursor
+        except sqlite3.Error as e:
+            logger.warning(f"Prediction cache write failed: {e}")
+            return None
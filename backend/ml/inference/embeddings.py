@@ -0,0 +1,265 @@
+import os
+import logging
+import threading
+
+import numpy as np
+
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def normalize(vectors):
+    """Scale vectors to unit length, so dot products are cosine similarities."""
+    vectors = np.asarray(vectors, np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def kmeans(vectors, k, iterations=10, seed=0):
+    """
+    Spherical k-means of unit vectors: return `k` unit centroids of shape
+    (k, dim). Clusters that end up empty keep their previous centroid.
+    """
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), k, replace=False)]
+    for _ in range(iterations):
+        assignment = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, vectors)
+        filled = np.bincount(assignment, minlength=k) > 0
+        centroids[filled] = normalize(sums[filled])
+    return centroids
+
+
+class _UserVectors:
+    """
+    Rows of one user's vectors, optionally partitioned into inverted lists
+    around k-means centroids.
+    """
+
+    def __init__(self):
+        self.rows = []
+        self.centroids = None
+        self.lists = None
+        self.trained_size = 0
+
+
+class _Space:
+    """
+    The vectors of one model, which are only comparable with each other,
+    as float16 rows of an array that doubles when full.
+    """
+
+    def __init__(self, dim):
+        self.vectors = np.zeros((64, dim), np.float16)
+        self.keys = []
+        self.free = []
+        self.rows = {}
+        self.users = {}
+
+    def allocate(self, key):
+        if self.free:
+            row = self.free.pop()
+            self.keys[row] = key
+            return row
+        row = len(self.keys)
+        if row == len(self.vectors):
+            grown = np.zeros((2 * row, self.vectors.shape[1]), np.float16)
+            grown[:row] = self.vectors
+            self.vectors = grown
+        self.keys.append(key)
+        return row
+
+
+class EmbeddingIndex:
+    """
+    Embeddings of users' uploads, searched by cosine similarity.
+
+    Vectors are normalized and kept as float16 rows of one array per model
+    fingerprint, as the embeddings of different models are not comparable.
+    A search computes the similarity of the query with all of the user's
+    vectors in one matrix product. Past `ivf_threshold` vectors, a user's
+    rows are partitioned into about sqrt(n) inverted lists around k-means
+    centroids, and a search only scans the `nprobe` lists closest to the
+    query (IVF). The centroids are trained when a user crosses the
+    threshold and again once their vectors have doubled; in between, new
+    vectors join the list of their nearest centroid, so queries never
+    rebuild the index. Uploads are evicted oldest first beyond
+    `max_entries`. With `path` set, the index is loaded from and saved to
+    that file.
+    """
+
+    def __init__(self, max_entries=100000, ivf_threshold=2048, nprobe=8, path=None):
+        self.max_entries = max(1, int(max_entries))
+        self.ivf_threshold = max(1, int(ivf_threshold))
+        self.nprobe = max(1, int(nprobe))
+        self.path = path or None
+
+        self._spaces = {}
+        self._order = OrderedDict()
+        self._lock = threading.Lock()
+        self._counts = {"searches": 0, "ivf_searches": 0, "trainings": 0}
+
+        if self.path and os.path.exists(self.path):
+            self.load()
+
+    def add(self, fingerprint, user_id, file_url, embedding):
+        """Remember the embedding of a user's upload, replacing an older one."""
+        vector = normalize(np.ravel(embedding))
+        with self._lock:
+            self._add(fingerprint, user_id, file_url, vector)
+
+    def remove(self, fingerprint, user_id, file_url):
+        with self._lock:
+            self._remove(fingerprint, user_id, file_url)
+
+    def search(self, fingerprint, user_id, file_url, k):
+        """
+        Return the (file_url, similarity) of the user's `k` uploads most
+        similar to the upload at `file_url`, best first, or None if that
+        upload has no embedding.
+        """
+        with self._lock:
+            space = self._spaces.get(fingerprint)
+            row = space.rows.get((user_id, file_url)) if space else None
+            if row is None:
+                return None
+
+            query = space.vectors[row].astype(np.float32)
+            user = space.users[user_id]
+            if user.centroids is None:
+                candidates = np.array(user.rows, np.intp)
+            else:
+                nearest = np.argsort(user.centroids @ query)[::-1][: self.nprobe]
+                candidates = np.array(
+                    [r for c in nearest for r in user.lists[c]], np.intp
+                )
+                self._counts["ivf_searches"] += 1
+            self._counts["searches"] += 1
+
+            candidates = candidates[candidates != row]
+            # float16 rounding can put a unit vector's similarity past 1
+            scores = np.clip(space.vectors[candidates] @ query, -1.0, 1.0)
+            k = min(int(k), len(candidates))
+            if k <= 0:
+                return []
+            best = np.argpartition(-scores, k - 1)[:k]
+            best = best[np.argsort(-scores[best])]
+            return [(space.keys[candidates[i]][1], float(scores[i])) for i in best]
+
+    def stats(self):
+        with self._lock:
+            users = [
+                user for space in self._spaces.values() for user in space.users.values()
+            ]
+            return {
+                "entries": len(self._order),
+                "users": len(users),
+                "ivf_users": sum(user.centroids is not None for user in users),
+                **self._counts,
+            }
+
+    def save(self):
+        """Write the entries to `path`, replacing the previous file at once."""
+        if not self.path:
+            return
+        with self._lock:
+            count = len(self._order)
+            arrays = {"fingerprints": np.array(list(self._spaces), str)}
+            for i, (fingerprint, space) in enumerate(self._spaces.items()):
+                rows = [
+                    space.rows[key[1:]] for key in self._order if key[0] == fingerprint
+                ]
+                arrays[f"vectors_{i}"] = space.vectors[rows]
+                arrays[f"users_{i}"] = np.array([space.keys[r][0] for r in rows], str)
+                arrays[f"urls_{i}"] = np.array([space.keys[r][1] for r in rows], str)
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp_path = self.path + ".tmp.npz"
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, self.path)
+        logger.info(f"Saved {count} embeddings to {self.path}")
+
+    def load(self, path=None):
+        """Add the entries saved to `path`, by default the index's own file."""
+        path = path or self.path
+        try:
+            with np.load(path) as data:
+                with self._lock:
+                    for i, fingerprint in enumerate(data["fingerprints"].tolist()):
+                        rows = zip(
+                            data[f"vectors_{i}"].astype(np.float32),
+                            data[f"users_{i}"].tolist(),
+                            data[f"urls_{i}"].tolist(),
+                        )
+                        for vector, user_id, file_url in rows:
+                            self._add(fingerprint, user_id, file_url, vector)
+            logger.info(f"Loaded {len(self._order)} embeddings from {path}")
+        except Exception as e:
+            logger.error(f"Could not load embedding index {path}: {e}")
+
+    def _add(self, fingerprint, user_id, file_url, vector):
+        space = self._spaces.get(fingerprint)
+        if space is None:
+            space = self._spaces[fingerprint] = _Space(len(vector))
+        if len(vector) != space.vectors.shape[1]:
+            raise ValueError(
+                f"Expected an embedding of size {space.vectors.shape[1]}, "
+                f"got {len(vector)}"
+            )
+
+        key = (user_id, file_url)
+        row = space.rows.get(key)
+        if row is None:
+            row = space.rows[key] = space.allocate(key)
+            user = space.users.setdefault(user_id, _UserVectors())
+            user.rows.append(row)
+            space.vectors[row] = vector
+            if user.centroids is not None:
+                nearest = int(np.argmax(user.centroids @ vector))
+                user.lists[nearest].append(row)
+            if len(user.rows) > max(self.ivf_threshold, 2 * user.trained_size):
+                self._train(space, user)
+        else:
+            # The stored vector keeps its inverted list, re-uploads of the
+            # same file have (nearly) the same embedding
+            space.vectors[row] = vector
+        self._order[(fingerprint, user_id, file_url)] = None
+        self._order.move_to_end((fingerprint, user_id, file_url))
+
+        while len(self._order) > self.max_entries:
+            evicted, _ = self._order.popitem(last=False)
+            self._remove(*evicted)
+
+    def _remove(self, fingerprint, user_id, file_url):
+        self._order.pop((fingerprint, user_id, file_url), None)
+        space = self._spaces.get(fingerprint)
+        row = space.rows.pop((user_id, file_url), None) if space else None
+        if row is None:
+            return
+
+        user = space.users[user_id]
+        user.rows.remove(row)
+        if user.lists is not None:
+            for rows in user.lists:
+                if row in rows:
+                    rows.remove(row)
+                    break
+        if not user.rows:
+            del space.users[user_id]
+        space.keys[row] = None
+        space.free.append(row)
+
+    def _train(self, space, user):
+        rows = np.array(user.rows, np.intp)
+        vectors = space.vectors[rows].astype(np.float32)
+        k = int(np.sqrt(len(rows)))
+        # A sample of the vectors is enough to place the centroids
+        sample = np.random.default_rng(0).permutation(len(rows))[: 32 * k]
+        user.centroids = kmeans(vectors[sample], k)
+
+        assignment = np.argmax(vectors @ user.centroids.T, axis=1)
+        user.lists = [rows[assignment == c].tolist() for c in range(k)]
+        user.trained_size = len(rows)
+        self._counts["trainings"] += 1
@@ -0,0 +1,171 @@
+import os
+import logging
+import threading
+
+import numpy as np
+
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Luma weights of ITU-R BT.601, as used by PIL's "L" conversion
+_LUMA = np.array([0.299, 0.587, 0.114], np.float32)
+
+# DCT-II basis for the 32 x 32 grid the hash is computed on
+_DCT = np.cos(np.pi * np.arange(32)[:, None] * (2 * np.arange(32) + 1) / 64)
+
+
+def phash(image, min_contrast=1e-3):
+    """
+    64-bit perceptual hash of a preprocessed (H, W, 3) image in [0, 1],
+    with H and W multiples of 32.
+
+    The grayscale image is averaged down to 32 x 32 and each bit tells
+    whether one of its 64 lowest-frequency DCT coefficients is above their
+    median, which survives re-encoding, rescaling and small crops. Returns
+    None for images too flat to hash reliably (such as a blank frame), where
+    every bit would be decided by noise.
+    """
+    gray = image @ _LUMA
+    height, width = gray.shape
+    grid = gray.reshape(32, height // 32, 32, width // 32).mean(axis=(1, 3))
+    coefficients = (_DCT @ grid @ _DCT.T)[:8, :8].ravel()
+    # The DC term only measures the overall brightness
+    ac = coefficients[1:]
+    if np.abs(ac).max() < min_contrast * grid.size:
+        return None
+
+    bits = coefficients > np.median(ac)
+    bits[0] = False
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+class NearDuplicateIndex:
+    """
+    Predictions of earlier uploads, found by the Hamming distance between
+    their perceptual hashes and the hash of a new upload.
+
+    Lookups use a multi-index hash table: the 64-bit hash is split into
+    `max_distance + 1` chunks, and since two hashes within `max_distance`
+    bits must agree exactly on at least one chunk, only the entries sharing
+    a chunk with the query are compared. Entries are tagged with the
+    fingerprint of the model that produced them and evicted least recently
+    used first beyond `max_entries`. With `path` set, the index is loaded
+    from and saved to that file.
+    """
+
+    def __init__(self, max_entries=10000, max_distance=4, path=None):
+        self.max_entries = max(1, int(max_entries))
+        self.max_distance = max(0, min(63, int(max_distance)))
+        self.path = path or None
+
+        chunks = self.max_distance + 1
+        bounds = [64 * i // chunks for i in range(chunks + 1)]
+        self._chunks = [
+            (64 - end, (1 << (end - start)) - 1)
+            for start, end in zip(bounds, bounds[1:])
+        ]
+        self._tables = [{} for _ in self._chunks]
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        if self.path and os.path.exists(self.path):
+            self.load()
+
+    def find(self, image_hash, fingerprint):
+        """
+        Return the (label, confidence) of the closest entry of the model
+        within `max_distance` bits of `image_hash`, or None.
+        """
+        with self._lock:
+            candidates = set()
+            for table, key in zip(self._tables, self._keys(image_hash)):
+                candidates.update(table.get(key, ()))
+
+            best, best_distance = None, self.max_distance + 1
+            for candidate in candidates:
+                if candidate[1] != fingerprint:
+                    continue
+                distance = bin(candidate[0] ^ image_hash).count("1")
+                if distance < best_distance:
+                    best, best_distance = candidate, distance
+
+            if best is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(best)
+            self.hits += 1
+            return self._entries[best]
+
+    def add(self, image_hash, fingerprint, value):
+        """Remember the (label, confidence) predicted for an image hash."""
+        with self._lock:
+            self._add(image_hash, fingerprint, tuple(value))
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+    def save(self):
+        """Write the entries to `path`, replacing the previous file at once."""
+        if not self.path:
+            return
+        with self._lock:
+            entries = list(self._entries.items())
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp_path = self.path + ".tmp.npz"
+        np.savez(
+            tmp_path,
+            hashes=np.array([key[0] for key, _ in entries], np.uint64),
+            fingerprints=np.array([key[1] for key, _ in entries], str),
+            labels=np.array([value[0] for _, value in entries], str),
+            confidences=np.array([value[1] for _, value in entries], np.float64),
+        )
+        os.replace(tmp_path, self.path)
+        logger.info(f"Saved {len(entries)} near-duplicate entries to {self.path}")
+
+    def load(self, path=None):
+        """Add the entries saved to `path`, by default the index's own file."""
+        path = path or self.path
+        try:
+            with np.load(path) as data:
+                rows = zip(
+                    data["hashes"].tolist(),
+                    data["fingerprints"].tolist(),
+                    data["labels"].tolist(),
+                    data["confidences"].tolist(),
+                )
+                with self._lock:
+                    for image_hash, fingerprint, label, confidence in rows:
+                        self._add(image_hash, fingerprint, (label, confidence))
+            logger.info(
+                f"Loaded {len(self._entries)} near-duplicate entries from {path}"
+            )
+        except Exception as e:
+            logger.error(f"Could not load near-duplicate index {path}: {e}")
+
+    def _keys(self, image_hash):
+        return [(image_hash >> shift) & mask for shift, mask in self._chunks]
+
+    def _add(self, image_hash, fingerprint, value):
+        key = (image_hash, fingerprint)
+        if key not in self._entries:
+            for table, chunk in zip(self._tables, self._keys(image_hash)):
+                table.setdefault(chunk, set()).add(key)
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_entries:
+            evicted, _ = self._entries.popitem(last=False)
+            for table, chunk in zip(self._tables, self._keys(evicted[0])):
+                bucket = table[chunk]
+                bucket.discard(evicted)
+                if not bucket:
+                    del table[chunk]
@@ -0,0 +1,91 @@
+import queue
+import threading
+
+from contextlib import contextmanager
+
+from ml.inference.runtime import get_interpreter_class
+
+
+class InterpreterPool:
+    """
+    A fixed set of pre-allocated TFLite interpreters for the same model.
+
+    A TFLite interpreter must not be used from more than one thread at a time,
+    so each inference checks one out, uses it exclusively and checks it back in.
+    """
+
+    def __init__(self, model_path, size=1, timeout=None, num_threads=None):
+        self.model_path = model_path
+        self.size = max(1, int(size))
+        self.timeout = timeout
+
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._in_use = 0
+
+        interpreter_class = get_interpreter_class()
+        for _ in range(self.size):
+            interpreter = interpreter_class(
+                model_path=model_path, num_threads=num_threads
+            )
+            interpreter.allocate_tensors()
+            self._idle.put(interpreter)
+
+        # All interpreters share the same graph, so the tensor layout of any
+        # of them describes the whole pool.
+        interpreter = self._idle.get()
+        self.input_details = interpreter.get_input_details()
+        self.output_details = interpreter.get_output_details()
+        self._idle.put(interpreter)
+
+    def checkout(self, timeout=None):
+        """
+        Take an idle interpreter, waiting up to `timeout` seconds (the pool
+        default when omitted) for one to be checked in.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        try:
+            interpreter = self._idle.get(timeout=timeout)
+        except queue.Empty:
+            raise TimeoutError(
+                f"No interpreter became available within {timeout} seconds"
+            )
+
+        with self._lock:
+            self._in_use += 1
+        return interpreter
+
+    def checkin(self, interpreter):
+        """Return an interpreter obtained from `checkout` to the pool."""
+        with self._lock:
+            self._in_use -= 1
+        self._idle.put(interpreter)
+
+    @contextmanager
+    def interpreter(self, timeout=None):
+        """Check an interpreter out for the duration of a `with` block."""
+        interpreter = self.checkout(timeout)
+        try:
+            yield interpreter
+        finally:
+            self.checkin(interpreter)
+
+    def checkout_all(self, timeout=None):
+        """
+        Check out every interpreter of the pool, e.g. to warm them up. When
+        one does not become available in time, those already taken are
+        checked back in before the TimeoutError is raised.
+        """
+        interpreters = []
+        try:
+            for _ in range(self.size):
+                interpreters.append(self.checkout(timeout))
+        except BaseException:
+            for interpreter in interpreters:
+                self.checkin(interpreter)
+            raise
+        return interpreters
+
+    def stats(self):
+        with self._lock:
+            return {"size": self.size, "in_use": self._in_use}
@@ -0,0 +1,57 @@
+import numpy as np
+
+
+def dequantize(output, quantization):
+    """
+    Convert the output of a quantized model back to float32 probabilities
+    using its (scale, zero_point). Float outputs are returned unchanged.
+    """
+    if output.dtype == np.float32:
+        return output
+    scale, zero_point = quantization
+    return (output.astype(np.float32) - zero_point) * np.float32(scale)
+
+
+class TopK:
+    """
+    Turn model outputs into the k most likely constellations.
+
+    The label lookups are built once, and each row only pays for an
+    `argpartition` plus a sort of its k best scores, not of every class.
+    """
+
+    def __init__(self, constellations):
+        self.labels = np.array([c[0] for c in constellations], dtype=object)
+        self.abbreviations = np.array([c[1] for c in constellations], dtype=object)
+        self.polish_names = np.array([c[2] for c in constellations], dtype=object)
+
+    def __call__(self, probabilities, k):
+        """
+        Return, for each row of `probabilities` (shape (N, num_classes) or
+        (num_classes,)), a list of the k best classes ordered by confidence.
+        """
+        probabilities = np.atleast_2d(probabilities)
+        k = max(1, min(int(k), probabilities.shape[1]))
+
+        indices = np.argpartition(probabilities, -k, axis=1)[:, -k:]
+        scores = np.take_along_axis(probabilities, indices, axis=1)
+        order = np.argsort(-scores, axis=1)
+        indices = np.take_along_axis(indices, order, axis=1)
+        scores = np.take_along_axis(scores, order, axis=1)
+
+        labels = self.labels[indices]
+        abbreviations = self.abbreviations[indices]
+        polish_names = self.polish_names[indices]
+
+        return [
+            [
+                {
+                    "label": labels[row, i],
+                    "abbreviation": abbreviations[row, i],
+                    "polish_name": polish_names[row, i],
+                    "confidence": float(scores[row, i]),
+                }
+                for i in range(k)
+            ]
+            for row in range(len(indices))
+        ]
@@ -1,38 +1,449 @@
-import tensorflow as tf
+import io
+
 import numpy as np
 
 from ml.ml_config import MLConfig
-from ml.inference.preprocess import preprocess_image
+from ml.inference.preprocess import (
+    preprocess_image,
+    preprocess_image_into,
+    quantize_into,
+    tile_image,
+)
+from ml.inference.batching import MicroBatcher
+from ml.inference.pool import InterpreterPool
+from ml.inference.cache import model_fingerprint
+from ml.inference.near_duplicates import phash
+from ml.inference.postprocess import TopK, dequantize
+from utils.metrics import STAGE_SECONDS
 
 
 class Predictor:
-    def __init__(self, model_path):
+    def __init__(self, model_path, pool_size=1, pool_timeout=None, num_threads=None):
+        self.model_path = model_path
+        self.pool = None
+        self.batcher = None
+        self.cache = None
+        self.near_duplicates = None
+        self.embedding_index = None
+        self.top_k = TopK(MLConfig.CONSTELLATIONS)
         try:
-            self.interpreter = tf.lite.Interpreter(model_path=model_path)
-            self.interpreter.allocate_tensors()
+            self.fingerprint = model_fingerprint(model_path)
+            self.pool = InterpreterPool(
+                model_path, pool_size, pool_timeout, num_threads
+            )
+            self.input_index = self.pool.input_details[0]["index"]
+            # Models converted with --embeddings also output the pooled
+            # backbone features next to the class probabilities.
+            outputs = sorted(
+                self.pool.output_details,
+                key=lambda details: details["shape"][-1] != len(MLConfig.CLASS_NAMES),
+            )
+            self.output_index = outputs[0]["index"]
+            self.embedding_index = outputs[1]["index"] if len(outputs) > 1 else None
+            self.embedding_size = (
+                int(outputs[1]["shape"][-1]) if len(outputs) > 1 else None
+            )
+            # Quantized models take and return integers, which are mapped
+            # to floats with these (scale, zero_point) pairs.
+            self.input_dtype = self.pool.input_details[0]["dtype"]
+            self.input_quantization = self.pool.input_details[0]["quantization"]
+            self.output_quantization = outputs[0]["quantization"]
+            self.embedding_quantization = (
+                outputs[1]["quantization"] if len(outputs) > 1 else None
+            )
             print("Model loaded successfully.")
         except Exception as e:
             print(f"Error loading model: {e}")
-            self.model = None
+            self.pool = None
+
+    @property
+    def has_embeddings(self):
+        """Whether the model outputs embeddings for similar-image search."""
+        return bool(self.pool) and self.embedding_index is not None
+
+    def enable_batching(self, max_batch_size, max_wait_ms):
+        """
+        Route single-image predictions through a micro-batching queue, with
+        one batching worker per pooled interpreter.
+        """
+        self.batcher = MicroBatcher(
+            self._run_rows, max_batch_size, max_wait_ms, workers=self.pool.size
+        )
+
+    def enable_cache(self, cache):
+        """
+        Serve repeated uploads of the same bytes from a PredictionCache.
+        """
+        self.cache = cache
+
+    def enable_near_duplicates(self, index):
+        """
+        Reuse the predictions of earlier uploads whose perceptual hash is
+        close to the new upload's, from a NearDuplicateIndex.
+        """
+        self.near_duplicates = index
+
+    def close(self):
+        """Stop the batching workers; later calls run unbatched."""
+        batcher, self.batcher = self.batcher, None
+        if batcher:
+            batcher.close()
+
+    def after_fork(self):
+        """Restart the batching workers in a forked child process."""
+        if self.batcher:
+            self.batcher.after_fork()
+
+    def warmup(self):
+        """
+        Invoke every pooled interpreter once on a synthetic input, so the
+        first real request does not pay for lazy kernel initialization.
+        """
+        if not self.pool:
+            return
+
+        interpreters = []
+        try:
+            interpreters = self.pool.checkout_all()
+            for interpreter in interpreters:
+                self._set_batch_size(interpreter, 1)
+                input_tensor = interpreter.tensor(self.input_index)()
+                input_tensor.fill(0)
+                del input_tensor
+                interpreter.invoke()
+        finally:
+            for interpreter in interpreters:
+                self.pool.checkin(interpreter)
+
+    def run(self, batch, embedding=False):
+        """
+        Run a pooled interpreter on a preprocessed batch, given either as an
+        array of shape (N, H, W, 3) or as a list of (H, W, 3) arrays, and
+        return the class probabilities of shape (N, num_classes), or the
+        (probabilities, embeddings) pair with `embedding`.
+        """
+        if not self.pool:
+            raise ValueError("Model is not loaded.")
+
+        with self.pool.interpreter() as interpreter:
+            self._set_batch_size(interpreter, len(batch))
+
+            # Copy each image straight into the input tensor instead of
+            # stacking the batch into another array first.
+            input_tensor = interpreter.tensor(self.input_index)()
+            for i, image in enumerate(batch):
+                if self.input_dtype == np.float32:
+                    input_tensor[i] = image
+                else:
+                    quantize_into(image, input_tensor[i], self.input_quantization)
+            del input_tensor
+
+            with STAGE_SECONDS.time(stage="invoke"):
+                interpreter.invoke()
+            probabilities = dequantize(
+                interpreter.get_tensor(self.output_index), self.output_quantization
+            )
+            if not embedding:
+                return probabilities
+            return probabilities, dequantize(
+                interpreter.get_tensor(self.embedding_index),
+                self.embedding_quantization,
+            )
+
+    def run_file(self, image, embedding=False):
+        """
+        Decode a single image file directly into a pooled interpreter's input
+        tensor and return its class probabilities of shape (num_classes,),
+        or the (probabilities, embedding) pair with `embedding`.
+        """
+        if not self.pool:
+            raise ValueError("Model is not loaded.")
+
+        with self.pool.interpreter() as interpreter:
+            self._set_batch_size(interpreter, 1)
+
+            # The view must be released before invoke, TFLite refuses to run
+            # while references to its internal buffers are alive.
+            input_tensor = interpreter.tensor(self.input_index)()
+            try:
+                with STAGE_SECONDS.time(stage="preprocess"):
+                    preprocess_image_into(
+                        image, input_tensor[0], self.input_quantization
+                    )
+            finally:
+                del input_tensor
+
+            with STAGE_SECONDS.time(stage="invoke"):
+                interpreter.invoke()
+            probabilities = dequantize(
+                interpreter.get_tensor(self.output_index)[0], self.output_quantization
+            )
+            if not embedding:
+                return probabilities
+            return probabilities, dequantize(
+                interpreter.get_tensor(self.embedding_index)[0],
+                self.embedding_quantization,
+            )
+
+    def _run_rows(self, batch):
+        # The batcher's rows carry the embeddings too when the model has
+        # them, so that requests with and without share the same batches
+        if not self.has_embeddings:
+            return self.run(batch)
+        return list(zip(*self.run(batch, embedding=True)))
+
+    def _set_batch_size(self, interpreter, batch_size):
+        # Resizing forces a tensor reallocation, so only do it when the
+        # batch size actually changes.
+        input_shape = interpreter.get_input_details()[0]["shape"]
+        if input_shape[0] != batch_size:
+            interpreter.resize_tensor_input(
+                self.input_index, [batch_size, *input_shape[1:]]
+            )
+            interpreter.allocate_tensors()
+
+    def predict(self, image, embedding=False):
+        """
+        Return the most likely constellation for an image and its
+        confidence, or with `embedding` the pair of that result and the
+        image's embedding. The embedding is None when the result is reused
+        from the cache or a near-duplicate; see `embed`.
+        """
+        if not self.pool:
+            raise ValueError("Model is not loaded.")
+        if embedding and not self.has_embeddings:
+            raise ValueError("Model does not output embeddings.")
+
+        if not self.cache and not self.near_duplicates:
+            return self._predict(image, embedding)
 
-    def predict(self, image):
-        if not self.interpreter:
+        data = image if isinstance(image, bytes) else _read_bytes(image)
+        # Results are only reused while the file on disk is still the model
+        # that this predictor has loaded.
+        if self.cache:
+            fingerprint = self.cache.check_model(self.model_path)
+        else:
+            fingerprint = model_fingerprint(self.model_path)
+        if fingerprint != self.fingerprint:
+            return self._predict(data, embedding)
+
+        if not self.cache:
+            return self._predict_near_duplicate(data, embedding)
+
+        key = self.cache.make_key(data, fingerprint)
+        result = self.cache.get(key)
+        if result is not None:
+            return (result, None) if embedding else result
+
+        if self.near_duplicates:
+            output = self._predict_near_duplicate(data, embedding)
+        else:
+            output = self._predict(data, embedding)
+        self.cache.put(key, output[0] if embedding else output)
+        return output
+
+    def predict_top_k(self, image, k, embedding=False):
+        """
+        Return the k most likely constellations for an image, best first,
+        each with its label, abbreviation, Polish name and confidence, or
+        with `embedding` the pair of those and the image's embedding.
+        """
+        if not self.pool:
             raise ValueError("Model is not loaded.")
+        if embedding and not self.has_embeddings:
+            raise ValueError("Model does not output embeddings.")
+
+        if not embedding:
+            return self.top_k(self._probabilities(image), k)[0]
+        probabilities, vector = self._probabilities(image, embedding=True)
+        return self.top_k(probabilities, k)[0], vector
+
+    def embed(self, image):
+        """
+        Return the embedding of an image: the pooled backbone features, for
+        uploads whose prediction was reused and so never computed one.
+        """
+        if not self.has_embeddings:
+            raise ValueError("Model does not output embeddings.")
+        return self._probabilities(image, embedding=True)[1]
+
+    def predict_batch(self, images, k=1):
+        """
+        Predict a list of images with batched invokes of up to
+        BATCH_MAX_SIZE images, bypassing the micro-batching queue.
 
-        processed_image = preprocess_image(image)
+        Returns, per image, its k most likely constellations as in
+        `predict_top_k`, or None if the image could not be decoded.
+        """
+        return self._predict_batch(images, k, embedding=False)[0]
 
-        input_details = self.interpreter.get_input_details()
-        output_details = self.interpreter.get_output_details()
+    def predict_batch_with_embeddings(self, images, k=1):
+        """
+        Predict a list of images as in `predict_batch`, and also return the
+        embedding of each image (None where it could not be decoded).
+        """
+        if not self.has_embeddings:
+            raise ValueError("Model does not output embeddings.")
+        return self._predict_batch(images, k, embedding=True)
 
-        self.interpreter.set_tensor(input_details[0]["index"], processed_image)
-        self.interpreter.invoke()
+    def _predict_batch(self, images, k, embedding):
+        if not self.pool:
+            raise ValueError("Model is not loaded.")
+
+        with STAGE_SECONDS.time(stage="preprocess"):
+            processed = [
+                preprocess_image(
+                    io.BytesIO(image) if isinstance(image, bytes) else image
+                )
+                for image in images
+            ]
+        decoded = [i for i, array in enumerate(processed) if array is not None]
+
+        results = [None] * len(images)
+        embeddings = [None] * len(images)
+        for start in range(0, len(decoded), MLConfig.BATCH_MAX_SIZE):
+            chunk = decoded[start : start + MLConfig.BATCH_MAX_SIZE]
+            outputs = self.run([processed[i][0] for i in chunk], embedding)
+            probabilities = outputs[0] if embedding else outputs
+            for j, (i, top) in enumerate(zip(chunk, self.top_k(probabilities, k))):
+                results[i] = top
+                if embedding:
+                    embeddings[i] = outputs[1][j]
+        return results, embeddings
+
+    def predict_tiled(self, image, aggregation=None):
+        """
+        Predict a wide-field image from overlapping tiles at model
+        resolution instead of squashing the whole photo to IMG_SIZE.
+
+        Tiles are run TILE_BATCH_SIZE at a time and aggregated either by
+        'max' (the single most confident tile wins) or 'vote' (the label
+        predicted by most tiles wins, with the mean confidence of those
+        tiles). Returns the per-image result with each tile's detection.
+        """
+        if not self.pool:
+            raise ValueError("Model is not loaded.")
 
-        predictions = self.interpreter.get_tensor(output_details[0]["index"])
+        if isinstance(image, bytes):
+            image = io.BytesIO(image)
+        with STAGE_SECONDS.time(stage="preprocess"):
+            tiles, boxes = tile_image(
+                image,
+                MLConfig.IMG_SIZE,
+                MLConfig.TILE_ROWS,
+                MLConfig.TILE_OVERLAP,
+                MLConfig.TILE_MAX_TILES,
+            )
+
+        probabilities = np.concatenate(
+            [
+                self.run(tiles[start : start + MLConfig.TILE_BATCH_SIZE])
+                for start in range(0, len(tiles), MLConfig.TILE_BATCH_SIZE)
+            ]
+        )
+        classes = np.argmax(probabilities, axis=1)
+        confidences = probabilities[np.arange(len(classes)), classes]
+
+        aggregation = aggregation or MLConfig.TILE_AGGREGATION
+        if aggregation == "vote":
+            votes = np.bincount(classes, minlength=probabilities.shape[1])
+            # Ties go to the label whose tiles are most confident overall.
+            score = votes + np.bincount(
+                classes, weights=confidences, minlength=probabilities.shape[1]
+            ) / (len(classes) + 1)
+            best_class = int(np.argmax(score))
+            confidence = float(confidences[classes == best_class].mean())
+        elif aggregation == "max":
+            best_tile = int(np.argmax(confidences))
+            best_class = int(classes[best_tile])
+            confidence = float(confidences[best_tile])
+        else:
+            raise ValueError(f"Unknown tile aggregation '{aggregation}'")
+
+        return {
+            "label": MLConfig.CLASS_NAMES[best_class],
+            "confidence": confidence,
+            "tiles": [
+                {
+                    "box": box,
+                    "label": MLConfig.CLASS_NAMES[class_index],
+                    "confidence": float(tile_confidence),
+                }
+                for box, class_index, tile_confidence in zip(
+                    boxes, classes, confidences
+                )
+            ],
+        }
+
+    def _predict(self, image, embedding=False):
+        output = self._probabilities(image, embedding)
+        predictions = output[0] if embedding else output
 
         predicted_class = MLConfig.CLASS_NAMES[np.argmax(predictions)]
         confidence = float(np.max(predictions))
 
-        return predicted_class, confidence
+        result = (predicted_class, confidence)
+        return (result, output[1]) if embedding else result
+
+    def _predict_near_duplicate(self, data, embedding=False):
+        """
+        Predict an image, or reuse the prediction of a near-duplicate. The
+        image is decoded once, for both the hash and the interpreter.
+        """
+        with STAGE_SECONDS.time(stage="preprocess"):
+            processed_image = preprocess_image(io.BytesIO(data))
+        if processed_image is None:
+            raise ValueError("Could not preprocess image.")
+
+        with STAGE_SECONDS.time(stage="near_duplicate_lookup"):
+            image_hash = phash(processed_image[0])
+            result = None
+            if image_hash is not None:
+                result = self.near_duplicates.find(image_hash, self.fingerprint)
+        if result is not None:
+            return (result, None) if embedding else result
+
+        output = self._run_one(processed_image[0], embedding)
+        predictions = output[0] if embedding else output
+        result = (
+            MLConfig.CLASS_NAMES[np.argmax(predictions)],
+            float(np.max(predictions)),
+        )
+        if image_hash is not None:
+            self.near_duplicates.add(image_hash, self.fingerprint, result)
+        return (result, output[1]) if embedding else result
+
+    def _probabilities(self, image, embedding=False):
+        if isinstance(image, bytes):
+            image = io.BytesIO(image)
+
+        if self.batcher:
+            with STAGE_SECONDS.time(stage="preprocess"):
+                processed_image = preprocess_image(image)
+            if processed_image is None:
+                raise ValueError("Could not preprocess image.")
+            return self._run_one(processed_image[0], embedding)
+        return self.run_file(image, embedding)
+
+    def _run_one(self, image, embedding):
+        """Run one preprocessed image, through the batcher when enabled."""
+        if self.batcher:
+            row = self.batcher.submit(image)
+            probabilities, vector = row if self.has_embeddings else (row, None)
+        elif embedding:
+            probabilities, vectors = self.run([image], embedding=True)
+            probabilities, vector = probabilities[0], vectors[0]
+        else:
+            probabilities, vector = self.run([image])[0], None
+        return (probabilities, vector) if embedding else probabilities
+
+
+def _read_bytes(file):
+    """Read a whole upload, leaving the stream rewound for other readers."""
+    file.seek(0)
+    data = file.read()
+    file.seek(0)
+    return data
 
 
 # class Predictor:
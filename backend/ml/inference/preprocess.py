@@ -1,3 +1,4 @@
+import math
 import numpy as np
 import logging
 
@@ -7,16 +8,133 @@ from ml.ml_config import MLConfig
 logger = logging.getLogger(__name__)
 
 
+def decode_image(file, size=MLConfig.IMG_SIZE):
+    """
+    Decode an image file as RGB, at a reduced scale when possible: JPEGs
+    are decoded straight from the DCT coefficients (`draft`) at the smallest
+    scale that is still at least `size` pixels.
+    """
+    img = Image.open(file)
+    img.draft("RGB", (size, size))
+    return img.convert("RGB")
+
+
+def load_image(file, size=MLConfig.IMG_SIZE):
+    """
+    Decode an image file as an RGB image of `size` x `size` pixels.
+
+    Large images are shrunk with `reduce` before the final resampling, so
+    together with `decode_image` a big photo is never fully decoded and
+    resampled at its original size.
+    """
+    return decode_image(file, size).resize((size, size), reducing_gap=3.0)
+
+
+def preprocess_image_into(file, out, quantization=(0.0, 0)):
+    """
+    Decode, resize and normalize an image file directly into `out`, an array
+    of shape (IMG_SIZE, IMG_SIZE, 3) such as a view of the interpreter's
+    input tensor. No intermediate float64 arrays are created.
+
+    Float32 buffers receive pixels scaled to [0, 1]. Integer buffers of a
+    quantized model receive those values quantized with its
+    (scale, zero_point).
+    """
+    img = load_image(file, out.shape[0])
+    pixels = np.asarray(img)
+
+    if out.dtype == np.float32:
+        np.multiply(pixels, np.float32(1 / 255.0), out=out)
+        return
+
+    scale, zero_point = quantization
+    if out.dtype == np.uint8 and zero_point == 0 and abs(scale * 255 - 1) < 1e-6:
+        # A uint8 input calibrated on [0, 1] takes the raw pixels as they are.
+        out[...] = pixels
+    else:
+        quantize_into(pixels * np.float32(1 / 255.0), out, quantization)
+
+
+def quantize_into(image, out, quantization):
+    """
+    Quantize a normalized float32 image into the integer array `out` with
+    the (scale, zero_point) of a quantized model input.
+    """
+    scale, zero_point = quantization
+    limits = np.iinfo(out.dtype)
+    values = np.rint(image / np.float32(scale))
+    values += zero_point
+    np.clip(values, limits.min, limits.max, out=values)
+    out[...] = values
+
+
+def tile_image(file, size, rows, overlap, max_tiles):
+    """
+    Split an image into overlapping square tiles at model resolution.
+
+    `rows` tiles cover the short side, overlapping by the `overlap` fraction
+    of a tile, and as many as needed (up to `max_tiles` in total) cover the
+    long side. The image is decoded and resized once, to the scale at which
+    a tile is `size` pixels, so the cost is bounded by the tile count and
+    not by the megapixels of the upload.
+
+    Returns the tiles as a float32 array of shape (T, size, size, 3) scaled
+    to [0, 1], and the (left, top, right, bottom) box of each tile in the
+    coordinates of the original image.
+    """
+    img = Image.open(file)
+    width, height = img.size
+
+    # Never cut tiles smaller than the model input, upscaling adds nothing.
+    rows = max(1, min(int(rows), min(width, height) // size))
+    tile_px = min(width, height) / (rows - (rows - 1) * overlap)
+    stride_px = tile_px * (1 - overlap)
+    columns = max(1, math.ceil((max(width, height) - tile_px) / stride_px - 1e-6) + 1)
+    columns = max(1, min(columns, max_tiles // rows))
+
+    scale = size / tile_px
+    scaled_w = max(size, round(width * scale))
+    scaled_h = max(size, round(height * scale))
+    img.draft("RGB", (scaled_w, scaled_h))
+    img = img.convert("RGB").resize((scaled_w, scaled_h), reducing_gap=3.0)
+    pixels = np.asarray(img)
+
+    def offsets(count, scaled_length):
+        if count == 1:
+            return [(scaled_length - size) // 2]
+        # Spread the tiles evenly so the first and last touch the edges.
+        step = (scaled_length - size) / (count - 1)
+        return [round(i * step) for i in range(count)]
+
+    if width >= height:
+        xs, ys = offsets(columns, scaled_w), offsets(rows, scaled_h)
+    else:
+        xs, ys = offsets(rows, scaled_w), offsets(columns, scaled_h)
+
+    tiles = np.empty((len(xs) * len(ys), size, size, 3), np.float32)
+    boxes = []
+    for i, (y, x) in enumerate((y, x) for y in ys for x in xs):
+        np.multiply(
+            pixels[y : y + size, x : x + size], np.float32(1 / 255.0), out=tiles[i]
+        )
+        boxes.append(
+            [
+                round(x / scale),
+                round(y / scale),
+                min(width, round((x + size) / scale)),
+                min(height, round((y + size) / scale)),
+            ]
+        )
+    return tiles, boxes
+
+
 def preprocess_image(file):
     """
     Preprocess an image file to fit the model input requirements.
     """
     try:
-        img = Image.open(file).convert("RGB")
-        img = img.resize((MLConfig.IMG_SIZE, MLConfig.IMG_SIZE))
-        img_array = np.array(img) / 255.0
-        img_array = img_array.astype(np.float32)
-        img_array = np.expand_dims(img_array, axis=0)
+        img_array = np.empty((1, MLConfig.IMG_SIZE, MLConfig.IMG_SIZE, 3), np.float32)
+        preprocess_image_into(file, img_array[0])
         return img_array
     except Exception as e:
         logger.error(f"Error preprocessing image: {e}")
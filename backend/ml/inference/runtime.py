@@ -0,0 +1,57 @@
+import logging
+
+from ml.ml_config import MLConfig
+
+logger = logging.getLogger(__name__)
+
+_interpreter_class = None
+
+
+def _import_litert():
+    from ai_edge_litert.interpreter import Interpreter
+
+    return Interpreter
+
+
+def _import_tflite_runtime():
+    from tflite_runtime.interpreter import Interpreter
+
+    return Interpreter
+
+
+def _import_tensorflow():
+    import tensorflow as tf
+
+    return tf.lite.Interpreter
+
+
+RUNTIMES = {
+    "litert": _import_litert,
+    "tflite_runtime": _import_tflite_runtime,
+    "tensorflow": _import_tensorflow,
+}
+
+
+def get_interpreter_class():
+    """
+    Return the TFLite Interpreter class, importing a runtime on first use.
+
+    With INFERENCE_RUNTIME=auto the standalone runtimes are tried first, as
+    they load in a fraction of the time and memory of the full TensorFlow
+    package, which is only imported when neither is installed.
+    """
+    global _interpreter_class
+    if _interpreter_class is not None:
+        return _interpreter_class
+
+    names = list(RUNTIMES) if MLConfig.INFERENCE_RUNTIME == "auto" else []
+    names = names or [MLConfig.INFERENCE_RUNTIME]
+    for name in names:
+        try:
+            _interpreter_class = RUNTIMES[name]()
+        except ImportError:
+            continue
+        logger.info(f"Using the '{name}' TFLite runtime")
+        return _interpreter_class
+
+    raise ImportError(f"No TFLite runtime available (tried {', '.join(names)})")
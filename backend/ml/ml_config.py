@@ -5,6 +5,85 @@ class MLConfig:
     BASE_DIR = os.path.dirname(os.path.abspath(__file__))
     MODEL_PATH = os.path.join(BASE_DIR, "models", "best_model.tflite")
     IMG_SIZE = 224
+
+    # TFLite runtime: 'auto' prefers the lightweight 'litert' or
+    # 'tflite_runtime' packages and falls back to 'tensorflow'
+    INFERENCE_RUNTIME = os.getenv("INFERENCE_RUNTIME", "auto")
+    # Run a synthetic input through every interpreter when a model is loaded
+    WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "true").lower() == "true"
+
+    # Models that /api/predict can serve, by the model_id form field. They
+    # are loaded on first use and evicted least recently used first once the
+    # resident models exceed MODEL_MEMORY_LIMIT_MB. Ids whose file is not
+    # deployed are rejected as unknown.
+    DEFAULT_MODEL_ID = "cnn"
+    MODELS = {
+        "cnn": MODEL_PATH,
+        "cnn-int8": os.path.join(BASE_DIR, "models", "best_model_int8.tflite"),
+        "mobilenet": os.path.join(BASE_DIR, "models", "best_mobilenet_model.tflite"),
+        "efficientnet": os.path.join(
+            BASE_DIR, "models", "best_efficientnet_model.tflite"
+        ),
+    }
+    MODEL_MEMORY_LIMIT_MB = float(os.getenv("MODEL_MEMORY_LIMIT_MB", "512"))
+
+    # Pool of interpreters shared by the request threads of one worker
+    INTERPRETER_POOL_SIZE = int(os.getenv("INTERPRETER_POOL_SIZE", "2"))
+    INTERPRETER_POOL_TIMEOUT_S = float(os.getenv("INTERPRETER_POOL_TIMEOUT_S", "10"))
+    # Threads used by each interpreter, unset leaves the runtime default
+    INTERPRETER_THREADS = int(os.getenv("INTERPRETER_THREADS", "0")) or None
+
+    # Micro-batching of concurrent /api/predict calls
+    BATCHING_ENABLED = os.getenv("BATCHING_ENABLED", "true").lower() == "true"
+    BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "8"))
+    BATCH_MAX_WAIT_MS = float(os.getenv("BATCH_MAX_WAIT_MS", "5"))
+
+    # Tiled inference for wide-field photos: TILE_ROWS tiles across the short
+    # side overlapping by TILE_OVERLAP, at most TILE_MAX_TILES per image, run
+    # TILE_BATCH_SIZE at a time and aggregated by 'max' confidence or 'vote'
+    TILE_ROWS = int(os.getenv("TILE_ROWS", "2"))
+    TILE_OVERLAP = float(os.getenv("TILE_OVERLAP", "0.25"))
+    TILE_MAX_TILES = int(os.getenv("TILE_MAX_TILES", "12"))
+    TILE_BATCH_SIZE = int(os.getenv("TILE_BATCH_SIZE", "12"))
+    TILE_AGGREGATION = os.getenv("TILE_AGGREGATION", "max")
+
+    # Cache of predictions for re-uploaded images (TTL of 0 means no expiry,
+    # an empty path keeps the cache in memory only). The file keeps at most
+    # PREDICTION_CACHE_DISK_SIZE of the newest entries.
+    PREDICTION_CACHE_ENABLED = (
+        os.getenv("PREDICTION_CACHE_ENABLED", "true").lower() == "true"
+    )
+    PREDICTION_CACHE_SIZE = int(os.getenv("PREDICTION_CACHE_SIZE", "1024"))
+    PREDICTION_CACHE_TTL_S = float(os.getenv("PREDICTION_CACHE_TTL_S", "0"))
+    PREDICTION_CACHE_PATH = os.getenv("PREDICTION_CACHE_PATH", "")
+    PREDICTION_CACHE_DISK_SIZE = int(os.getenv("PREDICTION_CACHE_DISK_SIZE", "100000"))
+
+    # Reuse of predictions for near-duplicate uploads (re-exported,
+    # recompressed or slightly cropped), matched by perceptual hashes within
+    # NEAR_DUPLICATE_MAX_DISTANCE bits. Off by default, as a near-duplicate
+    # gets the earlier image's prediction. An empty path keeps the index in
+    # memory only.
+    NEAR_DUPLICATE_ENABLED = (
+        os.getenv("NEAR_DUPLICATE_ENABLED", "false").lower() == "true"
+    )
+    NEAR_DUPLICATE_MAX_DISTANCE = int(os.getenv("NEAR_DUPLICATE_MAX_DISTANCE", "6"))
+    NEAR_DUPLICATE_INDEX_SIZE = int(os.getenv("NEAR_DUPLICATE_INDEX_SIZE", "10000"))
+    NEAR_DUPLICATE_INDEX_PATH = os.getenv("NEAR_DUPLICATE_INDEX_PATH", "")
+
+    # Embeddings of uploads for /api/similar, kept for models converted with
+    # --embeddings. A user's uploads are searched exhaustively up to
+    # EMBEDDING_IVF_THRESHOLD, then through EMBEDDING_IVF_NPROBE inverted
+    # lists. An empty path keeps the index in memory only.
+    EMBEDDINGS_ENABLED = os.getenv("EMBEDDINGS_ENABLED", "true").lower() == "true"
+    EMBEDDING_INDEX_SIZE = int(os.getenv("EMBEDDING_INDEX_SIZE", "100000"))
+    EMBEDDING_IVF_THRESHOLD = int(os.getenv("EMBEDDING_IVF_THRESHOLD", "2048"))
+    EMBEDDING_IVF_NPROBE = int(os.getenv("EMBEDDING_IVF_NPROBE", "8"))
+    EMBEDDING_INDEX_PATH = os.getenv("EMBEDDING_INDEX_PATH", "")
+    # Seconds between a server worker saving its indexes and loading what
+    # the other workers saved, so that /api/similar and near-duplicate reuse
+    # see the uploads of every worker (0 only merges them on the next start)
+    INDEX_SYNC_S = float(os.getenv("INDEX_SYNC_S", "30"))
+
     CONSTELLATIONS = [
         ("Andromeda", "And", "Andromeda"),
         ("Antlia", "Ant", "Pompa (Wodna)"),
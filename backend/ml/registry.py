@@ -0,0 +1,107 @@
+import os
+import logging
+import threading
+
+from collections import OrderedDict
+
+from utils.metrics import MODEL_LOAD_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+class ModelRegistry:
+    """
+    Map model ids to TFLite files and keep the recently used ones loaded.
+
+    Models are created with `factory(model_path)` on first use. Once the
+    estimated memory of the resident models exceeds `max_bytes`, the least
+    recently used ones are closed and dropped; the model being requested is
+    always kept.
+    """
+
+    def __init__(self, models, factory, max_bytes):
+        self.models = dict(models)
+        self.factory = factory
+        self.max_bytes = max_bytes
+
+        self._resident = OrderedDict()
+        self._lock = threading.Lock()
+        self._load_locks = {model_id: threading.Lock() for model_id in self.models}
+        self.loads = 0
+        self.evictions = 0
+
+    def __contains__(self, model_id):
+        """Whether `model_id` is registered and its file is deployed."""
+        return model_id in self.models and os.path.isfile(self.models[model_id])
+
+    def get(self, model_id):
+        """Return the loaded predictor for `model_id`, loading it if needed."""
+        if model_id not in self:
+            raise KeyError(f"Unknown model '{model_id}'")
+
+        with self._lock:
+            if model_id in self._resident:
+                self._resident.move_to_end(model_id)
+                return self._resident[model_id][0]
+
+        # Load outside the registry lock so a slow load does not block
+        # requests for models that are already resident.
+        with self._load_locks[model_id]:
+            with self._lock:
+                if model_id in self._resident:
+                    return self._resident[model_id][0]
+
+            with MODEL_LOAD_SECONDS.time(model_id=model_id):
+                predictor = self.factory(self.models[model_id])
+            if not predictor.pool:
+                raise ValueError(f"Model '{model_id}' could not be loaded")
+
+            with self._lock:
+                self._resident[model_id] = (predictor, _estimate_bytes(predictor))
+                self.loads += 1
+                self._evict()
+            logger.info(f"Loaded model '{model_id}'")
+            return predictor
+
+    def stats(self):
+        with self._lock:
+            return {
+                "resident": {
+                    model_id: {
+                        "bytes": size,
+                        "batching": (
+                            predictor.batcher.stats() if predictor.batcher else None
+                        ),
+                    }
+                    for model_id, (predictor, size) in self._resident.items()
+                },
+                "loads": self.loads,
+                "evictions": self.evictions,
+            }
+
+    def after_fork(self):
+        """
+        Prepare the models loaded before a fork for use in the child process.
+        Their interpreters stay shared with the parent, copy-on-write.
+        """
+        self._lock = threading.Lock()
+        self._load_locks = {model_id: threading.Lock() for model_id in self.models}
+        for predictor, _ in self._resident.values():
+            predictor.after_fork()
+
+    def _evict(self):
+        total = sum(size for _, size in self._resident.values())
+        while total > self.max_bytes and len(self._resident) > 1:
+            model_id, (predictor, size) = self._resident.popitem(last=False)
+            total -= size
+            self.evictions += 1
+            predictor.close()
+            logger.info(f"Evicted model '{model_id}'")
+
+
+def _estimate_bytes(predictor):
+    """
+    Approximate the memory a predictor keeps resident: the model buffer plus
+    tensor arenas of about the same size for each pooled interpreter.
+    """
+    return os.path.getsize(predictor.model_path) * (1 + predictor.pool.size)
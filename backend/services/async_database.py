@@ -0,0 +1,270 @@
+"""
+Async variants of the services in `services.database`, for the ASGI app.
+They take a Supabase AsyncClient and await each round trip instead of
+blocking a thread on it; queries and results are built by the same helpers.
+History cache calls, which may wait on Redis, run in a thread.
+"""
+
+import asyncio
+import logging
+
+from supabase import AsyncClient
+
+from services.storage import object_path_from_url
+from services.database import (
+    HISTORY_FIELDS,
+    build_prediction_record,
+    _fill_ids,
+    _update_history_cache,
+    _history_query,
+    _history_page,
+    _by_file_url_query,
+    _newest_by_file_url,
+    _deletable_records,
+    _record_deleted,
+    _unreferenced_objects,
+)
+
+logger = logging.getLogger(__name__)
+
+
+async def insert_prediction(
+    sb: AsyncClient,
+    table_name: str,
+    user_id: str,
+    filename: str,
+    file_url: str,
+    label: str,
+    model_id: str,
+    history_cache=None,
+):
+    """Insert a prediction record into the database."""
+    return await insert_predictions(
+        sb,
+        table_name,
+        [build_prediction_record(user_id, filename, file_url, label, model_id)],
+        history_cache,
+    )
+
+
+async def insert_predictions(
+    sb: AsyncClient, table_name: str, records: list, history_cache=None
+):
+    """
+    Insert several prediction records with a single request, filling in the
+    id of each inserted record.
+    """
+    if not records:
+        return True, None
+
+    try:
+        db_res = await sb.table(table_name).insert(records).execute()
+
+        if not db_res:
+            logger.error("Bulk prediction insertion failed")
+            return False, "Failed to save predictions"
+
+        _fill_ids(records, db_res.data)
+        if history_cache:
+            await asyncio.to_thread(
+                _update_history_cache, history_cache, records, db_res.data
+            )
+        return True, None
+    except Exception as e:
+        logger.error(f"Exception during bulk prediction insertion: {e}")
+        return False, "Internal server error during prediction insertion"
+
+
+async def fetch_history(
+    sb: AsyncClient,
+    table_name: str,
+    user_id: str,
+    limit: int,
+    after=None,
+    fields=None,
+    history_cache=None,
+):
+    """Fetch one page of a user's prediction history, newest first."""
+    if history_cache:
+        page = await asyncio.to_thread(history_cache.get, user_id, after, limit, fields)
+        if page is not None:
+            return page, None
+        generation = await asyncio.to_thread(history_cache.generation, user_id)
+
+    try:
+        db_res = await _history_query(
+            sb, table_name, user_id, limit, after, fields
+        ).execute()
+        page = _history_page(db_res.data or [], limit)
+        if history_cache:
+            await asyncio.to_thread(
+                history_cache.put, user_id, after, limit, fields, page, generation
+            )
+        return page, None
+    except Exception as e:
+        logger.error(f"Exception during history fetch: {e}")
+        return None, "Failed to fetch history"
+
+
+async def fetch_prediction(
+    sb: AsyncClient, table_name: str, pred_id: int, user_id: str
+):
+    """Fetch one of a user's prediction records, None if it does not exist."""
+    try:
+        db_res = (
+            await sb.table(table_name)
+            .select(",".join(HISTORY_FIELDS))
+            .eq("id", pred_id)
+            .eq("user_id", user_id)
+            .maybe_single()
+            .execute()
+        )
+        return (db_res.data if db_res else None), None
+    except Exception as e:
+        logger.error(f"Exception during prediction fetch: {e}")
+        return None, "Failed to fetch prediction"
+
+
+async def fetch_predictions_by_file_url(
+    sb: AsyncClient, table_name: str, user_id: str, file_urls: list
+):
+    """
+    Fetch the newest of a user's prediction records for each of the
+    `file_urls` in one query, as a {file_url: record} dict.
+    """
+    if not file_urls:
+        return {}, None
+    try:
+        db_res = await _by_file_url_query(sb, table_name, user_id, file_urls).execute()
+        return _newest_by_file_url(db_res.data or []), None
+    except Exception as e:
+        logger.error(f"Exception during prediction fetch: {e}")
+        return None, "Failed to fetch predictions"
+
+
+async def delete_prediction(
+    sb: AsyncClient,
+    table_name: str,
+    bucket_name: str,
+    pred_id: int,
+    history_cache=None,
+    file_remover=None,
+):
+    """
+    Delete a prediction record, and its file unless other predictions still
+    reference it.
+    """
+    try:
+        fetch_res = (
+            await sb.table(table_name)
+            .select("file_url,user_id")
+            .eq("id", pred_id)
+            .maybe_single()
+            .execute()
+        )
+
+        if not fetch_res or not fetch_res.data:
+            return None, "Prediction not found"
+
+        record = fetch_res.data
+        file_url = record.get("file_url")
+        if not file_url:
+            return None, "File URL not found"
+
+        file_path = object_path_from_url(file_url, bucket_name)
+        if not file_path:
+            return None, "Invalid file path"
+
+        delete_res = await sb.table(table_name).delete().eq("id", pred_id).execute()
+        if not delete_res.data or len(delete_res.data) == 0:
+            logger.error(f"Failed to delete prediction record: {delete_res}")
+            return None, "Failed to delete prediction record"
+        if history_cache:
+            await asyncio.to_thread(history_cache.invalidate, record.get("user_id"))
+
+        # Shared content-addressed objects are kept, see `delete_prediction`
+        # in services.database
+        if file_remover:
+            file_remover.submit([file_url])
+        else:
+            await remove_unreferenced_files(sb, table_name, bucket_name, {file_url})
+
+        logger.info(f"Successfully deleted prediction record {pred_id}")
+        return {"success": True}, None
+    except Exception as e:
+        logger.error(f"Exception during deletion: {e}")
+        return None, "Failed to delete prediction"
+
+
+async def delete_predictions(
+    sb: AsyncClient,
+    table_name: str,
+    bucket_name: str,
+    user_id: str,
+    pred_ids: list,
+    history_cache=None,
+    file_remover=None,
+):
+    """
+    Delete several of a user's prediction records and their files with one
+    query per step. Returns a {pred_id: error or None} dict with the outcome
+    of each id, other users' records being reported as not found.
+    """
+    results = {pred_id: "Prediction not found" for pred_id in pred_ids}
+    try:
+        fetch_res = (
+            await sb.table(table_name)
+            .select("id,file_url,user_id")
+            .eq("user_id", user_id)
+            .in_("id", pred_ids)
+            .execute()
+        )
+        records = _deletable_records(fetch_res.data or [], bucket_name, results)
+        if not records:
+            return results, None
+
+        delete_res = (
+            await sb.table(table_name)
+            .delete()
+            .eq("user_id", user_id)
+            .in_("id", list(records))
+            .execute()
+        )
+        deleted = await asyncio.to_thread(
+            _record_deleted, records, delete_res.data or [], results, history_cache
+        )
+
+        try:
+            file_urls = {r["file_url"] for r in deleted}
+            if file_remover:
+                file_remover.submit(file_urls)
+            else:
+                await remove_unreferenced_files(sb, table_name, bucket_name, file_urls)
+        except Exception as e:
+            logger.error(f"Exception during bulk file removal: {e}")
+
+        logger.info(f"Deleted {len(deleted)} of {len(pred_ids)} prediction records")
+        return results, None
+    except Exception as e:
+        logger.error(f"Exception during bulk deletion: {e}")
+        return None, "Failed to delete predictions"
+
+
+async def remove_unreferenced_files(sb, table_name, bucket_name, file_urls):
+    """Remove the files, and thumbnails, that no prediction references."""
+    if not file_urls:
+        return
+
+    refs_res = (
+        await sb.table(table_name)
+        .select("file_url")
+        .in_("file_url", list(file_urls))
+        .execute()
+    )
+    referenced = {row["file_url"] for row in refs_res.data or []}
+    object_paths = _unreferenced_objects(bucket_name, file_urls, referenced)
+    if not object_paths:
+        return
+
+    remove_res = await sb.storage.from_(bucket_name).remove(object_paths)
+    logger.debug(f"Remove response: {remove_res}")
@@ -0,0 +1,140 @@
+"""
+Async variants of the services in `services.storage`, for the ASGI app.
+They take a Supabase AsyncClient and share their helpers with the sync
+services.
+"""
+
+import time
+import asyncio
+import logging
+
+from werkzeug.utils import secure_filename
+from supabase import AsyncClient
+
+from services.storage import (
+    sanitize_user_id,
+    content_key,
+)
+from utils.metrics import STAGE_SECONDS, STORAGE_UPLOADS
+
+logger = logging.getLogger(__name__)
+
+
+async def upload_bytes_to_storage(
+    sb: AsyncClient,
+    bucket_name: str,
+    file_bytes: bytes,
+    filename: str,
+    content_type: str,
+    user_id: str,
+    content_addressed: bool = False,
+):
+    """Upload file content to Supabase Storage and return its public URL."""
+    with STAGE_SECONDS.time(stage="upload_file_to_storage"):
+        if content_addressed:
+            return await upload_content_addressed(
+                sb, bucket_name, file_bytes, content_type
+            )
+        return await _upload_named(
+            sb, bucket_name, file_bytes, filename, content_type, user_id
+        )
+
+
+async def _upload_named(sb, bucket_name, file_bytes, filename, content_type, user_id):
+    try:
+        sanitized_user_id = sanitize_user_id(user_id)
+        original_filename = secure_filename(filename)
+        unique_name = f"{sanitized_user_id}_{int(time.time())}_{original_filename}"
+
+        bucket = sb.storage.from_(bucket_name)
+        upload_res = await bucket.upload(
+            unique_name, file_bytes, {"content-type": content_type}
+        )
+
+        if not upload_res:
+            logger.error("File upload failed: No response received")
+            return None, "File upload failed"
+        STORAGE_UPLOADS.inc(result="uploaded")
+
+        public_url_res = await bucket.get_public_url(unique_name)
+
+        if not public_url_res:
+            logger.error("Failed to get public URL")
+            return None, "Failed to get public URL"
+
+        return public_url_res, None
+    except Exception as e:
+        logger.error(f"Exception during file upload: {e}")
+        return None, "Internal server error during file upload"
+
+
+async def upload_content_addressed(
+    sb: AsyncClient, bucket_name: str, file_bytes: bytes, content_type: str
+):
+    """
+    Store file content under its content hash and return its public URL,
+    skipping the upload when the object already exists.
+    """
+    object_path = content_key(file_bytes)
+    bucket = sb.storage.from_(bucket_name)
+    try:
+        if await bucket.exists(object_path):
+            STORAGE_UPLOADS.inc(result="deduplicated")
+        else:
+            try:
+                await bucket.upload(
+                    object_path, file_bytes, {"content-type": content_type}
+                )
+            except Exception:
+                # A concurrent upload of the same content may have won
+                if not await bucket.exists(object_path):
+                    raise
+            STORAGE_UPLOADS.inc(result="uploaded")
+
+        public_url_res = await bucket.get_public_url(object_path)
+        if not public_url_res:
+            logger.error("Failed to get public URL")
+            return None, "Failed to get public URL"
+
+        return public_url_res, None
+    except Exception as e:
+        logger.error(f"Exception during file upload: {e}")
+        return None, "Internal server error during file upload"
+
+
+async def upload_many_to_storage(
+    sb: AsyncClient,
+    bucket_name: str,
+    files,
+    user_id: str,
+    content_addressed: bool = False,
+):
+    """
+    Upload several (filename, bytes, content_type) files concurrently and
+    return a (public_url, error) pair per file, in order. Names are
+    prefixed with their position, see `upload_many_to_storage` in
+    services.storage.
+    """
+    return await asyncio.gather(
+        *(
+            upload_bytes_to_storage(
+                sb,
+                bucket_name,
+                file_bytes,
+                f"{i}_{filename}",
+                content_type,
+                user_id,
+                content_addressed,
+            )
+            for i, (filename, file_bytes, content_type) in enumerate(files)
+        )
+    )
+
+
+async def upload_thumbnail(
+    sb: AsyncClient, bucket_name: str, object_path: str, data: bytes
+):
+    """Store a JPEG thumbnail, replacing an existing one."""
+    await sb.storage.from_(bucket_name).upload(
+        object_path, data, {"content-type": "image/jpeg", "upsert": "true"}
+    )
@@ -1,64 +1,273 @@
+import json
 import time
+import base64
 import logging
 
 from supabase import Client
-from urllib.parse import urlparse
+
+from services.storage import object_path_from_url
+from services.thumbnails import THUMBNAIL_NAMES, thumbnail_path
 
 logger = logging.getLogger(__name__)
 
 
+def build_prediction_record(
+    user_id: str, filename: str, file_url: str, label: str, model_id: str
+):
+    """
+    Build a prediction row as stored in the predictions table. The
+    model_id column is added by migrations/001_predictions_model_id.sql.
+    """
+    return {
+        "user_id": user_id,
+        "filename": filename,
+        "file_url": file_url,
+        "label": label,
+        "model_id": model_id,
+        "created_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+
+
 def insert_prediction(
-    sb: Client, table_name: str, user_id: str, filename: str, file_url: str, label: str
+    sb: Client,
+    table_name: str,
+    user_id: str,
+    filename: str,
+    file_url: str,
+    label: str,
+    model_id: str,
+    history_cache=None,
 ):
     """Insert a prediction record into the database."""
     try:
-        prediction_data = {
-            "user_id": user_id,
-            "filename": filename,
-            "file_url": file_url,
-            "label": label,
-            "created_at": time.strftime("%Y-%m-%d %H:%M:%S"),
-        }
+        prediction_data = build_prediction_record(
+            user_id, filename, file_url, label, model_id
+        )
         db_res = sb.table(table_name).insert(prediction_data).execute()
 
         if not db_res:
             logger.error("Prediction insertion failed")
             return False, "Failed to save prediction"
 
+        _update_history_cache(history_cache, [prediction_data], db_res.data)
         return True, None
     except Exception as e:
         logger.error(f"Exception during prediction insertion: {e}")
         return False, "Internal server error during prediction insertion"
 
 
+def insert_predictions(sb: Client, table_name: str, records: list, history_cache=None):
+    """
+    Insert several prediction records with a single request, filling in the
+    id of each inserted record.
+    """
+    if not records:
+        return True, None
+
+    try:
+        db_res = sb.table(table_name).insert(records).execute()
+
+        if not db_res:
+            logger.error("Bulk prediction insertion failed")
+            return False, "Failed to save predictions"
+
+        _fill_ids(records, db_res.data)
+        _update_history_cache(history_cache, records, db_res.data)
+        return True, None
+    except Exception as e:
+        logger.error(f"Exception during bulk prediction insertion: {e}")
+        return False, "Internal server error during prediction insertion"
+
+
+def _fill_ids(records, inserted):
+    """Copy the ids of the rows returned by an insert to their records."""
+    if inserted and len(inserted) == len(records):
+        for record, row in zip(records, inserted):
+            if "id" in row:
+                record["id"] = row["id"]
+
+
+def _update_history_cache(history_cache, records, inserted):
+    """
+    Add inserted rows to their users' cached history. The rows returned by
+    the insert carry the id and created_at the pages are ordered by; without
+    them the users' cached pages are dropped instead.
+    """
+    if not history_cache:
+        return
+
+    rows_by_user = {}
+    complete = bool(inserted) and all(
+        "id" in row and "created_at" in row for row in inserted
+    )
+    for row in inserted if complete else records:
+        rows_by_user.setdefault(row["user_id"], []).append(row)
+
+    for user_id, rows in rows_by_user.items():
+        if complete:
+            history_cache.add_rows(user_id, rows, encode_cursor)
+        else:
+            history_cache.invalidate(user_id)
+
+
+# Columns of the predictions table that history requests may select.
+# `id` and `created_at` are always selected, the cursor is built from them.
+HISTORY_FIELDS = (
+    "id",
+    "created_at",
+    "user_id",
+    "filename",
+    "file_url",
+    "label",
+    "model_id",
+)
+
+
+def encode_cursor(row):
+    """Opaque cursor pointing just after `row` in created_at, id order."""
+    position = json.dumps([row["created_at"], row["id"]]).encode()
+    return base64.urlsafe_b64encode(position).decode()
+
+
+def decode_cursor(cursor):
+    """Return the (created_at, id) of a cursor, or None if it is invalid."""
+    try:
+        created_at, pred_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except Exception:
+        return None
+    if not isinstance(created_at, str) or not isinstance(pred_id, int):
+        return None
+    return created_at, pred_id
+
+
 # services/database.py
-def fetch_history(sb: Client, table_name: str, user_id: str):
-    """Fetch prediction history for a specific user."""
+def fetch_history(
+    sb: Client,
+    table_name: str,
+    user_id: str,
+    limit: int,
+    after=None,
+    fields=None,
+    history_cache=None,
+):
+    """
+    Fetch one page of a user's prediction history, newest first.
+
+    Pages are read by keyset on (created_at, id): `after` is the position
+    decoded from the previous page's cursor, so every page costs the same
+    however deep it is. Only `fields` (and the cursor columns) are selected.
+    Returns the rows and the cursor of the next page, None on the last one.
+    Pages are served from and stored in `history_cache` when given.
+    """
+    if history_cache:
+        page = history_cache.get(user_id, after, limit, fields)
+        if page is not None:
+            return page, None
+        generation = history_cache.generation(user_id)
+
+    try:
+        db_res = _history_query(sb, table_name, user_id, limit, after, fields).execute()
+        page = _history_page(db_res.data or [], limit)
+        if history_cache:
+            history_cache.put(user_id, after, limit, fields, page, generation)
+        return page, None
+    except Exception as e:
+        logger.error(f"Exception during history fetch: {e}")
+        return None, "Failed to fetch history"
+
+
+def _history_query(sb, table_name, user_id, limit, after, fields):
+    columns = ["id", "created_at"]
+    columns += [f for f in fields or HISTORY_FIELDS if f not in columns]
+    query = sb.table(table_name).select(",".join(columns)).eq("user_id", user_id)
+    if after:
+        created_at, pred_id = after
+        query = query.or_(
+            f'created_at.lt."{created_at}",'
+            f'and(created_at.eq."{created_at}",id.lt.{pred_id})'
+        )
+
+    # One extra row tells whether there is a next page
+    return query.order("created_at", desc=True).order("id", desc=True).limit(limit + 1)
+
+
+def _history_page(rows, limit):
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor(rows[-1])
+
+
+def fetch_prediction(sb: Client, table_name: str, pred_id: int, user_id: str):
+    """Fetch one of a user's prediction records, None if it does not exist."""
     try:
         db_res = (
             sb.table(table_name)
-            .select("*")
+            .select(",".join(HISTORY_FIELDS))
+            .eq("id", pred_id)
             .eq("user_id", user_id)
-            .order("created_at", desc=True)
+            .maybe_single()
             .execute()
         )
+        return (db_res.data if db_res else None), None
+    except Exception as e:
+        logger.error(f"Exception during prediction fetch: {e}")
+        return None, "Failed to fetch prediction"
 
-        if not db_res.data:
-            return [], None
 
-        return db_res.data, None
+def fetch_predictions_by_file_url(
+    sb: Client, table_name: str, user_id: str, file_urls: list
+):
+    """
+    Fetch the newest of a user's prediction records for each of the
+    `file_urls` in one query. Returns a {file_url: record} dict, without
+    the files that no record references.
+    """
+    if not file_urls:
+        return {}, None
+    try:
+        db_res = _by_file_url_query(sb, table_name, user_id, file_urls).execute()
+        return _newest_by_file_url(db_res.data or []), None
     except Exception as e:
-        logger.error(f"Exception during history fetch: {e}")
-        return None, "Failed to fetch history"
+        logger.error(f"Exception during prediction fetch: {e}")
+        return None, "Failed to fetch predictions"
+
 
+def _by_file_url_query(sb, table_name, user_id, file_urls):
+    return (
+        sb.table(table_name)
+        .select(",".join(HISTORY_FIELDS))
+        .eq("user_id", user_id)
+        .in_("file_url", list(file_urls))
+        .order("created_at", desc=True)
+        .order("id", desc=True)
+    )
 
-def delete_prediction(sb: Client, table_name: str, bucket_name: str, pred_id: int):
-    """Delete a prediction record and associated file."""
+
+def _newest_by_file_url(rows):
+    records = {}
+    for record in rows:
+        records.setdefault(record["file_url"], record)
+    return records
+
+
+def delete_prediction(
+    sb: Client,
+    table_name: str,
+    bucket_name: str,
+    pred_id: int,
+    history_cache=None,
+    file_remover=None,
+):
+    """
+    Delete a prediction record, and its file unless other predictions still
+    reference it: right away, or later with a DeferredFileRemover.
+    """
     try:
         # Fetch the prediction record
         fetch_res = (
             sb.table(table_name)
-            .select("file_url")
+            .select("file_url,user_id")
             .eq("id", pred_id)
             .maybe_single()
             .execute()
@@ -72,27 +281,151 @@ def delete_prediction(sb: Client, table_name: str, bucket_name: str, pred_id: in
         if not file_url:
             return None, "File URL not found"
 
-        parsed_url = urlparse(file_url)
-        path = parsed_url.path
-        file_path = (
-            path.split(f"/{bucket_name}/")[1] if f"/{bucket_name}/" in path else None
-        )
-
+        file_path = object_path_from_url(file_url, bucket_name)
         if not file_path:
             return None, "Invalid file path"
 
-        # Remove file from storage
-        remove_res = sb.storage.from_(bucket_name).remove([file_path])
-        logger.debug(f"Remove response: {remove_res}")
-
         # Delete record from database
         delete_res = sb.table(table_name).delete().eq("id", pred_id).execute()
         if not delete_res.data or len(delete_res.data) == 0:
             logger.error(f"Failed to delete prediction record: {delete_res}")
             return None, "Failed to delete prediction record"
+        if history_cache:
+            history_cache.invalidate(record.get("user_id"))
+
+        # Content-addressed objects are shared by every prediction of the
+        # same image, the file is only removed with its last reference
+        if file_remover:
+            file_remover.submit([file_url])
+        else:
+            remove_unreferenced_files(sb, table_name, bucket_name, {file_url})
 
         logger.info(f"Successfully deleted prediction record {pred_id}")
         return {"success": True}, None
     except Exception as e:
         logger.error(f"Exception during deletion: {e}")
         return None, "Failed to delete prediction"
+
+
+def delete_predictions(
+    sb: Client,
+    table_name: str,
+    bucket_name: str,
+    user_id: str,
+    pred_ids: list,
+    history_cache=None,
+    file_remover=None,
+):
+    """
+    Delete several of a user's prediction records and their files with one
+    query per step instead of three round trips per record: one select of
+    the records, one delete of the rows, one lookup of the files still
+    referenced by other predictions and one storage remove for the rest.
+
+    Returns a {pred_id: error or None} dict with the outcome of each id.
+    Ids of other users' records are reported as not found.
+    """
+    results = {pred_id: "Prediction not found" for pred_id in pred_ids}
+    try:
+        fetch_res = (
+            sb.table(table_name)
+            .select("id,file_url,user_id")
+            .eq("user_id", user_id)
+            .in_("id", pred_ids)
+            .execute()
+        )
+
+        records = _deletable_records(fetch_res.data or [], bucket_name, results)
+        if not records:
+            return results, None
+
+        delete_res = (
+            sb.table(table_name)
+            .delete()
+            .eq("user_id", user_id)
+            .in_("id", list(records))
+            .execute()
+        )
+        deleted = _record_deleted(
+            records, delete_res.data or [], results, history_cache
+        )
+
+        # Files shared with remaining predictions are kept, see
+        # `delete_prediction`. The rows are gone at this point, so a failure
+        # here only leaves files behind and is not reported per id.
+        try:
+            file_urls = {r["file_url"] for r in deleted}
+            if file_remover:
+                file_remover.submit(file_urls)
+            else:
+                remove_unreferenced_files(sb, table_name, bucket_name, file_urls)
+        except Exception as e:
+            logger.error(f"Exception during bulk file removal: {e}")
+
+        logger.info(f"Deleted {len(deleted)} of {len(pred_ids)} prediction records")
+        return results, None
+    except Exception as e:
+        logger.error(f"Exception during bulk deletion: {e}")
+        return None, "Failed to delete predictions"
+
+
+def _deletable_records(rows, bucket_name, results):
+    """Records with a stored file by id, the others get their error."""
+    records = {}
+    for record in rows:
+        file_url = record.get("file_url")
+        if not file_url:
+            results[record["id"]] = "File URL not found"
+        elif not object_path_from_url(file_url, bucket_name):
+            results[record["id"]] = "Invalid file path"
+        else:
+            records[record["id"]] = record
+    return records
+
+
+def _record_deleted(records, deleted_rows, results, history_cache):
+    """Mark the outcome of each deleted record, return the deleted records."""
+    deleted = [records[row["id"]] for row in deleted_rows]
+    for pred_id in records:
+        results[pred_id] = "Failed to delete prediction record"
+    for record in deleted:
+        results[record["id"]] = None
+    if history_cache:
+        for user_id in {record["user_id"] for record in deleted}:
+            history_cache.invalidate(user_id)
+    return deleted
+
+
+def _unreferenced_objects(bucket_name, file_urls, referenced):
+    """
+    Storage paths of the files no prediction references any more, with
+    their thumbnails.
+    """
+    file_paths = [
+        object_path_from_url(file_url, bucket_name)
+        for file_url in file_urls
+        if file_url not in referenced
+    ]
+    return file_paths + [
+        thumbnail_path(p, name) for p in file_paths for name in THUMBNAIL_NAMES
+    ]
+
+
+def remove_unreferenced_files(sb, table_name, bucket_name, file_urls):
+    """Remove the files, and thumbnails, that no prediction references."""
+    if not file_urls:
+        return
+
+    refs_res = (
+        sb.table(table_name)
+        .select("file_url")
+        .in_("file_url", list(file_urls))
+        .execute()
+    )
+    referenced = {row["file_url"] for row in refs_res.data or []}
+    object_paths = _unreferenced_objects(bucket_name, file_urls, referenced)
+    if not object_paths:
+        return
+
+    remove_res = sb.storage.from_(bucket_name).remove(object_paths)
+    logger.debug(f"Remove response: {remove_res}")
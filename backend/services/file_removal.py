@@ -0,0 +1,94 @@
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class DeferredFileRemover:
+    """
+    Remove the files of deleted predictions `delay_s` after the delete,
+    unless a prediction references them again by then. `remove(file_urls)`
+    checks the references and removes the files, see
+    `remove_unreferenced_files` in services.database.
+
+    A content-addressed file is shared by every prediction of the same
+    image, and a new prediction of it may still wait in the write-behind
+    queue of any worker when another of its predictions is deleted. The
+    references are only checked once those rows are written, so the delay
+    must outlast a write-behind flush with its retries.
+
+    Files still waiting when the remover is closed are left in storage.
+    """
+
+    def __init__(self, remove, delay_s=60):
+        self.remove = remove
+        self.delay = max(0.0, float(delay_s))
+
+        self._due = {}
+        self._condition = threading.Condition()
+        self._counts = {"checked": 0, "failed": 0}
+        self._closed = False
+        self._start()
+
+    def submit(self, file_urls):
+        """Schedule the removal of files whose predictions were deleted."""
+        due = time.monotonic() + self.delay
+        with self._condition:
+            for file_url in file_urls:
+                self._due[file_url] = due
+            self._condition.notify()
+
+    def stats(self):
+        with self._condition:
+            return {"pending": len(self._due), **self._counts}
+
+    def close(self):
+        """Stop the background thread, leaving the files still waiting."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._worker.join()
+        if self._due:
+            logger.warning(f"Left {len(self._due)} deleted files in storage")
+
+    def after_fork(self):
+        """
+        Start a thread of its own in a forked child process. Files scheduled
+        before the fork are left to the parent.
+        """
+        self._due = {}
+        self._condition = threading.Condition()
+        self._counts = {"checked": 0, "failed": 0}
+        if not self._closed:
+            self._start()
+
+    def _start(self):
+        self._worker = threading.Thread(
+            target=self._run, name="file-removal", daemon=True
+        )
+        self._worker.start()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._closed:
+                    now = time.monotonic()
+                    ready = {url for url, due in self._due.items() if due <= now}
+                    if ready:
+                        break
+                    timeout = min(self._due.values(), default=now + 60) - now
+                    self._condition.wait(timeout)
+                if self._closed:
+                    return
+                for file_url in ready:
+                    del self._due[file_url]
+
+            try:
+                self.remove(ready)
+                result = "checked"
+            except Exception as e:
+                logger.error(f"Removal of {len(ready)} deleted files failed: {e}")
+                result = "failed"
+            with self._condition:
+                self._counts[result] += len(ready)
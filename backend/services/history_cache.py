@@ -0,0 +1,284 @@
+import json
+import time
+import logging
+import threading
+
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class LocalCacheBackend:
+    """
+    Process-local LRU of cached history, one entry per user. Each gunicorn
+    worker has its own copy, so with several workers a user's changes only
+    reach the other workers' copies once the entries expire.
+    """
+
+    shared = False
+
+    def __init__(self, max_users=1000, ttl_seconds=None):
+        self.max_users = max(1, int(max_users))
+        self.ttl = ttl_seconds or None
+        self._entries = OrderedDict()
+        self._generations = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            pages, expires_at = entry
+            if expires_at and expires_at <= time.time():
+                del self._entries[user_id]
+                return None
+            self._entries.move_to_end(user_id)
+            return dict(pages)
+
+    def set(self, user_id, pages, generation=None):
+        expires_at = time.time() + self.ttl if self.ttl else None
+        with self._lock:
+            if generation is not None and generation != self._generations.get(
+                user_id, 0
+            ):
+                return False
+            self._entries[user_id] = (dict(pages), expires_at)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_users:
+                self._entries.popitem(last=False)
+            return True
+
+    def delete(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def generation(self, user_id):
+        with self._lock:
+            return self._generations.get(user_id, 0)
+
+    def bump(self, user_id):
+        with self._lock:
+            self._generations[user_id] = self._generations.get(user_id, 0) + 1
+            self._generations.move_to_end(user_id)
+            while len(self._generations) > self.max_users:
+                self._generations.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class RedisCacheBackend:
+    """
+    Cached history kept in Redis, shared by every worker and instance.
+    Memory is bounded by the TTL and Redis' own eviction policy.
+    """
+
+    shared = True
+
+    def __init__(self, url, ttl_seconds=None, prefix="history:"):
+        try:
+            import redis
+        except ImportError:
+            raise ImportError("The 'redis' history cache backend requires redis-py")
+
+        self.ttl = int(ttl_seconds) if ttl_seconds else None
+        self.prefix = prefix
+        self._redis = redis.Redis.from_url(url)
+        self._watch_error = redis.WatchError
+
+    def get(self, user_id):
+        data = self._redis.get(self.prefix + user_id)
+        if data is None:
+            return None
+        return {key: tuple(page) for key, page in json.loads(data).items()}
+
+    def set(self, user_id, pages, generation=None):
+        if generation is None:
+            self._redis.set(self.prefix + user_id, json.dumps(pages), ex=self.ttl)
+            return True
+
+        # Written only if no other worker bumped the generation meanwhile
+        generation_key = self.prefix + "generation:" + user_id
+        with self._redis.pipeline() as pipe:
+            try:
+                pipe.watch(generation_key)
+                if int(pipe.get(generation_key) or 0) != generation:
+                    return False
+                pipe.multi()
+                pipe.set(self.prefix + user_id, json.dumps(pages), ex=self.ttl)
+                pipe.execute()
+                return True
+            except self._watch_error:
+                return False
+
+    def delete(self, user_id):
+        self._redis.delete(self.prefix + user_id)
+
+    def generation(self, user_id):
+        return int(self._redis.get(self.prefix + "generation:" + user_id) or 0)
+
+    def bump(self, user_id):
+        generation_key = self.prefix + "generation:" + user_id
+        with self._redis.pipeline() as pipe:
+            pipe.incr(generation_key)
+            if self.ttl:
+                pipe.expire(generation_key, self.ttl)
+            pipe.execute()
+
+    def clear(self):
+        for key in self._redis.scan_iter(self.prefix + "*"):
+            self._redis.delete(key)
+
+
+class HistoryCache:
+    """
+    Cache of the recently fetched history pages of each user.
+
+    A page is stored under its cursor, size and selected fields. New rows
+    are newer than every cached row, so they can only change first pages:
+    after an insert the first pages are updated in place (write-through)
+    and pages behind a cursor stay valid. A delete can change any page, so
+    it drops all of the user's pages. With a shared backend the first pages
+    are dropped instead of updated, as two workers updating the same entry
+    could lose one of the rows.
+
+    Both bump a per-user generation. A page read from the database is only
+    stored if the generation it was read at is still current, so a fetch
+    that raced with an insert or delete cannot cache what it missed.
+    """
+
+    def __init__(self, backend, max_pages_per_user=8):
+        self.backend = backend
+        self.max_pages_per_user = max(1, int(max_pages_per_user))
+        self._lock = threading.Lock()
+        self._update_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def page_key(after, limit, fields):
+        after = list(after) if after else None
+        return json.dumps([after, limit, list(fields) if fields else None])
+
+    def get(self, user_id, after, limit, fields):
+        """
+        Return the cached (rows, next_cursor) page starting after the
+        `after` position, or None.
+        """
+        pages = self._read(user_id)
+        page = pages.get(self.page_key(after, limit, fields)) if pages else None
+        with self._lock:
+            if page is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return page
+
+    def generation(self, user_id):
+        """
+        Return the user's current generation, to be read before fetching
+        a page from the database and passed to `put`.
+        """
+        try:
+            return self.backend.generation(user_id)
+        except Exception as e:
+            logger.warning(f"History cache read failed: {e}")
+            return None
+
+    def put(self, user_id, after, limit, fields, page, generation):
+        """
+        Store a page read from the database at `generation`, unless the
+        user's history has changed since.
+        """
+        if generation is None:
+            return
+        key = self.page_key(after, limit, fields)
+        with self._update_lock:
+            pages = self._read(user_id) or {}
+            pages.pop(key, None)
+            pages[key] = page
+            # Pages are kept in insertion order, the oldest ones go first
+            while len(pages) > self.max_pages_per_user:
+                del pages[next(iter(pages))]
+            self._write(user_id, pages, generation)
+
+    def add_rows(self, user_id, rows, encode_cursor):
+        """Merge newly inserted rows into the user's cached first pages."""
+        with self._update_lock:
+            self._bump(user_id)
+            pages = self._read(user_id)
+            if pages:
+                self._write(user_id, self._merge(pages, rows, encode_cursor))
+
+    def _merge(self, pages, rows, encode_cursor):
+        updated = {}
+        for key, (page_rows, next_cursor) in pages.items():
+            after, limit, fields = json.loads(key)
+            if after is not None:
+                updated[key] = (page_rows, next_cursor)
+                continue
+            if self.backend.shared:
+                continue
+
+            # A page read after the insert already holds its rows
+            cached_ids = {row["id"] for row in page_rows}
+            columns = ["id", "created_at"] + (fields or [])
+            new_rows = [
+                {c: row[c] for c in columns if c in row} if fields else dict(row)
+                for row in rows
+                if row["id"] not in cached_ids
+            ]
+            merged = sorted(
+                new_rows + page_rows,
+                key=lambda row: (row["created_at"], row["id"]),
+                reverse=True,
+            )
+            if next_cursor or len(merged) > limit:
+                next_cursor = encode_cursor(merged[limit - 1])
+            updated[key] = (merged[:limit], next_cursor)
+        return updated
+
+    def invalidate(self, user_id):
+        """Drop every cached page of a user."""
+        with self._update_lock:
+            self._bump(user_id)
+            self._write(user_id, None)
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+    def _read(self, user_id):
+        try:
+            return self.backend.get(user_id)
+        except Exception as e:
+            logger.warning(f"History cache read failed: {e}")
+            return None
+
+    def _write(self, user_id, pages, generation=None):
+        try:
+            if pages:
+                self.backend.set(user_id, pages, generation)
+            else:
+                self.backend.delete(user_id)
+        except Exception as e:
+            logger.warning(f"History cache write failed: {e}")
+
+    def _bump(self, user_id):
+        try:
+            self.backend.bump(user_id)
+        except Exception as e:
+            logger.warning(f"History cache write failed: {e}")
+
+
+def create_history_cache(backend, url=None, max_users=1000, ttl_seconds=None):
+    """Build the history cache for the configured backend, None to disable."""
+    if backend == "none":
+        return None
+    if backend == "local":
+        return HistoryCache(LocalCacheBackend(max_users, ttl_seconds))
+    if backend == "redis":
+        return HistoryCache(RedisCacheBackend(url, ttl_seconds))
+    raise ValueError(f"Unknown history cache backend '{backend}'")
@@ -0,0 +1,67 @@
+import time
+import random
+import threading
+
+
+class LocalResponse:
+    def __init__(self, data):
+        self.data = data
+
+
+class LocalInsert:
+    def __init__(self, client, table_name, rows):
+        self.client = client
+        self.table_name = table_name
+        self.rows = rows
+
+    def execute(self):
+        return self.client._insert(self.table_name, self.rows)
+
+
+class LocalTable:
+    def __init__(self, client, table_name):
+        self.client = client
+        self.table_name = table_name
+
+    def insert(self, rows):
+        return LocalInsert(self.client, self.table_name, rows)
+
+
+class LocalTableClient:
+    """
+    In-memory stand-in for the Supabase client's `table(...).insert(...)`,
+    used to exercise database writes offline.
+
+    Every `execute` sleeps `latency_ms` plus `per_row_ms` per row to mimic a
+    round trip, and fails with probability `failure_rate`. Inserted rows are
+    kept per table in `rows`, and `requests` counts the round trips.
+    """
+
+    def __init__(self, latency_ms=0.0, per_row_ms=0.0, failure_rate=0.0, seed=0):
+        self.latency = latency_ms / 1000.0
+        self.per_row = per_row_ms / 1000.0
+        self.failure_rate = failure_rate
+        self.rows = {}
+        self.requests = 0
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def table(self, table_name):
+        return LocalTable(self, table_name)
+
+    def _insert(self, table_name, rows):
+        rows = rows if isinstance(rows, list) else [rows]
+        time.sleep(self.latency + self.per_row * len(rows))
+
+        with self._lock:
+            self.requests += 1
+            if self._random.random() < self.failure_rate:
+                raise ConnectionError("Simulated insert failure")
+
+            table = self.rows.setdefault(table_name, [])
+            inserted = []
+            for row in rows:
+                table.append({"id": len(table) + 1, **row})
+                inserted.append(table[-1])
+        return LocalResponse(inserted)
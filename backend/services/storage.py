@@ -1,10 +1,17 @@
 import re
 import time
+import hashlib
 import logging
 
+from urllib.parse import urlparse
+
+from concurrent.futures import Executor
+
 from werkzeug.utils import secure_filename
 from supabase import Client
 
+from utils.metrics import STAGE_SECONDS, STORAGE_UPLOADS
+
 logger = logging.getLogger(__name__)
 
 
@@ -13,27 +20,75 @@ def sanitize_user_id(user_id):
     return re.sub(r"[^a-zA-Z0-9_-]", "_", user_id)
 
 
+def content_key(file_bytes: bytes):
+    """Object key derived from the SHA-256 of the file content."""
+    digest = hashlib.sha256(file_bytes).hexdigest()
+    return f"content/{digest[:2]}/{digest}"
+
+
+def object_path_from_url(file_url: str, bucket_name: str):
+    """Path of a file within the bucket, parsed from its public URL."""
+    path = urlparse(file_url).path
+    return path.split(f"/{bucket_name}/")[1] if f"/{bucket_name}/" in path else None
+
+
 def upload_file_to_storage(sb: Client, bucket_name: str, file, user_id: str):
     """Upload a file to Supabase Storage and return its public URL."""
+    try:
+        # Read file content
+        file_bytes = file.read()
+    except Exception as e:
+        logger.error(f"Exception during file upload: {e}")
+        return None, "Internal server error during file upload"
+
+    return upload_bytes_to_storage(
+        sb, bucket_name, file_bytes, file.filename, file.mimetype, user_id
+    )
+
+
+def upload_bytes_to_storage(
+    sb: Client,
+    bucket_name: str,
+    file_bytes: bytes,
+    filename: str,
+    content_type: str,
+    user_id: str,
+    content_addressed: bool = False,
+):
+    """
+    Upload file content to Supabase Storage and return its public URL.
+
+    With `content_addressed`, the object is named after the hash of its
+    content and shared by every upload of the same image, see
+    `upload_content_addressed`. The round trip is timed as the
+    'upload_file_to_storage' stage, wherever the upload runs.
+    """
+    with STAGE_SECONDS.time(stage="upload_file_to_storage"):
+        if content_addressed:
+            return upload_content_addressed(sb, bucket_name, file_bytes, content_type)
+        return _upload_named(
+            sb, bucket_name, file_bytes, filename, content_type, user_id
+        )
+
+
+def _upload_named(sb, bucket_name, file_bytes, filename, content_type, user_id):
     try:
         # Sanitize user_id
         sanitized_user_id = sanitize_user_id(user_id)
 
         # Generate unique filename
-        original_filename = secure_filename(file.filename)
+        original_filename = secure_filename(filename)
         unique_name = f"{sanitized_user_id}_{int(time.time())}_{original_filename}"
 
-        # Read file content
-        file_bytes = file.read()
-
         # Upload file to Supabase Storage
         upload_res = sb.storage.from_(bucket_name).upload(
-            unique_name, file_bytes, {"content-type": file.mimetype}
+            unique_name, file_bytes, {"content-type": content_type}
         )
 
         if not upload_res:
             logger.error("File upload failed: No response received")
             return None, "File upload failed"
+        STORAGE_UPLOADS.inc(result="uploaded")
 
         # Get public URL
         public_url_res = sb.storage.from_(bucket_name).get_public_url(unique_name)
@@ -46,3 +101,83 @@ def upload_file_to_storage(sb: Client, bucket_name: str, file, user_id: str):
     except Exception as e:
         logger.error(f"Exception during file upload: {e}")
         return None, "Internal server error during file upload"
+
+
+def upload_content_addressed(
+    sb: Client, bucket_name: str, file_bytes: bytes, content_type: str
+):
+    """
+    Store file content under its content hash and return its public URL.
+
+    The upload is skipped when the object already exists, so an image that
+    is uploaded many times is transferred and stored once. Predictions of
+    all users then reference the same object, which `delete_prediction`
+    only removes with its last reference.
+    """
+    object_path = content_key(file_bytes)
+    bucket = sb.storage.from_(bucket_name)
+    try:
+        # Checked on every upload, as another worker may have removed the
+        # object's last reference since this one stored it
+        if bucket.exists(object_path):
+            STORAGE_UPLOADS.inc(result="deduplicated")
+        else:
+            try:
+                bucket.upload(object_path, file_bytes, {"content-type": content_type})
+            except Exception:
+                # A concurrent upload of the same content may have won
+                if not bucket.exists(object_path):
+                    raise
+            STORAGE_UPLOADS.inc(result="uploaded")
+
+        public_url_res = bucket.get_public_url(object_path)
+        if not public_url_res:
+            logger.error("Failed to get public URL")
+            return None, "Failed to get public URL"
+
+        return public_url_res, None
+    except Exception as e:
+        logger.error(f"Exception during file upload: {e}")
+        return None, "Internal server error during file upload"
+
+
+def upload_many_to_storage(
+    sb: Client,
+    bucket_name: str,
+    files,
+    user_id: str,
+    executor: Executor,
+    content_addressed: bool = False,
+):
+    """
+    Start uploading several (filename, bytes, content_type) files
+    concurrently on `executor`. Returns one future per file, in order, each
+    resolving to a (public_url, error) pair.
+
+    Storage has no multi-object upload, so the round trips are overlapped
+    instead. Each name gets its position as a prefix, which keeps names
+    unique when the same filename appears twice within one second.
+    """
+    return [
+        executor.submit(
+            upload_bytes_to_storage,
+            sb,
+            bucket_name,
+            file_bytes,
+            f"{i}_{filename}",
+            content_type,
+            user_id,
+            content_addressed,
+        )
+        for i, (filename, file_bytes, content_type) in enumerate(files)
+    ]
+
+
+def upload_thumbnail(sb: Client, bucket_name: str, object_path: str, data: bytes):
+    """
+    Store a JPEG thumbnail, replacing an existing one, as content-addressed
+    originals can be stored again.
+    """
+    sb.storage.from_(bucket_name).upload(
+        object_path, data, {"content-type": "image/jpeg", "upsert": "true"}
+    )
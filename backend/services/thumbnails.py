@@ -0,0 +1,107 @@
+import io
+import logging
+import threading
+
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+# Every kind of thumbnail that may exist next to an original
+THUMBNAIL_NAMES = ("thumbnail", "preview")
+
+
+def thumbnail_path(object_path: str, name: str):
+    """Path of a thumbnail, stored next to its original in the bucket."""
+    return f"{object_path}.{name}.jpg"
+
+
+def thumbnail_url(file_url: str, name: str):
+    """Public URL of a thumbnail, from the public URL of its original."""
+    url = urlparse(file_url)
+    return url._replace(path=thumbnail_path(url.path, name)).geturl()
+
+
+def make_thumbnail(data: bytes, max_size: int, quality=80):
+    """
+    Encode a JPEG of at most `max_size` pixels on its longest side. JPEGs
+    are decoded at a reduced scale, so originals are never fully decoded.
+    """
+    with Image.open(io.BytesIO(data)) as img:
+        img.draft("RGB", (max_size, max_size))
+        img = ImageOps.exif_transpose(img).convert("RGB")
+        img.thumbnail((max_size, max_size), reducing_gap=3.0)
+
+        buffer = io.BytesIO()
+        img.save(buffer, "JPEG", quality=quality, optimize=True)
+        return buffer.getvalue()
+
+
+class ThumbnailWorker:
+    """
+    Generate the thumbnails of stored images on a pool of background
+    threads, off the request path, and store them with `upload(path,
+    data)`, which overwrites an existing thumbnail.
+
+    `sizes` maps names from THUMBNAIL_NAMES to the longest side in pixels
+    of the thumbnails to generate. At most `max_pending` images wait for
+    their thumbnails; further ones are skipped, and their history entries
+    fall back to the original.
+    """
+
+    def __init__(self, upload, sizes, workers=2, max_pending=256):
+        self.upload = upload
+        self.sizes = dict(sizes)
+        self.workers = max(1, int(workers))
+        self.max_pending = max(1, int(max_pending))
+
+        self._executor = ThreadPoolExecutor(
+            self.workers, thread_name_prefix="thumbnail"
+        )
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._counts = {"generated": 0, "failed": 0, "skipped": 0}
+
+    def submit(self, data: bytes, object_path: str):
+        """Queue the thumbnails of a stored image, without waiting for them."""
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self._counts["skipped"] += 1
+                logger.warning(f"Thumbnail backlog full, skipping {object_path}")
+                return False
+            self._pending += 1
+        self._executor.submit(self._generate, data, object_path)
+        return True
+
+    def stats(self):
+        with self._lock:
+            return {"pending": self._pending, **self._counts}
+
+    def close(self):
+        """Wait for the queued thumbnails to be uploaded."""
+        self._executor.shutdown(wait=True)
+
+    def after_fork(self):
+        """Start a thread pool of its own in a forked child process."""
+        self._executor = ThreadPoolExecutor(
+            self.workers, thread_name_prefix="thumbnail"
+        )
+        self._lock = threading.Lock()
+        self._pending = 0
+
+    def _generate(self, data, object_path):
+        try:
+            for name, max_size in self.sizes.items():
+                self.upload(
+                    thumbnail_path(object_path, name), make_thumbnail(data, max_size)
+                )
+            result = "generated"
+        except Exception as e:
+            logger.error(f"Thumbnail generation failed for {object_path}: {e}")
+            result = "failed"
+
+        with self._lock:
+            self._pending -= 1
+            self._counts[result] += 1
@@ -0,0 +1,165 @@
+import queue
+import logging
+import threading
+import time
+
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class WriteBehindQueue:
+    """
+    Collect records and write them in bulk from a background thread.
+
+    `write_fn` takes a list of records and returns a (success, error) pair,
+    like `insert_predictions`. A flush happens once `max_rows` records are
+    waiting or `flush_interval_ms` after the oldest waiting record arrived,
+    whichever comes first. A failed flush is retried `max_retries` times
+    with exponential backoff. After that the batch is split in halves that
+    are written on their own, so that one record the table rejects does not
+    take the rest of its batch with it; only records that fail alone are
+    dropped and logged.
+
+    At most `max_pending` records are held in memory; `put` refuses records
+    beyond that so the caller can write them synchronously instead.
+    """
+
+    def __init__(
+        self,
+        write_fn,
+        max_rows=50,
+        flush_interval_ms=200,
+        max_pending=10000,
+        max_retries=3,
+        retry_backoff_ms=100,
+    ):
+        self.write_fn = write_fn
+        self.max_rows = max(1, int(max_rows))
+        self.flush_interval = max(0.0, float(flush_interval_ms)) / 1000.0
+        self.max_retries = max(0, int(max_retries))
+        self.retry_backoff = max(0.0, float(retry_backoff_ms)) / 1000.0
+
+        self._queue = queue.Queue(maxsize=max(1, int(max_pending)))
+        self._lock = threading.Lock()
+        self._counts = Counter()
+        self._closed = False
+        self._start()
+
+    def put(self, record):
+        """
+        Queue a record for writing. Returns False, without queueing it, when
+        the queue is full or closed.
+        """
+        with self._lock:
+            if self._closed:
+                return False
+            try:
+                self._queue.put_nowait(record)
+            except queue.Full:
+                self._counts["rejected"] += 1
+                return False
+        return True
+
+    def stats(self):
+        """Return the queued records and how many were written so far."""
+        with self._lock:
+            return {
+                "pending": self._queue.qsize(),
+                "flushes": self._counts["flushes"],
+                "written": self._counts["written"],
+                "dropped": self._counts["dropped"],
+                "rejected": self._counts["rejected"],
+            }
+
+    def close(self, timeout=None):
+        """Flush the queued records and stop the background thread."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        # Blocks while the queue is full, the worker keeps draining it.
+        self._queue.put(_STOP)
+        self._worker.join(timeout)
+
+    def after_fork(self):
+        """
+        Restart the background thread in a forked child process, which
+        inherits the queue but not its thread. Records queued before the
+        fork are left to the parent to write.
+        """
+        self._queue = queue.Queue(maxsize=self._queue.maxsize)
+        self._lock = threading.Lock()
+        self._counts = Counter()
+        if not self._closed:
+            self._start()
+
+    def _start(self):
+        self._worker = threading.Thread(
+            target=self._run, name="write-behind", daemon=True
+        )
+        self._worker.start()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.max_rows:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            self._flush(batch)
+
+    def _flush(self, batch):
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                time.sleep(self.retry_backoff * 2 ** (attempt - 1))
+            success, error = self._write(batch)
+            if success:
+                return
+            logger.warning(
+                f"Write-behind flush of {len(batch)} records failed "
+                f"(attempt {attempt + 1}/{self.max_retries + 1}): {error}"
+            )
+        self._split(batch, error)
+
+    def _split(self, batch, error):
+        if len(batch) == 1:
+            with self._lock:
+                self._counts["dropped"] += 1
+            logger.error(f"Dropped record after failed flushes: {batch[0]}: {error}")
+            return
+
+        middle = len(batch) // 2
+        for half in (batch[:middle], batch[middle:]):
+            success, error = self._write(half)
+            if not success:
+                self._split(half, error)
+
+    def _write(self, batch):
+        with self._lock:
+            self._counts["flushes"] += 1
+        try:
+            success, error = self.write_fn(batch)
+        except Exception as e:
+            success, error = False, str(e)
+        if success:
+            with self._lock:
+                self._counts["written"] += len(batch)
+        return success, error
@@ -0,0 +1,578 @@
+"""
+Request parsing, prediction and response helpers shared by the Flask app
+(app.py) and the ASGI app (asgi.py), so both modes behave alike. Importing
+this module creates nothing: the models, indexes and services the helpers
+use are passed in by each app, see components.py.
+"""
+
+import io
+import os
+import json
+import zipfile
+import logging
+import mimetypes
+
+from config import Config
+from services.storage import object_path_from_url
+from services.thumbnails import ThumbnailWorker, thumbnail_url
+from services.write_behind import WriteBehindQueue
+from services.file_removal import DeferredFileRemover
+from services.database import build_prediction_record, decode_cursor, HISTORY_FIELDS
+from utils.validation import allowed_file, inspect_image
+from utils.metrics import STAGE_SECONDS, PREDICTIONS, CallbackMetric
+from ml.ml_config import MLConfig
+from ml.inference.cache import model_fingerprint
+
+logger = logging.getLogger(__name__)
+
+INVALID_FILE_TYPE = "Invalid file type. Only JPG, JPEG, PNG allowed."
+
+
+def predict_options(form, models):
+    """
+    Read and validate the options of an /api/predict form. Returns the
+    (model_id, top_k, tiled, tile_aggregation) options and the error.
+    """
+    model_id = form.get("model_id", MLConfig.DEFAULT_MODEL_ID)
+    top_k = form.get("top_k", type=int)
+    tiled = form.get("tiled", "false").lower() == "true"
+    tile_aggregation = form.get("tile_aggregation")
+    options = (model_id, top_k, tiled, tile_aggregation)
+
+    error = _top_k_error(top_k)
+    if error:
+        return options, error
+
+    if tiled and top_k:
+        logger.error("Both tiled and top_k requested.")
+        return options, "tiled cannot be combined with top_k"
+
+    if tile_aggregation not in (None, "max", "vote"):
+        logger.error(f"Invalid tile_aggregation value: {tile_aggregation}")
+        return options, "tile_aggregation must be 'max' or 'vote'"
+
+    return options, _model_error(models, model_id)
+
+
+def predict_image(predictor, data, top_k, tiled, tile_aggregation, embeddings=None):
+    """
+    Run the prediction of an /api/predict upload. Returns its label,
+    confidence, the extra fields of the response and the embedding to
+    index, None without an embedding index, when the model has none or the
+    prediction was reused (the upload is then indexed when first searched,
+    see `search_similar`).
+    """
+    if tiled:
+        tiled_prediction = predictor.predict_tiled(data, tile_aggregation)
+        return (
+            tiled_prediction["label"],
+            tiled_prediction["confidence"],
+            {"tiles": tiled_prediction["tiles"]},
+            None,
+        )
+
+    embedding = None
+    with_embedding = embeddings is not None and predictor.has_embeddings
+    if not top_k:
+        output = predictor.predict(data, with_embedding)
+        (predicted_class, confidence), embedding = (
+            output if with_embedding else (output, None)
+        )
+        return predicted_class, confidence, {}, embedding
+
+    if with_embedding:
+        top_predictions, embedding = predictor.predict_top_k(data, top_k, True)
+    else:
+        top_predictions = predictor.predict_top_k(data, top_k)
+
+    return (
+        top_predictions[0]["label"],
+        top_predictions[0]["confidence"],
+        {"top_k": top_predictions} if top_k else {},
+        embedding,
+    )
+
+
+def _top_k_error(top_k):
+    if top_k is not None and not 1 <= top_k <= len(MLConfig.CLASS_NAMES):
+        logger.error(f"Invalid top_k value: {top_k}")
+        return f"top_k must be between 1 and {len(MLConfig.CLASS_NAMES)}"
+    return None
+
+
+def _model_error(models, model_id):
+    if model_id not in models:
+        logger.error(f"Unknown model_id: {model_id}")
+        return f"Unknown model_id '{model_id}'"
+    return None
+
+
+def batch_options(form, models):
+    """
+    Read and validate the options of an /api/predict/batch form. Returns
+    the (user_id, model_id, top_k) options and the error.
+    """
+    user_id = form.get("user_id")
+    model_id = form.get("model_id", MLConfig.DEFAULT_MODEL_ID)
+    top_k = form.get("top_k", type=int)
+
+    if not user_id:
+        logger.error("Missing user_id in the batch request.")
+        return None, "Missing user_id"
+
+    error = _top_k_error(top_k) or _model_error(models, model_id)
+    if error:
+        return None, error
+
+    return (user_id, model_id, top_k), None
+
+
+def read_batch_files(images, archive):
+    """
+    Collect the (filename, bytes, content_type, error) of the uploaded images
+    and of the images inside an uploaded zip archive. Files that fail
+    validation are kept with None content and their error, so they get an
+    error line. Returns the files and the error of the whole request.
+    """
+    files = []
+    for file in images:
+        error = check_image(file.filename, file)
+        if error:
+            files.append((file.filename, None, None, error))
+        else:
+            files.append((file.filename, file.read(), file.mimetype, None))
+
+    if archive:
+        try:
+            archived, error = _read_archive(archive, len(files))
+        except zipfile.BadZipFile:
+            logger.error("Invalid zip archive provided.")
+            return None, "Invalid zip archive"
+        if error:
+            return None, error
+        files += archived
+
+    if not files:
+        logger.error("No files in the batch request.")
+        return None, "Missing images or archive"
+
+    if len(files) > Config.MAX_BATCH_IMAGES:
+        logger.error(f"Too many files in the batch request: {len(files)}")
+        return None, f"At most {Config.MAX_BATCH_IMAGES} images allowed"
+
+    return files, None
+
+
+def _read_archive(archive, loose_files):
+    files = []
+    with zipfile.ZipFile(archive.stream) as zf:
+        entries = [info for info in zf.infolist() if not info.is_dir()]
+        # Both limits are checked from the zip directory, before anything
+        # is extracted: highly compressed entries would otherwise be held in
+        # memory far beyond the size of the request.
+        count = loose_files + len(entries)
+        if count > Config.MAX_BATCH_IMAGES:
+            logger.error(f"Too many files in the batch request: {count}")
+            return None, f"At most {Config.MAX_BATCH_IMAGES} images allowed"
+        extracted = sum(
+            info.file_size
+            for info in entries
+            if info.file_size <= Config.MAX_UPLOAD_BYTES
+        )
+        if extracted > Config.MAX_REQUEST_BYTES:
+            logger.error(f"Archive too large when extracted: {extracted} bytes")
+            max_mb = Config.MAX_REQUEST_BYTES // 2**20
+            return None, f"Archive too large. At most {max_mb} MB when extracted."
+
+        for info in entries:
+            filename = os.path.basename(info.filename)
+            # The uncompressed size is known from the zip directory, so
+            # oversized entries are never extracted.
+            if info.file_size > Config.MAX_UPLOAD_BYTES:
+                max_mb = Config.MAX_UPLOAD_BYTES // 2**20
+                error = f"File too large. Maximum size is {max_mb} MB."
+                files.append((filename, None, None, error))
+                continue
+            if not allowed_file(filename):
+                files.append((filename, None, None, INVALID_FILE_TYPE))
+                continue
+            data = zf.read(info)
+            error = check_image(filename, io.BytesIO(data))
+            content_type = mimetypes.guess_type(filename)[0]
+            files.append((filename, None if error else data, content_type, error))
+    return files, None
+
+
+def check_image(filename, stream):
+    """Validate an upload by extension and image header, return the error."""
+    if not allowed_file(filename):
+        return INVALID_FILE_TYPE
+    _, error = inspect_image(stream, Config.MAX_UPLOAD_BYTES, Config.MAX_IMAGE_PIXELS)
+    return error
+
+
+def predict_chunk(predictor, images, top_k, embeddings=None):
+    """
+    Predict the valid images of a batch chunk. Returns their top-k lists
+    and embeddings, both with None entries for images that failed.
+    """
+    try:
+        if embeddings is not None and predictor.has_embeddings:
+            return predictor.predict_batch_with_embeddings(images, top_k or 1)
+        return predictor.predict_batch(images, top_k or 1), [None] * len(images)
+    except Exception as e:
+        logger.error(f"Error making batch prediction: {e}")
+        return [None] * len(images), [None] * len(images)
+
+
+def chunk_results(
+    chunk,
+    valid,
+    predictions,
+    vectors,
+    uploaded,
+    user_id,
+    model_id,
+    top_k,
+    thumbnails=None,
+):
+    """
+    Build the response lines of a predicted and uploaded batch chunk by
+    position, with the prediction records to save and the (file_url,
+    embedding) pairs to index once they are saved.
+    """
+    lines = {}
+    records = []
+    indexed = []
+    for i, top, vector, (public_url, error) in zip(
+        valid, predictions, vectors, uploaded
+    ):
+        if error:
+            lines[i] = {"error": error}
+        elif top is None:
+            lines[i] = {"error": "Error making prediction"}
+        else:
+            lines[i] = {
+                "label": top[0]["label"],
+                "confidence": top[0]["confidence"],
+                "file_url": public_url,
+                "model_id": model_id,
+            }
+            if top_k:
+                lines[i]["top_k"] = top
+            PREDICTIONS.inc(model_id=model_id, label=top[0]["label"])
+            queue_thumbnails(chunk[i][1], public_url, thumbnails)
+            records.append(
+                build_prediction_record(
+                    user_id, chunk[i][0], public_url, top[0]["label"], model_id
+                )
+            )
+            if vector is not None:
+                indexed.append((public_url, vector))
+    return lines, records, indexed
+
+
+def chunk_saved(lines, predictor, user_id, indexed, success, error, embeddings=None):
+    """
+    Index the embeddings of a batch chunk once its records are saved, or
+    turn its predictions into errors when saving failed.
+    """
+    if not success:
+        logger.error(f"Failed to save batch predictions to database: {error}")
+        for line in lines.values():
+            if "label" in line:
+                line.clear()
+                line["error"] = error
+    else:
+        for public_url, vector in indexed:
+            embeddings.add(predictor.fingerprint, user_id, public_url, vector)
+
+
+def chunk_lines(start, chunk, lines):
+    """Yield the NDJSON lines of a batch chunk, in upload order."""
+    for i, (filename, _, _, error) in enumerate(chunk):
+        line = lines.get(i, {"error": error})
+        yield json.dumps({"index": start + i, "filename": filename, **line}) + "\n"
+
+
+def history_options(args):
+    """
+    Read and validate the query of a history request. Returns the
+    (user_id, limit, after, fields) arguments of `fetch_history` and the
+    error.
+    """
+    user_id = args.get("user_id")
+    if not user_id:
+        return None, "Missing user_id"
+
+    limit = args.get("limit", Config.HISTORY_PAGE_SIZE, type=int)
+    if not 1 <= limit <= Config.HISTORY_MAX_PAGE_SIZE:
+        return None, f"limit must be between 1 and {Config.HISTORY_MAX_PAGE_SIZE}"
+
+    after = None
+    cursor = args.get("cursor")
+    if cursor:
+        after = decode_cursor(cursor)
+        if not after:
+            return None, "Invalid cursor"
+
+    fields = None
+    if args.get("fields"):
+        fields = [f.strip() for f in args["fields"].split(",") if f.strip()]
+        unknown = [f for f in fields if f not in HISTORY_FIELDS]
+        if unknown:
+            return None, f"Unknown fields: {', '.join(unknown)}"
+
+    return (user_id, limit, after, fields), None
+
+
+def queue_thumbnails(data, public_url, thumbnails=None):
+    """Generate the thumbnails of a stored image after the response."""
+    if thumbnails:
+        thumbnails.submit(data, object_path_from_url(public_url, Config.BUCKET_NAME))
+
+
+def with_thumbnail_urls(history, thumbnails=None):
+    """
+    Add the '<name>_url' of each thumbnail to the history records that have
+    a file URL. The records may be shared with the history cache, so they
+    are copied rather than updated.
+    """
+    if not thumbnails:
+        return history
+
+    records = []
+    for record in history:
+        file_url = record.get("file_url")
+        if file_url and object_path_from_url(file_url, Config.BUCKET_NAME):
+            record = dict(record)
+            for name in thumbnails.sizes:
+                record[f"{name}_url"] = thumbnail_url(file_url, name)
+        records.append(record)
+    return records
+
+
+def similar_options(args):
+    """
+    Read and validate the query of a similar-uploads request. Returns the
+    (user_id, pred_id, limit) options and the error.
+    """
+    user_id = args.get("user_id")
+    pred_id = args.get("id", type=int)
+    if not user_id or pred_id is None:
+        return None, "Missing user_id or id"
+
+    limit = args.get("limit", Config.SIMILAR_RESULTS, type=int)
+    if not 1 <= limit <= Config.SIMILAR_MAX_RESULTS:
+        return None, f"limit must be between 1 and {Config.SIMILAR_MAX_RESULTS}"
+
+    return (user_id, pred_id, limit), None
+
+
+def search_similar(record, limit, embeddings, models, download):
+    """
+    Search the embedding index for the uploads most similar to the upload
+    of a prediction record, None if it has no embedding. Uploads that were
+    not indexed yet are fetched with `download(object_path)` and indexed.
+    """
+    model_path = MLConfig.MODELS.get(record.get("model_id"))
+    try:
+        fingerprint = model_fingerprint(model_path) if model_path else None
+    except OSError:
+        fingerprint = None
+
+    with STAGE_SECONDS.time(stage="similar_search"):
+        matches = embeddings.search(
+            fingerprint, record["user_id"], record["file_url"], limit
+        )
+    if matches is None and index_upload(
+        record, fingerprint, embeddings, models, download
+    ):
+        with STAGE_SECONDS.time(stage="similar_search"):
+            matches = embeddings.search(
+                fingerprint, record["user_id"], record["file_url"], limit
+            )
+    return matches
+
+
+def index_upload(record, fingerprint, embeddings, models, download):
+    """
+    Compute and index the embedding of an upload whose prediction was
+    reused from the cache or a near-duplicate, from the stored file.
+    Returns whether it was indexed; only uploads predicted by the loaded
+    version of a model with embeddings can be.
+    """
+    model_id = record.get("model_id")
+    object_path = record.get("file_url") and object_path_from_url(
+        record["file_url"], Config.BUCKET_NAME
+    )
+    if fingerprint is None or model_id not in models or not object_path:
+        return False
+
+    try:
+        predictor = models.get(model_id)
+        if not predictor.has_embeddings or predictor.fingerprint != fingerprint:
+            return False
+        data = download(object_path)
+        with STAGE_SECONDS.time(stage="index_upload"):
+            embedding = predictor.embed(data)
+    except Exception as e:
+        logger.error(f"Could not index upload {record['file_url']}: {e}")
+        return False
+
+    embeddings.add(fingerprint, record["user_id"], record["file_url"], embedding)
+    return True
+
+
+def similar_items(matches, records, thumbnails=None):
+    """Pair the matches that still have a record with their similarity."""
+    return with_thumbnail_urls(
+        [
+            {**records[file_url], "similarity": similarity}
+            for file_url, similarity in matches
+            if file_url in records
+        ],
+        thumbnails,
+    )
+
+
+def bulk_delete_options(data):
+    """
+    Read and validate a bulk delete request body. Returns the (user_id,
+    ids) options, the ids without duplicates and in request order, and the
+    error.
+    """
+    data = data if isinstance(data, dict) else {}
+    user_id = data.get("user_id")
+    if not isinstance(user_id, str) or not user_id:
+        logger.error("Missing user_id in the bulk delete request.")
+        return None, "Missing user_id"
+
+    pred_ids = data.get("ids")
+    if (
+        not isinstance(pred_ids, list)
+        or not pred_ids
+        or not all(isinstance(i, int) and not isinstance(i, bool) for i in pred_ids)
+    ):
+        logger.error("Missing or invalid ids in the bulk delete request.")
+        return None, "ids must be a non-empty list of integers"
+
+    pred_ids = list(dict.fromkeys(pred_ids))
+    if len(pred_ids) > Config.MAX_BULK_DELETE:
+        return None, f"At most {Config.MAX_BULK_DELETE} ids can be deleted at once"
+
+    return (user_id, pred_ids), None
+
+
+def bulk_delete_results(pred_ids, outcomes):
+    return [
+        (
+            {"id": pred_id, "error": outcomes[pred_id]}
+            if outcomes[pred_id]
+            else {"id": pred_id, "success": True}
+        )
+        for pred_id in pred_ids
+    ]
+
+
+def create_thumbnail_worker(upload):
+    """
+    The worker generating the configured thumbnails of uploaded images in
+    the background, None when disabled.
+    """
+    if not Config.THUMBNAIL_ENABLED:
+        return None
+    return ThumbnailWorker(
+        upload,
+        {
+            name: size
+            for name, size in (
+                ("thumbnail", Config.THUMBNAIL_SIZE),
+                ("preview", Config.PREVIEW_SIZE),
+            )
+            if size
+        },
+        workers=Config.THUMBNAIL_WORKERS,
+        max_pending=Config.THUMBNAIL_MAX_PENDING,
+    )
+
+
+def create_write_behind(write):
+    """
+    The queue writing prediction rows in bulk in the background, None when
+    disabled.
+    """
+    if not Config.WRITE_BEHIND_ENABLED:
+        return None
+    return WriteBehindQueue(
+        write,
+        max_rows=Config.WRITE_BEHIND_MAX_ROWS,
+        flush_interval_ms=Config.WRITE_BEHIND_FLUSH_MS,
+        max_pending=Config.WRITE_BEHIND_MAX_PENDING,
+        max_retries=Config.WRITE_BEHIND_MAX_RETRIES,
+        retry_backoff_ms=Config.WRITE_BEHIND_RETRY_BACKOFF_MS,
+    )
+
+
+def create_file_remover(remove):
+    """
+    The remover of the files of deleted predictions, once no queued row can
+    still reference them. None without content-addressed storage, where
+    files are not shared, or when disabled.
+    """
+    if not Config.CONTENT_ADDRESSED_STORAGE or Config.FILE_REMOVAL_DELAY_S <= 0:
+        return None
+    return DeferredFileRemover(remove, Config.FILE_REMOVAL_DELAY_S)
+
+
+def service_stats(history_cache, write_behind, thumbnails, file_remover):
+    """
+    The counters of the services of an app: hits and misses of the history
+    cache, the rows of the write-behind queue, the thumbnail backlog and
+    the files waiting for removal.
+    """
+    return {
+        "history_cache": history_cache.stats() if history_cache else None,
+        "write_behind": write_behind.stats() if write_behind else None,
+        "thumbnails": thumbnails.stats() if thumbnails else None,
+        "file_removal": file_remover.stats() if file_remover else None,
+    }
+
+
+def register_service_metrics(history_cache, write_behind):
+    """Expose the counters of the history cache and write-behind queue."""
+    CallbackMetric(
+        "history_cache_lookups_total",
+        "History cache lookups, by result.",
+        ["result"],
+        lambda: (
+            {
+                ("hit",): history_cache.stats()["hits"],
+                ("miss",): history_cache.stats()["misses"],
+            }
+            if history_cache
+            else {}
+        ),
+        type="counter",
+    )
+    CallbackMetric(
+        "write_behind_rows_total",
+        "Prediction rows handled by the write-behind queue, by result.",
+        ["result"],
+        lambda: (
+            {
+                (result,): count
+                for result, count in write_behind.stats().items()
+                if result in ("written", "dropped", "rejected")
+            }
+            if write_behind
+            else {}
+        ),
+        type="counter",
+    )
+    CallbackMetric(
+        "write_behind_pending_rows",
+        "Prediction rows waiting in the write-behind queue.",
+        [],
+        lambda: {(): write_behind.stats()["pending"]} if write_behind else {},
+    )
@@ -0,0 +1,318 @@
+import os
+import json
+import time
+import atexit
+import bisect
+import threading
+
+from contextlib import contextmanager
+
+# Buckets in seconds, from a fast cache hit to a slow storage round trip.
+DEFAULT_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+)
+
+
+class Counter:
+    """A monotonically increasing count, optionally split by labels."""
+
+    type = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.register(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [
+                (self.name, dict(zip(self.labelnames, key)), value)
+                for key, value in self._values.items()
+            ]
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Histogram:
+    """Cumulative bucket counts, sum and count of observed values."""
+
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.register(self)
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        # Only the bucket the value falls into is counted here, cumulative
+        # counts are computed when the metrics are scraped.
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of a `with` block in seconds."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        with self._lock:
+            values = [
+                (key, list(counts), total, count)
+                for key, (counts, total, count) in self._values.items()
+            ]
+
+        samples = []
+        for key, counts, total, count in values:
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                samples.append(
+                    (f"{self.name}_bucket", {**labels, "le": le}, cumulative)
+                )
+            samples.append((f"{self.name}_sum", labels, total))
+            samples.append((f"{self.name}_count", labels, count))
+        return samples
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+
+class CallbackMetric:
+    """
+    Values owned by another component, read from `callback` when scraped.
+    The callback returns a {label values tuple: value} dict.
+    """
+
+    def __init__(self, name, documentation, labelnames, callback, type="gauge"):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.callback = callback
+        self.type = type
+        REGISTRY.register(self)
+
+    def samples(self):
+        return [
+            (self.name, dict(zip(self.labelnames, key)), value)
+            for key, value in self.callback().items()
+        ]
+
+
+class MetricsRegistry:
+    """
+    The metrics of this process, or with `share` the sum of the metrics of
+    every process of a server with several workers.
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+        self._directory = None
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+
+    def share(self, directory, interval=5.0):
+        """
+        Write the metrics of this process to `directory` every `interval`
+        seconds and on exit, or only now without an interval, and render
+        the sum of every process that does. Counters and histograms of
+        processes that exited are kept in the sum, so it never decreases;
+        their gauges are left out.
+        """
+        os.makedirs(directory, exist_ok=True)
+        self._directory = directory
+        self._path = os.path.join(directory, f"{os.getpid()}_{time.time_ns()}.json")
+        self.write()
+        atexit.unregister(self.write)
+        if not interval:
+            return
+        atexit.register(self.write)
+
+        def run():
+            while True:
+                time.sleep(interval)
+                self.write()
+
+        threading.Thread(target=run, name="metrics-writer", daemon=True).start()
+
+    def reset(self):
+        """
+        Clear the counters and histograms, for a worker forked from a server
+        whose own metrics it shares.
+        """
+        with self._lock:
+            metrics = list(self._metrics)
+        for metric in metrics:
+            if hasattr(metric, "reset"):
+                metric.reset()
+
+    def write(self):
+        tmp_path = self._path + ".tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(self._collect(), f)
+            os.replace(tmp_path, self._path)
+        except OSError:
+            # The server removes the directory once its workers exited
+            pass
+
+    def render(self):
+        """Render every metric in the Prometheus text exposition format."""
+        metrics = self._collect()
+        if self._directory:
+            metrics = self._merge(metrics)
+
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric['name']} {metric['documentation']}")
+            lines.append(f"# TYPE {metric['name']} {metric['type']}")
+            for name, labels, value in metric["samples"]:
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def _collect(self):
+        with self._lock:
+            metrics = list(self._metrics)
+        return [
+            {
+                "name": metric.name,
+                "documentation": metric.documentation,
+                "type": metric.type,
+                "samples": metric.samples(),
+            }
+            for metric in metrics
+        ]
+
+    def _merge(self, own):
+        """Add the last written metrics of the other processes to `own`."""
+        merged = {}
+        for metric in own:
+            merged[metric["name"]] = {**metric, "samples": _sample_dict(metric)}
+
+        for file_name in os.listdir(self._directory):
+            path = os.path.join(self._directory, file_name)
+            if not file_name.endswith(".json") or path == self._path:
+                continue
+            try:
+                with open(path) as f:
+                    metrics = json.load(f)
+            except (OSError, ValueError):
+                continue
+            alive = _alive(int(file_name.split("_")[0]))
+
+            for metric in metrics:
+                if metric["type"] == "gauge" and not alive:
+                    continue
+                entry = merged.setdefault(metric["name"], {**metric, "samples": {}})[
+                    "samples"
+                ]
+                for key, sample in _sample_dict(metric).items():
+                    if key in entry:
+                        name, labels, value = entry[key]
+                        entry[key] = (name, labels, value + sample[2])
+                    else:
+                        entry[key] = sample
+
+        return [
+            {**metric, "samples": list(metric["samples"].values())}
+            for metric in merged.values()
+        ]
+
+
+def _sample_dict(metric):
+    return {
+        (name, tuple(labels.items())): (name, labels, value)
+        for name, labels, value in metric["samples"]
+    }
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+REGISTRY = MetricsRegistry()
+
+# Metrics of the API, shared by the request handlers and the inference code.
+REQUESTS = Counter(
+    "api_requests_total", "Handled API requests.", ["endpoint", "method", "status"]
+)
+REQUEST_SECONDS = Histogram(
+    "api_request_duration_seconds", "API request latency.", ["endpoint", "method"]
+)
+STAGE_SECONDS = Histogram(
+    "api_stage_duration_seconds",
+    "Latency of the individual stages of API requests.",
+    ["stage"],
+)
+MODEL_LOAD_SECONDS = Histogram(
+    "model_load_duration_seconds",
+    "Time to load and warm up a model.",
+    ["model_id"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+PREDICTIONS = Counter(
+    "predictions_total", "Predictions served, by label.", ["model_id", "label"]
+)
+STORAGE_UPLOADS = Counter(
+    "storage_uploads_total",
+    "Images stored, by whether they were uploaded or already stored.",
+    ["result"],
+)
@@ -1,6 +1,54 @@
+import os
+
+from PIL import Image
+
 ALLOWED_EXTENSIONS = {"png", "jpg", "jpeg"}
+ALLOWED_FORMATS = {"PNG", "JPEG"}
 
 
 def allowed_file(filename):
     """Check if the file has a valid extension."""
     return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
+
+
+def inspect_image(file, max_bytes, max_pixels):
+    """
+    Check an uploaded image from its header only, before it is stored or
+    decoded: its size in bytes, its real format and its dimensions.
+
+    Returns the image info (format, width, height, bytes) and None, or None
+    and an error message. The stream is left rewound.
+    """
+    try:
+        file.seek(0, os.SEEK_END)
+        size = file.tell()
+        file.seek(0)
+        if size > max_bytes:
+            return None, f"File too large. Maximum size is {max_bytes // 2**20} MB."
+
+        # Image.open only parses the header, the pixel data is not decoded.
+        with Image.open(file) as img:
+            image_format = img.format
+            width, height = img.size
+    except Image.DecompressionBombError:
+        return None, "Image dimensions too large."
+    except Exception:
+        return None, "File is not a valid image."
+    finally:
+        file.seek(0)
+
+    if image_format not in ALLOWED_FORMATS:
+        return None, "Invalid file type. Only JPG, JPEG, PNG allowed."
+
+    if width * height > max_pixels:
+        return (
+            None,
+            f"Image dimensions too large. Maximum is {max_pixels // 10**6} megapixels.",
+        )
+
+    return {
+        "format": image_format,
+        "width": width,
+        "height": height,
+        "bytes": size,
+    }, None
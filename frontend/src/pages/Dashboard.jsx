@@ -13,7 +13,9 @@ const Dashboard = () => {
   const [predictionResult, setPredictionResult] = useState("");
   const [predictionLoading, setPredictionLoading] = useState(false);
   const [history, setHistory] = useState([]);
+  const [nextCursor, setNextCursor] = useState(null);
   const [loadingHistory, setLoadingHistory] = useState(false);
+  const [loadingMore, setLoadingMore] = useState(false);
 
   useEffect(() => {
     if (isAuthenticated) {
@@ -77,14 +79,15 @@ const Dashboard = () => {
       const data = await res.json();
       if (data.label) {
         setPredictionResult({ label: data.label, confidence: data.confidence });
+        // The backend may save the row shortly after responding, so the new
+        // entry is added from the response instead of refetching the history
+        addHistoryEntry(data);
       } else {
         setPredictionResult({
           label: "Brak wyniku",
           confidence: "100",
         });
       }
-
-      fetchHistory();
     } catch (err) {
       console.error(err);
       setPredictionResult("Błąd podczas predykcji");
@@ -93,13 +96,30 @@ const Dashboard = () => {
     }
   };
 
+  // Only the columns shown in the history list
+  const HISTORY_FIELDS = "file_url,filename,label";
+  const HISTORY_PAGE_SIZE = 20;
+
+  const fetchHistoryPage = async (cursor) => {
+    const params = new URLSearchParams({
+      user_id: user.sub,
+      limit: HISTORY_PAGE_SIZE,
+      fields: HISTORY_FIELDS,
+    });
+    if (cursor) {
+      params.append("cursor", cursor);
+    }
+    const res = await fetch(`${BASE_URL}/history?${params}`);
+    return res.json();
+  };
+
   const fetchHistory = async () => {
     setLoadingHistory(true);
 
     try {
-      const res = await fetch(`${BASE_URL}/history?user_id=${user.sub}`);
-      const data = await res.json();
-      setHistory(data);
+      const data = await fetchHistoryPage(null);
+      setHistory(data.items);
+      setNextCursor(data.next_cursor);
       // setHistory(mockHistory);
     } catch (err) {
       console.error(err);
@@ -107,6 +127,32 @@ const Dashboard = () => {
     setLoadingHistory(false);
   };
 
+  // Entries whose row is not written yet have no id until the next refetch
+  const addHistoryEntry = (data) => {
+    const entry = {
+      id: data.id,
+      key: data.id ?? `pending-${data.file_url}-${data.created_at}`,
+      filename: data.filename,
+      file_url: data.file_url,
+      label: data.label,
+      created_at: data.created_at,
+    };
+    setHistory((prev) => [entry, ...prev]);
+  };
+
+  const fetchMoreHistory = async () => {
+    setLoadingMore(true);
+
+    try {
+      const data = await fetchHistoryPage(nextCursor);
+      setHistory((prev) => [...prev, ...data.items]);
+      setNextCursor(data.next_cursor);
+    } catch (err) {
+      console.error(err);
+    }
+    setLoadingMore(false);
+  };
+
   const handleDelete = async (id) => {
     try {
       await fetch(`${BASE_URL}/history/${id}`, {
@@ -213,13 +259,20 @@ const Dashboard = () => {
                 ) : (
                   history.map((item) => (
                     <li
-                      key={item.id}
+                      key={item.key ?? item.id}
                       className="grid grid-cols-10 place-items-center items-center border-b border-dashed py-2"
                     >
-                      <span className="col-span-1">{item.id}</span>
+                      <span className="col-span-1">{item.id ?? "…"}</span>
                       <img
-                        src={item.file_url}
+                        src={item.thumbnail_url || item.file_url}
                         alt={item.filename}
+                        loading="lazy"
+                        onError={(e) => {
+                          // Older uploads have no thumbnail
+                          if (e.currentTarget.src !== item.file_url) {
+                            e.currentTarget.src = item.file_url;
+                          }
+                        }}
                         className="col-span-2 h-16 w-16 object-cover"
                       />
                       <span className="col-span-3 text-center">
@@ -229,7 +282,8 @@ const Dashboard = () => {
                       <span className="col-span-2">
                         <button
                           onClick={() => handleDelete(item.id)}
-                          className="rounded bg-red-500 p-2 text-white hover:cursor-pointer hover:bg-red-700"
+                          disabled={item.id == null}
+                          className="rounded bg-red-500 p-2 text-white hover:cursor-pointer hover:bg-red-700 disabled:cursor-not-allowed disabled:opacity-50"
                         >
                           Usuń
                         </button>
@@ -238,6 +292,17 @@ const Dashboard = () => {
                   ))
                 )}
               </ul>
+              {nextCursor && (
+                <div className="py-2 text-center">
+                  <button
+                    onClick={fetchMoreHistory}
+                    disabled={loadingMore}
+                    className="rounded bg-blue-500 p-2 text-white hover:cursor-pointer hover:bg-blue-700"
+                  >
+                    {loadingMore ? "Ładowanie..." : "Pokaż więcej"}
+                  </button>
+                </div>
+              )}
             </div>
           )}
         </div>
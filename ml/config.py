@@ -6,11 +6,12 @@ DATA_DIR = os.path.join(BASE_DIR, "ml", "data")
 CONSTELLATIONS_DIR = os.path.join(BASE_DIR, "ml", "data", "constellations")
 MODELS_DIR = os.path.join(BASE_DIR, "ml", "models")
 SCRIPTS_DIR = os.path.join(BASE_DIR, "ml", "scripts")
+BACKEND_DIR = os.path.join(BASE_DIR, "backend")
 
 # Data and processing parameters
 IMG_SIZE = 96
 BATCH_SIZE = 4
-VALIDATION_SPLIT = 0.2
+VALIDATION_SPLIT = 0.3
 
 # Model training parameters
 EPOCHS = 8
@@ -18,6 +19,10 @@ EPOCHS_FINE_TUNE = 8
 LEARNING_RATE = 0.0001
 FINE_TUNE_LR = 0.00001
 
+# Quantization parameters
+CALIBRATION_SAMPLES = 200  # images used to calibrate full-integer quantization
+EVALUATION_SAMPLES = 500  # validation images used to compare converted models
+
 # Data augmentation configuration
 AUGMENATION_CONFIG = {
     "horizontal_flip": True,
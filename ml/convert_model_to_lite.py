@@ -1,25 +1,142 @@
 import os
+import argparse
 import tensorflow as tf
 
-from config import MODELS_DIR
+from config import (
+    MODELS_DIR,
+    DATA_DIR,
+    VALIDATION_SPLIT,
+    CALIBRATION_SAMPLES,
+)
+from utils.dataset import (
+    list_labelled_images,
+    split_training_validation,
+    sample_images,
+    load_image,
+)
 
-# Load the best model
-model = tf.keras.models.load_model(MODELS_DIR + "/best_model.keras")
+# Output file for each conversion mode. The dynamic-range model keeps the
+# name the backend loads by default.
+OUTPUT_NAMES = {
+    "float": "best_model_float.tflite",
+    "dynamic": "best_model.tflite",
+    "int8": "best_model_int8.tflite",
+}
 
-# Convert the model to TensorFlow Lite
-converter = tf.lite.TFLiteConverter.from_keras_model(model)
 
-# Optional: Set the optimization strategy for the model
-converter.optimizations = [tf.lite.Optimize.DEFAULT]  # Kwantyzacja
+def representative_dataset(images, img_size):
+    """
+    Feed calibration images to the converter, preprocessed exactly like
+    backend uploads so the quantization ranges match what is served.
+    """
 
-# Convert the model
-tflite_model = converter.convert()
+    def generator():
+        for path, _ in images:
+            yield [load_image(path, img_size)[None, ...]]
 
-# Define the path to save the TFLite model
-tflite_model_path = os.path.join(MODELS_DIR, "best_model.tflite")
+    return generator
 
-# Save the TFLite model
-with open(tflite_model_path, "wb") as f:
-    f.write(tflite_model)
 
-print(f"Model saved to {tflite_model_path}")
+def with_embedding_output(model):
+    """
+    Add the pooled backbone features, the input of the Dense head that
+    `build_model` puts on top of the backbone, as a second output after the
+    class probabilities. The backend serves these embeddings to find
+    similar uploads.
+    """
+    pooling = next(
+        layer
+        for layer in model.layers
+        if isinstance(layer, tf.keras.layers.GlobalAveragePooling2D)
+    )
+    return tf.keras.Model(model.inputs, [model.outputs[0], pooling.output])
+
+
+def convert(model, mode, calibration_images=None, uint8_io=False):
+    """
+    Convert a Keras model to TensorFlow Lite.
+
+    Modes:
+    - 'float': no quantization.
+    - 'dynamic': dynamic-range quantization of the weights.
+    - 'int8': full-integer quantization calibrated on `calibration_images`,
+      with float32 input/output, or uint8 input/output with `uint8_io`.
+    """
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+
+    if mode in ("dynamic", "int8"):
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]  # Kwantyzacja
+
+    if mode == "int8":
+        converter.representative_dataset = representative_dataset(
+            calibration_images, model.input_shape[1]
+        )
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+        if uint8_io:
+            converter.inference_input_type = tf.uint8
+            converter.inference_output_type = tf.uint8
+
+    return converter.convert()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert the best model to TFLite")
+    parser.add_argument(
+        "--mode", choices=["float", "dynamic", "int8", "all"], default="dynamic"
+    )
+    parser.add_argument(
+        "--uint8-io",
+        action="store_true",
+        help="Use uint8 instead of float32 input/output for the int8 model",
+    )
+    parser.add_argument(
+        "--report",
+        action="store_true",
+        help="Compare the converted models on held-out images (implied by 'all')",
+    )
+    parser.add_argument(
+        "--embeddings",
+        action="store_true",
+        help="Also output the pooled backbone features used for similar-image search",
+    )
+    args = parser.parse_args()
+
+    # Load the best model
+    model = tf.keras.models.load_model(MODELS_DIR + "/best_model.keras")
+    if args.embeddings:
+        model = with_embedding_output(model)
+
+    modes = ["float", "dynamic", "int8"] if args.mode == "all" else [args.mode]
+    calibration_images = None
+    if "int8" in modes:
+        # Calibrate on training images only, the validation subset is left
+        # for evaluate_tflite.py
+        images, _ = list_labelled_images(DATA_DIR)
+        training, _ = split_training_validation(images, VALIDATION_SPLIT)
+        calibration_images = sample_images(training, CALIBRATION_SAMPLES)
+
+    for mode in modes:
+        # Convert the model
+        tflite_model = convert(model, mode, calibration_images, args.uint8_io)
+
+        # Save the TFLite model
+        tflite_model_path = os.path.join(MODELS_DIR, OUTPUT_NAMES[mode])
+        with open(tflite_model_path, "wb") as f:
+            f.write(tflite_model)
+
+        print(f"Model saved to {tflite_model_path}")
+
+    if args.report or args.mode == "all":
+        from evaluate_tflite import evaluate_models
+
+        evaluate_models(
+            [
+                os.path.join(MODELS_DIR, OUTPUT_NAMES[mode])
+                for mode in ("float", "dynamic", "int8")
+                if os.path.exists(os.path.join(MODELS_DIR, OUTPUT_NAMES[mode]))
+            ]
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+import os
+import sys
+import json
+import time
+import numpy as np
+import tensorflow as tf
+
+from config import (
+    MODELS_DIR,
+    DATA_DIR,
+    VALIDATION_SPLIT,
+    EVALUATION_SAMPLES,
+)
+from utils.dataset import (
+    list_labelled_images,
+    split_training_validation,
+    sample_images,
+    load_image,
+)
+
+
+def evaluate_model(model_path, images):
+    """
+    Measure a TFLite model on labelled images: size on disk, per-image
+    invoke latency and top-1 accuracy. Quantized inputs and outputs are
+    converted with the model's scale and zero point.
+    """
+    interpreter = tf.lite.Interpreter(model_path=model_path)
+    interpreter.allocate_tensors()
+    input_details = interpreter.get_input_details()[0]
+    # Models converted with --embeddings also output the pooled features,
+    # which are wider than the class probabilities
+    output_details = min(
+        interpreter.get_output_details(), key=lambda details: details["shape"][-1]
+    )
+    img_size = input_details["shape"][1]
+
+    latencies = []
+    correct = 0
+    for path, label in images:
+        image = load_image(path, img_size)[None, ...]
+        if input_details["dtype"] != np.float32:
+            scale, zero_point = input_details["quantization"]
+            limits = np.iinfo(input_details["dtype"])
+            image = np.clip(np.rint(image / scale) + zero_point, limits.min, limits.max)
+            image = image.astype(input_details["dtype"])
+
+        interpreter.set_tensor(input_details["index"], image)
+        start = time.perf_counter()
+        interpreter.invoke()
+        latencies.append((time.perf_counter() - start) * 1000)
+
+        output = interpreter.get_tensor(output_details["index"])[0]
+        if output_details["dtype"] != np.float32:
+            scale, zero_point = output_details["quantization"]
+            output = (output.astype(np.float32) - zero_point) * scale
+        correct += int(np.argmax(output) == label)
+
+    return {
+        "model": os.path.basename(model_path),
+        "size_kb": os.path.getsize(model_path) / 1024,
+        "input_dtype": np.dtype(input_details["dtype"]).name,
+        "latency_ms_mean": float(np.mean(latencies)),
+        "latency_ms_p50": float(np.percentile(latencies, 50)),
+        "latency_ms_p95": float(np.percentile(latencies, 95)),
+        "top1_accuracy": correct / len(images),
+    }
+
+
+def write_report(results, images_count, report_path):
+    """Write the comparison as JSON and as a Markdown table next to it."""
+    with open(report_path + ".json", "w") as f:
+        json.dump({"images": images_count, "models": results}, f, indent=2)
+
+    lines = [
+        f"Evaluated on {images_count} images of the validation subset.",
+        "",
+        "| Model | Input | Size (KB) | Mean latency (ms) | p95 latency (ms) | Top-1 |",
+        "| ----- | ----- | --------- | ----------------- | ---------------- | ----- |",
+    ]
+    for r in results:
+        lines.append(
+            f"| {r['model']} | {r['input_dtype']} | {r['size_kb']:.0f} "
+            f"| {r['latency_ms_mean']:.2f} | {r['latency_ms_p95']:.2f} "
+            f"| {r['top1_accuracy']:.3f} |"
+        )
+    with open(report_path + ".md", "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def evaluate_models(model_paths, report_path=None):
+    """
+    Compare TFLite models on the validation subset that training held out,
+    which calibration does not use either.
+    """
+    images, _ = list_labelled_images(DATA_DIR)
+    _, validation = split_training_validation(images, VALIDATION_SPLIT)
+    held_out = sample_images(validation, EVALUATION_SAMPLES)
+    if not held_out:
+        raise ValueError(f"No held-out images found in {DATA_DIR}")
+
+    results = [evaluate_model(path, held_out) for path in model_paths]
+
+    report_path = report_path or os.path.join(MODELS_DIR, "quantization_report")
+    write_report(results, len(held_out), report_path)
+    print(f"Report saved to {report_path}.json and {report_path}.md")
+    return results
+
+
+if __name__ == "__main__":
+    # Usage: python evaluate_tflite.py model_a.tflite [model_b.tflite ...]
+    evaluate_models(sys.argv[1:])
@@ -9,6 +9,7 @@ from config import (
     MODELS_DIR,
     IMG_SIZE,
     BATCH_SIZE,
+    VALIDATION_SPLIT,
     EPOCHS,
     EPOCHS_FINE_TUNE,
     BACKBONES,
@@ -52,7 +53,7 @@ def create_data_generators(preprocess_input):
     """
     datagen = ImageDataGenerator(
         preprocessing_function=preprocess_input,
-        validation_split=0.3,
+        validation_split=VALIDATION_SPLIT,
         horizontal_flip=True,
         vertical_flip=True,
         rotation_range=180,
@@ -0,0 +1,71 @@
+import os
+import sys
+import random
+
+import numpy as np
+
+from config import BACKEND_DIR
+
+# Decode images with the backend's preprocessing, see `load_image`
+sys.path.append(BACKEND_DIR)
+from ml.inference import preprocess
+
+# The formats `flow_from_directory` reads
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".ppm", ".tif", ".tiff")
+
+
+def list_labelled_images(data_dir):
+    """
+    List (path, class_index) pairs for the images in the class folders of
+    `data_dir`, in the order `flow_from_directory` lists them during
+    training: classes are the sorted folder names, and the images of each
+    are found recursively, by sorted folder and then sorted filename.
+    """
+    class_names = sorted(
+        name
+        for name in os.listdir(data_dir)
+        if os.path.isdir(os.path.join(data_dir, name))
+    )
+    images = []
+    for class_index, class_name in enumerate(class_names):
+        walk = sorted(os.walk(os.path.join(data_dir, class_name)), key=lambda w: w[0])
+        for dirpath, _, filenames in walk:
+            for filename in sorted(filenames):
+                if filename.lower().endswith(IMAGE_EXTENSIONS):
+                    images.append((os.path.join(dirpath, filename), class_index))
+    return images, class_names
+
+
+def split_training_validation(images, validation_split):
+    """
+    Split (path, class_index) pairs into the training and validation subsets
+    that `flow_from_directory` uses with `validation_split`: the first
+    fraction of each class's sorted filenames is the validation subset.
+    """
+    by_class = {}
+    for path, label in images:
+        by_class.setdefault(label, []).append((path, label))
+
+    training, validation = [], []
+    for class_images in by_class.values():
+        split = int(validation_split * len(class_images))
+        validation += class_images[:split]
+        training += class_images[split:]
+    return training, validation
+
+
+def sample_images(images, count, seed=42):
+    """Pick `count` of the images, shuffled deterministically."""
+    images = list(images)
+    random.Random(seed).shuffle(images)
+    return images[:count]
+
+
+def load_image(path, img_size):
+    """
+    Load an image the way the backend preprocesses uploads: decoded at a
+    reduced scale by `preprocess.load_image`, resized to `img_size` and
+    scaled to [0, 1] as float32.
+    """
+    img = preprocess.load_image(path, img_size)
+    return np.asarray(img, dtype=np.float32) * np.float32(1 / 255.0)